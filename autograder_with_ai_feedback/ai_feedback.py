@@ -4,26 +4,91 @@ AI-Powered Feedback Generator for Autograders
 Drop this file into your autograder folder and add one line to utils.py
 """
 
+import asyncio
+import codecs
+import contextlib
+import hashlib
 import json
 import os
+import random
 import re
-from typing import Dict, List, Any
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Any, Tuple
 import requests
+from requests.adapters import HTTPAdapter
+
+# Streaming notebook reader shipped with the autograder; this file also works on its own without it
+try:
+    from notebook_reader import iter_code_cells
+except ImportError:
+    iter_code_cells = None
+
+# Exact token counts if tiktoken is installed, otherwise about 4 characters per token
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# File locks, so processes sharing CACHE_DIR update the circuit breaker one at a time (not on Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # ============== CONFIGURATION ==============
 API_KEY_HERE = ""  # Add your OpenAI API key here
 MODEL = "gpt-4o"  # or "gpt-4o-mini" for faster/cheaper
-MAX_CODE_LENGTH = 8000  # Characters to include from student code
+FAST_MODEL = "gpt-4o-mini"  # Used for full-score submissions; a weak answer is escalated to MODEL
+FULL_SCORE_TIER = "fast"  # Full-score submissions: "fast" (FAST_MODEL), "none" (no API call) or "large" (MODEL)
+MAX_CONCURRENCY = 8  # API requests in flight at once when enhancing many results
+REQUEST_TIMEOUT = 30  # Seconds per API request
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.ai_feedback_cache')  # "" to disable
+CACHE_MAX_MB = 100  # Oldest entries are evicted beyond this size
+CACHE_MAX_AGE_DAYS = 30  # Entries older than this are ignored and evicted
+TIMED_TESTS = ("performance",)  # Tests scored by timings, which differ between runs: not part of the cache key
+MAX_RETRIES = 3  # Retries after a rate limit (429), server error (5xx), timeout or connection error
+RETRY_BASE_DELAY = 1.0  # Seconds; the backoff doubles on every retry, with random jitter
+RETRY_MAX_DELAY = 20.0  # Seconds; a longer Retry-After gives up instead of waiting
+CIRCUIT_FAILURES = 5  # Failed requests in a row that open the circuit breaker
+CIRCUIT_COOLDOWN = 300  # Seconds the API is not called once the breaker is open
+STREAM_FEEDBACK = True  # Stream the response, so generation can be cut off at the deadline
+AUTOGRADER_TIME_LIMIT = 600  # Seconds Gradescope allows the whole autograder (Settings > Autograder timeout)
+DEADLINE_MARGIN = 15  # Seconds kept free after feedback for writing results.json
+PROMPT_TOKEN_BUDGET = 3000  # Tokens for the prompt; code most relevant to the failing tests is kept first
+MAX_TEST_OUTPUT_TOKENS = 150  # Tokens of autograder output per failing test (passing tests send none)
+# USD per million (prompt, completion) tokens, for the spend in results['metrics']; update when prices change
+MODEL_PRICES = {"gpt-4o": (2.50, 10.00), "gpt-4o-mini": (0.15, 0.60)}
 # ===========================================
 
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+FULL_SCORE_MESSAGE = "All tests passed. Nice work."
+
+# Bump whenever the prompt or the system message changes, so cached feedback for the old prompt is not reused
+PROMPT_VERSION = 2
+
+API_URL = 'https://api.openai.com/v1/chat/completions'
+
+# One keep-alive session shared by every request, so only the first call pays for TCP+TLS setup
+_session = None
+_session_lock = threading.Lock()
+
 
-def enhance_results_with_ai_feedback(results: dict, autograder_dir: str) -> dict:
+def enhance_results_with_ai_feedback(results: dict, autograder_dir: str, deadline: float = None,
+                                     student_code: str = None) -> dict:
     """
     Enhance autograder results with AI-generated feedback.
     
     Args:
         results: The autograder results dictionary
         autograder_dir: Path to the autograder directory
+        deadline: time.time() by which feedback must be done (default: from results['execution_time'])
+        student_code: the submission.py source if the caller already has it in memory (default: read from disk)
         
     Returns:
         Enhanced results dictionary with AI feedback added
@@ -34,12 +99,65 @@ def enhance_results_with_ai_feedback(results: dict, autograder_dir: str) -> dict
         print("AI Feedback: No API key configured. Skipping AI feedback generation.")
         return results
     
+    return _enhance(results, autograder_dir, deadline, student_code)
+
+
+async def enhance_results_with_ai_feedback_async(results: dict, autograder_dir: str,
+                                                 executor: ThreadPoolExecutor = None) -> dict:
+    """
+    Async version of enhance_results_with_ai_feedback. The request runs over the shared session on a
+    thread of `executor` (the loop's default executor if None), whose size bounds the concurrency.
+    """
+    
+    if not API_KEY_HERE:
+        print("AI Feedback: No API key configured. Skipping AI feedback generation.")
+        return results
+    
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, _enhance, results, autograder_dir)
+
+
+async def enhance_many_results_async(jobs: List[Tuple[dict, str]], max_concurrency: int = None) -> List[dict]:
+    """Enhance many (results, autograder_dir) pairs concurrently, at most max_concurrency requests at a time."""
+    
+    with ThreadPoolExecutor(max_workers=max_concurrency or MAX_CONCURRENCY) as executor:
+        return await asyncio.gather(*(
+            enhance_results_with_ai_feedback_async(results, autograder_dir, executor)
+            for results, autograder_dir in jobs
+        ))
+
+
+def enhance_many_results_with_ai_feedback(jobs: List[Tuple[dict, str]], max_concurrency: int = None) -> List[dict]:
+    """
+    Batch entry point: enhance the results of a whole cohort concurrently.
+    
+    Args:
+        jobs: (results, autograder_dir) pairs
+        max_concurrency: API requests in flight at once (default MAX_CONCURRENCY)
+        
+    Returns:
+        The enhanced results dictionaries, in the order of `jobs`
+    """
+    
+    return asyncio.run(enhance_many_results_async(jobs, max_concurrency))
+
+
+def _enhance(results: dict, autograder_dir: str, deadline: float = None, student_code: str = None) -> dict:
+    """Collect the code, ask for feedback and attach it, with its telemetry in results['metrics']. Never raises."""
+    
+    if deadline is None:
+        deadline = feedback_deadline(results)
+    start_time = time.time()
+    metrics = {'cached': False, 'requests': []}
     try:
         # Get student code
-        student_code = get_student_code(autograder_dir)
+        if student_code is None:
+            student_code = get_student_code(autograder_dir)
+        else:
+            student_code = clean_student_code(student_code)
         
         # Generate feedback via GPT-4
-        feedback = generate_feedback(results, student_code)
+        feedback = generate_feedback(results, student_code, deadline, metrics)
         
         # Add feedback to results
         if feedback:
@@ -48,10 +166,33 @@ def enhance_results_with_ai_feedback(results: dict, autograder_dir: str) -> dict
     except Exception as e:
         # If anything fails, just return original results
         print(f"AI Feedback Error: {e}")
-        
+    
+    # Recorded even without feedback: failed and cut-off requests take time and may still be billed
+    results['metrics'] = total_metrics(metrics, time.time() - start_time)
     return results
 
 
+def feedback_deadline(results: dict) -> float:
+    """The autograder time limit minus the time Grade() already used, less DEADLINE_MARGIN, as a time.time()."""
+    
+    elapsed = results.get('execution_time') or 0
+    return time.time() + AUTOGRADER_TIME_LIMIT - elapsed - DEADLINE_MARGIN
+
+
+def get_session() -> requests.Session:
+    """The shared session, with a connection pool large enough for MAX_CONCURRENCY requests."""
+    
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(MAX_CONCURRENCY, 1))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+
 def get_student_code(autograder_dir: str) -> str:
     """Extract student code from submission."""
     
@@ -62,10 +203,7 @@ def get_student_code(autograder_dir: str) -> str:
     if os.path.exists(submission_py):
         try:
             with open(submission_py, 'r', encoding='utf-8') as f:
-                student_code = f.read()
-                # Clean up the code dividers
-                student_code = re.sub(r'#{50,}', '\n', student_code)
-                return student_code[:MAX_CODE_LENGTH]
+                return clean_student_code(f.read())
         except:
             pass
     
@@ -76,50 +214,128 @@ def get_student_code(autograder_dir: str) -> str:
             if file.endswith('.ipynb'):
                 try:
                     notebook_path = os.path.join(submission_dir, file)
-                    with open(notebook_path, 'r', encoding='utf-8') as f:
-                        notebook = json.load(f)
                         
                     # Extract code cells marked as AUTOGRADED
                     code_cells = []
-                    for cell in notebook.get('cells', []):
-                        if cell.get('cell_type') == 'code':
-                            source = cell.get('source', [])
-                            if source and len(source) > 0:
-                                # Check if it's autograded
-                                first_line = source[0] if isinstance(source, list) else source.split('\n')[0]
-                                if '# AUTOGRADED' in first_line or len(code_cells) == 0:
-                                    cell_text = ''.join(source) if isinstance(source, list) else source
-                                    code_cells.append(cell_text)
+                    for source in iter_notebook_code_cells(notebook_path):
+                        if source and len(source) > 0:
+                            # Check if it's autograded
+                            first_line = source[0] if isinstance(source, list) else source.split('\n')[0]
+                            if '# AUTOGRADED' in first_line or len(code_cells) == 0:
+                                cell_text = ''.join(source) if isinstance(source, list) else source
+                                code_cells.append(cell_text)
                     
                     student_code = '\n\n'.join(code_cells)
                     break
                 except:
                     continue
     
-    # Truncate if too long
-    if len(student_code) > MAX_CODE_LENGTH:
-        student_code = student_code[:MAX_CODE_LENGTH] + "\n\n[Code truncated for brevity...]"
-    
+    # Not truncated: create_feedback_prompt selects what fits in PROMPT_TOKEN_BUDGET
     return student_code
 
 
-def generate_feedback(results: dict, student_code: str) -> Dict[str, Any]:
-    """Generate AI feedback using GPT-4."""
+def clean_student_code(script: str) -> str:
+    """The source of submission.py as sent to the model: without the cell dividers."""
+    
+    # Clean up the code dividers
+    return re.sub(r'#{50,}', '\n', script)
+
+
+def iter_notebook_code_cells(notebook_path: str):
+    """Yield the source of each code cell, streaming past outputs when notebook_reader.py is available."""
+    
+    if iter_code_cells is not None:
+        yield from iter_code_cells(notebook_path)
+        return
+    
+    with open(notebook_path, 'r', encoding='utf-8') as f:
+        notebook = json.load(f)
+    for cell in notebook.get('cells', []):
+        if cell.get('cell_type') == 'code':
+            yield cell.get('source', [])
+
+
+def generate_feedback(results: dict, student_code: str, deadline: float = None,
+                      metrics: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Generate AI feedback using GPT-4. Cache hits and API requests are recorded in `metrics` if given."""
     
     # Prepare the test results summary
-    test_summaries = []
-    for test in results.get('tests', []):
-        test_info = {
-            'name': test.get('name', 'Unknown Test'),
-            'score': test.get('score', 0),
-            'max_score': test.get('max_score', 0),
-            'output': test.get('output', '')[:500]  # Limit output length
-        }
-        test_summaries.append(test_info)
+    test_summaries = summarize_tests(results)
+    
+    # Identical code and results (a resubmission or a regrade) reuse the stored feedback
+    cache_key = feedback_cache_key(test_summaries, student_code)
+    feedback = cache_get(cache_key)
+    if feedback is not None:
+        print("AI Feedback: Using cached feedback.")
+        feedback['routing'] = dict(feedback.get('routing') or {}, cached=True)
+        if metrics is not None:
+            metrics['cached'] = True
+        return feedback
+    
+    tier = choose_tier(test_summaries)
+    if tier == 'none':
+        return {'overall': FULL_SCORE_MESSAGE, 'tests': {}, 'routing': {'tier': 'none', 'model': None}}
     
     # Create the prompt
     prompt = create_feedback_prompt(test_summaries, student_code)
     
+    feedback, feedback_text, complete = request_feedback(prompt, tier_model(tier), deadline, metrics)
+    escalated = False
+    if tier == 'fast' and complete and is_low_confidence(feedback_text, feedback, test_summaries):
+        print(f"AI Feedback: Low-confidence response from {FAST_MODEL}. Escalating to {MODEL}.")
+        large_feedback, large_text, large_complete = request_feedback(prompt, MODEL, deadline, metrics)
+        if large_feedback:
+            feedback, complete, tier, escalated = large_feedback, large_complete, 'large', True
+    if not feedback:
+        return {}
+    
+    feedback['routing'] = {'tier': tier, 'model': tier_model(tier), 'escalated': escalated}
+    if complete:
+        cache_put(cache_key, feedback)
+    return feedback
+
+
+def choose_tier(test_summaries: List[Dict]) -> str:
+    """
+    Which model a submission needs: full-score submissions get FULL_SCORE_TIER, anything that
+    lost points goes straight to the large MODEL.
+    """
+    
+    if any(is_failing(test) for test in test_summaries):
+        return 'large'
+    return FULL_SCORE_TIER
+
+
+def tier_model(tier: str) -> str:
+    return FAST_MODEL if tier == 'fast' else MODEL
+
+
+def is_low_confidence(feedback_text: str, feedback: Dict[str, Any], test_summaries: List[Dict]) -> bool:
+    """The response was not JSON, has no overall assessment, or says nothing about a failing test."""
+    
+    try:
+        json.loads(re.search(r'\{.*\}', feedback_text, re.DOTALL).group())
+    except (AttributeError, ValueError):
+        return True
+    if not isinstance(feedback.get('overall'), str) or not feedback['overall'].strip():
+        return True
+    test_feedback = feedback.get('tests')
+    if not isinstance(test_feedback, dict):
+        return True
+    return any(is_failing(test) and match_test_feedback(test['name'], test_feedback) is None
+               for test in test_summaries)
+
+
+def request_feedback(prompt: str, model: str, deadline: float = None,
+                     metrics: Dict[str, Any] = None) -> Tuple[Dict[str, Any], str, bool]:
+    """
+    Ask `model` for feedback. Returns (feedback, response text, complete); feedback is {} on failure.
+    The request's latency, tokens, retries and cost are appended to metrics['requests'] if given;
+    a request that was never sent is counted in metrics['skipped'] instead, by reason.
+    """
+    
+    start_time = time.time()
+    stats = {}
     # Make API call
     try:
         headers = {
@@ -127,64 +343,510 @@ def generate_feedback(results: dict, student_code: str) -> Dict[str, Any]:
             'Content-Type': 'application/json'
         }
         
-        data = {
-            'model': MODEL,
-            'messages': [
-                {
-                    'role': 'system',
-                    'content': """You are a direct, knowledgeable programming instructor providing feedback on student code submissions. 
-                    Give specific, actionable feedback in 2-3 sentences per graded section.
-                    Focus on what the student did wrong and how to fix it, or what they did well if they succeeded.
-                    Be direct and technical - avoid unnecessary encouragement."""
-                },
-                {
-                    'role': 'user',
-                    'content': prompt
-                }
-            ],
-            'temperature': 0.3,
-            'max_tokens': 1500
-        }
+        data = build_chat_request(prompt, model)
+        data['stream'] = STREAM_FEEDBACK
+        if STREAM_FEEDBACK:
+            # Without this a streamed response carries no token counts
+            data['stream_options'] = {'include_usage': True}
         
-        response = requests.post(
-            'https://api.openai.com/v1/chat/completions',
-            headers=headers,
-            json=data,
-            timeout=30
-        )
+        response = post_with_retries(headers, data, deadline, stats)
+        if response is None:
+            return {}, '', False
         
         if response.status_code == 200:
-            result = response.json()
-            feedback_text = result['choices'][0]['message']['content']
-            return parse_feedback_response(feedback_text)
+            if response.headers.get('Content-Type', '').startswith('text/event-stream'):
+                feedback_text, complete = read_streamed_feedback(response, deadline, stats)
+            else:
+                result = response.json()
+                feedback_text, complete = result['choices'][0]['message']['content'], True
+                stats['usage'] = result.get('usage')
+            stats['text'] = feedback_text
+            if not complete:
+                # Keep the fields that arrived; tests without feedback get the score-based messages
+                print("AI Feedback: Response cut off at the grading deadline. Keeping the partial feedback.")
+                return parse_partial_feedback(feedback_text), feedback_text, False
+            return parse_feedback_response(feedback_text), feedback_text, True
         else:
             print(f"AI Feedback API Error: {response.status_code} - {response.text}")
-            return {}
+            return {}, '', False
             
     except Exception as e:
         print(f"AI Feedback Generation Error: {e}")
-        return {}
+        return {}, '', False
+    finally:
+        if metrics is not None and stats.get('skipped'):
+            skipped = metrics.setdefault('skipped', {})
+            skipped[stats['skipped']] = skipped.get(stats['skipped'], 0) + 1
+        elif metrics is not None:
+            metrics['requests'].append(request_metrics(model, data, stats, time.time() - start_time))
 
 
-def create_feedback_prompt(test_summaries: List[Dict], student_code: str) -> str:
-    """Create the prompt for GPT-4."""
+def request_metrics(model: str, data: dict, stats: dict, latency: float) -> Dict[str, Any]:
+    """
+    Telemetry of one request from the stats collected while making it. Token counts come from the
+    response's `usage` block; without one (a stream cut off at the deadline) they are estimated.
+    """
     
-    prompt = f"""Analyze this student's code submission and provide feedback based on the autograder results.
+    usage = stats.get('usage') or {}
+    if usage:
+        prompt_tokens, completion_tokens = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+    elif stats.get('status') == 200:
+        prompt_tokens = sum(count_tokens(message['content']) for message in data['messages'])
+        completion_tokens = count_tokens(stats.get('text', ''))
+    else:
+        # Rate-limited and failed requests are not billed
+        prompt_tokens, completion_tokens = 0, 0
+    first_token = stats.get('first_token_time')
+    return {
+        'model': model,
+        'status': stats.get('status'),
+        'latency': round(latency, 3),
+        'ttfb': stats.get('ttfb'),
+        'time_to_first_token': None if first_token is None else round(first_token - stats['start_time'], 3),
+        'retries': max(0, stats.get('attempts', 1) - 1),
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'estimated_tokens': not usage and stats.get('status') == 200,
+        'cost_usd': request_cost(model, prompt_tokens, completion_tokens),
+    }
 
-STUDENT CODE:
-```python
-{student_code}
-```
 
-AUTOGRADER RESULTS:
-"""
+def request_cost(model: str, prompt_tokens: int, completion_tokens: int, price_factor: float = 1.0):
+    """Cost in USD from MODEL_PRICES, or None for a model without a price."""
     
+    if model not in MODEL_PRICES:
+        return None
+    prompt_price, completion_price = MODEL_PRICES[model]
+    return round((prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6 * price_factor, 6)
+
+
+def total_metrics(metrics: Dict[str, Any], latency: float = None) -> Dict[str, Any]:
+    """Per-submission totals over the requests in `metrics`, as stored in results['metrics']. latency is None if unknown."""
+    
+    requests_made = metrics.get('requests', [])
+    costs = [request['cost_usd'] for request in requests_made]
+    return dict(
+        metrics,
+        skipped=metrics.get('skipped', {}),
+        latency=None if latency is None else round(latency, 3),
+        prompt_tokens=sum(request['prompt_tokens'] for request in requests_made),
+        completion_tokens=sum(request['completion_tokens'] for request in requests_made),
+        retries=sum(request['retries'] for request in requests_made),
+        cost_usd=None if None in costs else round(sum(costs), 6),
+    )
+
+
+def summarize_tests(results: dict) -> List[Dict]:
+    """Name, score, max score and output of every test, as sent to the model."""
+    
+    test_summaries = []
+    for test in results.get('tests', []):
+        test_info = {
+            'name': test.get('name', 'Unknown Test'),
+            'score': test.get('score', 0),
+            'max_score': test.get('max_score', 0),
+            'output': test.get('output', '')[:500]  # Limit output length
+        }
+        test_summaries.append(test_info)
+    return test_summaries
+
+
+def build_chat_request(prompt: str, model: str = None) -> dict:
+    """The chat completion request body for a feedback prompt (to MODEL unless `model` is given)."""
+    
+    return {
+        'model': model or MODEL,
+        'messages': [
+            {
+                'role': 'system',
+                'content': """You are a direct, knowledgeable programming instructor providing feedback on student code submissions. 
+                Give specific, actionable feedback in 2-3 sentences per graded section.
+                Focus on what the student did wrong and how to fix it, or what they did well if they succeeded.
+                Be direct and technical - avoid unnecessary encouragement."""
+            },
+            {
+                'role': 'user',
+                'content': prompt
+            }
+        ],
+        'temperature': 0.3,
+        'max_tokens': 1500
+    }
+
+
+def post_with_retries(headers: dict, data: dict, deadline: float = None, stats: dict = None):
+    """
+    POST to the API, retrying rate limits, server errors and network failures with jittered
+    exponential backoff (or the server's Retry-After), without going past the deadline.
+    Returns the last response, or None if there is none or the circuit breaker is open.
+    The attempts made and the last response's status and time to first byte are recorded in `stats` if given,
+    or, if no request was sent at all, why it was skipped ('circuit_open' or 'deadline').
+    """
+    
+    if stats is None:
+        stats = {}
+    for attempt in range(MAX_RETRIES + 1):
+        if not CIRCUIT_BREAKER.allow():
+            print("AI Feedback: API circuit breaker is open after repeated failures. Skipping AI feedback.")
+            if attempt == 0:
+                stats['skipped'] = 'circuit_open'
+            return None
+        timeout = REQUEST_TIMEOUT if deadline is None else min(REQUEST_TIMEOUT, deadline - time.time())
+        if timeout <= 0:
+            print("AI Feedback: No time left before the grading deadline. Skipping AI feedback.")
+            if attempt == 0:
+                stats['skipped'] = 'deadline'
+            return None
+        
+        response, retry_after = None, None
+        stats.update(attempts=attempt + 1, start_time=time.time(), status=None, ttfb=None)
+        try:
+            response = get_session().post(API_URL, headers=headers, json=data, timeout=timeout,
+                                          stream=data.get('stream', False))
+            # elapsed runs from sending the request to parsing the response headers
+            stats['status'], stats['ttfb'] = response.status_code, round(response.elapsed.total_seconds(), 3)
+            if response.status_code not in RETRYABLE_STATUS:
+                # Success, or an error retrying cannot fix (e.g. a bad API key): the provider is up
+                CIRCUIT_BREAKER.record_success()
+                return response
+            print(f"AI Feedback API Error: {response.status_code} (attempt {attempt + 1} of {MAX_RETRIES + 1})")
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print(f"AI Feedback Request Error: {e} (attempt {attempt + 1} of {MAX_RETRIES + 1})")
+        CIRCUIT_BREAKER.record_failure()
+        
+        if attempt == MAX_RETRIES:
+            break
+        if retry_after is not None:
+            if retry_after > RETRY_MAX_DELAY:
+                print(f"AI Feedback: Retry-After of {retry_after:.0f} s is too long. Giving up.")
+                break
+            delay = retry_after
+        else:
+            # Full jitter, so many graders hitting the same limit do not retry in lockstep
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        if deadline is not None and time.time() + delay >= deadline:
+            print("AI Feedback: No time left before the grading deadline to retry. Giving up.")
+            break
+        if response is not None:
+            response.close()
+        time.sleep(delay)
+    
+    return response
+
+
+def read_streamed_feedback(response, deadline: float = None, stats: dict = None) -> Tuple[str, bool]:
+    """
+    Collect the text of a streamed (SSE) chat completion. Returns (text, complete); complete is False
+    if the stream broke off or was closed at the deadline. The time the first text arrived and the
+    final `usage` block are recorded in `stats` if given.
+    """
+    
+    if stats is None:
+        stats = {}    
+    parts = []
+    # Shut the connection down at the deadline, which also interrupts a read that is waiting on the server
+    watchdog = None
+    if deadline is not None:
+        watchdog = threading.Timer(max(0.0, deadline - time.time()), _interrupt, args=(response,))
+        watchdog.daemon = True
+        watchdog.start()
+    try:
+        for line in _iter_stream_lines(response):
+            if deadline is not None and time.time() >= deadline:
+                break
+            if not line or not line.startswith('data:'):
+                continue
+            payload = line[len('data:'):].strip()
+            if payload == '[DONE]':
+                return ''.join(parts), True
+            chunk = json.loads(payload)
+            if chunk.get('usage'):
+                stats['usage'] = chunk['usage']
+            for choice in chunk.get('choices', []):
+                content = (choice.get('delta') or {}).get('content')
+                if content and 'first_token_time' not in stats:
+                    stats['first_token_time'] = time.time()
+                parts.append(content or '')
+    except Exception as e:
+        if deadline is None or time.time() < deadline:
+            print(f"AI Feedback Stream Error: {e}")
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+        response.close()
+    return ''.join(parts), False
+
+
+def _iter_stream_lines(response):
+    """Lines of a streamed response as soon as they arrive (iter_lines waits for whole 512-byte chunks)."""
+    
+    read1 = getattr(response.raw, 'read1', None)
+    if read1 is None:
+        response.encoding = 'utf-8'
+        yield from response.iter_lines(decode_unicode=True)
+        return
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    while True:
+        data = read1(8192)
+        if not data:
+            break
+        *lines, pending = (pending + decoder.decode(data)).split('\n')
+        for line in lines:
+            yield line.rstrip('\r')
+    if pending:
+        yield pending
+
+
+def _interrupt(response):
+    try:
+        sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    response.close()
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or an HTTP date), or None."""
+    
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Stops calling the API for CIRCUIT_COOLDOWN seconds after CIRCUIT_FAILURES failed requests in a row.
+    After the cooldown the breaker is half-open: the first caller claims a single probe request and everyone
+    else keeps skipping until it succeeds (closing the breaker) or fails (reopening it). A probe that never
+    reports back is given up after another CIRCUIT_COOLDOWN.
+    With a CACHE_DIR the state is kept in a file, so grading runs and worker processes share it.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+    
+    def _path(self):
+        return os.path.join(CACHE_DIR, 'circuit.json') if CACHE_DIR else None
+    
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the lock, across processes too, and the current state loaded from the file."""
+        with self.lock:
+            lock_file = None
+            if self._path() is not None and fcntl is not None:
+                try:
+                    os.makedirs(CACHE_DIR, exist_ok=True)
+                    lock_file = open(self._path() + '.lock', 'a')
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                except OSError:
+                    lock_file = None
+            try:
+                self._load()
+                yield
+            finally:
+                if lock_file is not None:
+                    lock_file.close()  # releases the flock
+    
+    def _load(self):
+        path = self._path()
+        if path is None:
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self.failures, self.opened_at = state['failures'], state['opened_at']
+            self.probe_at = state.get('probe_at')
+        except (OSError, ValueError, KeyError):
+            pass
+    
+    def _save(self):
+        path = self._path()
+        if path is None:
+            return
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'failures': self.failures, 'opened_at': self.opened_at, 'probe_at': self.probe_at}, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+    
+    def allow(self) -> bool:
+        with self._locked():
+            if self.opened_at is None:
+                return True
+            now = time.time()
+            if now - self.opened_at < CIRCUIT_COOLDOWN:
+                return False
+            if self.probe_at is not None and now - self.probe_at < CIRCUIT_COOLDOWN:
+                return False  # another caller's probe is in flight
+            self.probe_at = now
+            self._save()
+            return True
+    
+    def record_success(self):
+        with self._locked():
+            if self.failures or self.opened_at is not None:
+                self.failures, self.opened_at, self.probe_at = 0, None, None
+                self._save()
+    
+    def record_failure(self):
+        with self._locked():
+            self.failures += 1
+            if self.failures >= CIRCUIT_FAILURES:
+                # Also a failed probe: open for another cooldown
+                self.opened_at, self.probe_at = time.time(), None
+            self._save()
+
+
+CIRCUIT_BREAKER = CircuitBreaker()
+
+
+def feedback_cache_key(test_summaries: List[Dict], student_code: str) -> str:
+    """
+    Hash of everything the feedback depends on: normalized code, test summaries, models and prompt version.
+    The code is compared as written, not by its AST fingerprint: feedback quotes the student's names,
+    comments and strings, so it is only reused for the same student code.
+    """
+    
+    # Trailing whitespace, blank lines and line endings do not change the feedback
+    lines = [line.rstrip() for line in student_code.replace('\r\n', '\n').split('\n')]
+    code = '\n'.join(line for line in lines if line)
+    # Timings change on every run: timed tests are left out but for their name, other outputs have their
+    # decimals masked. The code is already in the key.
+    tests = [{'name': test['name']} if test['name'] in TIMED_TESTS
+             else dict(test, output=re.sub(r'\d+\.\d+', '#', test['output'])) for test in test_summaries]
+    models = {'model': MODEL, 'fast_model': FAST_MODEL, 'full_score_tier': FULL_SCORE_TIER}
+    key = json.dumps({'code': code, 'tests': tests, 'models': models, 'prompt_version': PROMPT_VERSION},
+                     sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _cache_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, key[:2], key + '.json')
+
+
+def cache_get(key: str):
+    """Stored feedback for a key, or None if there is none or it is older than CACHE_MAX_AGE_DAYS."""
+    
+    if not CACHE_DIR:
+        return None
+    path = _cache_path(key)
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_MAX_AGE_DAYS * 86400:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            feedback = json.load(f)
+        # Bump the modification time, so eviction drops the least recently used entries first
+        os.utime(path)
+        return feedback
+    except (OSError, ValueError):
+        return None
+
+
+def cache_put(key: str, feedback: Dict[str, Any]):
+    """Store feedback atomically, evicting old entries when needed. Failures only cost a future cache miss."""
+    
+    if not CACHE_DIR or not feedback:
+        return
+    path = _cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(feedback, f)
+        os.replace(tmp_path, path)
+        _count_cache_bytes(os.path.getsize(path))
+    except OSError as e:
+        print(f"AI Feedback Cache Error: {e}")
+
+
+# Size of the cache at this process's last eviction plus the entries it stored since, so that a put does not
+# list the whole cache. Entries stored by other processes are counted at the next eviction.
+_cache_size = None
+_cache_size_lock = threading.Lock()
+
+
+def _count_cache_bytes(added: int):
+    """Evict on the first put of the process, then whenever the entries stored since go over CACHE_MAX_MB."""
+    
+    global _cache_size
+    with _cache_size_lock:
+        if _cache_size is not None:
+            _cache_size += added
+            if _cache_size <= CACHE_MAX_MB * 1024 * 1024:
+                return
+        _cache_size = evict_cache()
+
+
+def evict_cache() -> int:
+    """
+    Delete entries older than CACHE_MAX_AGE_DAYS and, if the cache is over CACHE_MAX_MB, the least recently used
+    ones down to 90% of it, which leaves room for the puts that follow before the next eviction.
+    Only the key[:2] subdirectories hold entries: the circuit breaker's files next to them are kept.
+    Returns the size of the entries left.
+    """
+    
+    entries = []
+    try:
+        shards = [entry.path for entry in os.scandir(CACHE_DIR) if len(entry.name) == 2 and entry.is_dir()]
+    except OSError:
+        return 0
+    for shard in shards:
+        try:
+            files = list(os.scandir(shard))
+        except OSError:
+            continue
+        for file in files:
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file.path))
+    
+    now = time.time()
+    total_size = sum(size for _, size, _ in entries)
+    max_size = CACHE_MAX_MB * 1024 * 1024 * (0.9 if total_size > CACHE_MAX_MB * 1024 * 1024 else 1)
+    for mtime, size, path in sorted(entries):
+        expired = now - mtime > CACHE_MAX_AGE_DAYS * 86400
+        if not expired and total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError:
+            pass
+    return total_size
+
+
+def create_feedback_prompt(test_summaries: List[Dict], student_code: str) -> str:
+    """Create the prompt for GPT-4, within PROMPT_TOKEN_BUDGET tokens."""
+    
+    header = "Analyze this student's code submission and provide feedback based on the autograder results.\n\n"
+    
+    results_text = "AUTOGRADER RESULTS:\n"
     for test in test_summaries:
-        prompt += f"\n{test['name']}: {test['score']}/{test['max_score']} points"
-        if test['output']:
-            prompt += f"\nAutograder output: {test['output']}\n"
+        results_text += f"\n{test['name']}: {test['score']}/{test['max_score']} points"
+        # Only failing tests need their output; for the passing ones the score says it all
+        if test['output'] and is_failing(test):
+            results_text += f"\nAutograder output: {truncate_to_tokens(test['output'], MAX_TEST_OUTPUT_TOKENS)}\n"
     
-    prompt += """
+    instructions = """
 
 Provide feedback in the following JSON format:
 {
@@ -200,7 +862,131 @@ If they failed, explain the likely issue and how to fix it.
 If they succeeded, briefly note what they did well.
 Focus on the code implementation, not just restating the scores."""
     
-    return prompt
+    code_budget = PROMPT_TOKEN_BUDGET - count_tokens(header + results_text + instructions) - 20  # code fences
+    code = select_relevant_code(student_code, test_summaries, code_budget)
+    
+    return header + f"STUDENT CODE:\n```python\n{code}\n```\n\n" + results_text + instructions
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    encoding = _get_encoding()
+    if encoding is None:
+        return text if len(text) <= 4 * max_tokens else text[:4 * max_tokens] + '...'
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens]) + '...'
+
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.encoding_for_model(MODEL)
+        except KeyError:
+            _encoding = tiktoken.get_encoding('o200k_base')
+    return _encoding
+
+
+def is_failing(test: Dict) -> bool:
+    """Lost points: below max_score, or a deduction from a test worth 0 points."""
+    return test['score'] < test['max_score'] if test['max_score'] else test['score'] < 0
+
+
+def split_code_regions(student_code: str) -> List[Tuple[str, str]]:
+    """Split code into top-level (name, text) regions: each function or class with its decorators, named,
+    and the code between them, unnamed."""
+    
+    regions = []
+    decorators = ''
+    # A new region starts at every line that is not indented, blank or a comment
+    for block in re.split(r'\n(?=[^\s#])', student_code):
+        if block.startswith('@'):
+            decorators += block + '\n'
+            continue
+        match = re.match(r'(?:async\s+)?(?:def|class)\s+(\w+)', block)
+        name = match.group(1) if match else None
+        text, decorators = decorators + block, ''
+        if name is None and regions and regions[-1][0] is None:
+            regions[-1] = (None, regions[-1][1] + '\n' + text)
+        else:
+            regions.append((name, text))
+    if decorators:
+        regions.append((None, decorators))
+    return regions
+
+
+def rank_code_regions(regions: List[Tuple[str, str]], test_summaries: List[Dict]) -> List[float]:
+    """Relevance of each region to the failing tests."""
+    
+    scores = [0.0] * len(regions)
+    for test in test_summaries:
+        if not is_failing(test):
+            continue
+        output = test['output'] or ''
+        # The grader decorator reports the failing line of the submission as "in <function>:"
+        traceback_functions = set(re.findall(r'\bin (\w+):', output))
+        identifiers = set(re.findall(r'\w+', output))
+        # Test names are prose ("average pooling"); match their word stems against function names
+        stems = [word[:4] for word in re.findall(r'[a-z]+', test['name'].lower()) if len(word) >= 4]
+        for i, (name, _) in enumerate(regions):
+            if name is None:
+                continue
+            if name in traceback_functions:
+                scores[i] += 10
+            elif name in identifiers:
+                scores[i] += 5
+            if any(stem in name.lower() for stem in stems):
+                scores[i] += 2
+    
+    # Helpers called by a relevant function are half as relevant
+    called = [0.0] * len(regions)
+    for i, (name, _) in enumerate(regions):
+        if name is None:
+            continue
+        for j, (_, text) in enumerate(regions):
+            if j != i and scores[j] and re.search(rf'\b{re.escape(name)}\s*\(', text):
+                called[i] = max(called[i], scores[j] / 2)
+    return [score + helper for score, helper in zip(scores, called)]
+
+
+def select_relevant_code(student_code: str, test_summaries: List[Dict], max_tokens: int) -> str:
+    """The most relevant regions of the code that fit in max_tokens, in their original order."""
+    
+    if count_tokens(student_code) <= max_tokens:
+        return student_code
+    
+    regions = split_code_regions(student_code)
+    scores = rank_code_regions(regions, test_summaries)
+    max_tokens -= 40  # room for the note listing what was omitted
+    order = sorted(range(len(regions)), key=lambda i: -scores[i])  # stable: ties keep the code order
+    
+    selected, used = {}, 0
+    for i in order:
+        tokens = count_tokens(regions[i][1]) + 1
+        if used + tokens <= max_tokens:
+            selected[i] = regions[i][1]
+            used += tokens
+        elif not selected and max_tokens > 0:
+            # Even the most relevant region does not fit: keep its beginning
+            selected[i] = truncate_to_tokens(regions[i][1], max_tokens - 10)
+            used = max_tokens
+    
+    omitted = [name for i, (name, _) in enumerate(regions) if i not in selected and name]
+    code = '\n'.join(selected[i] for i in sorted(selected))
+    if len(omitted) > 10:
+        omitted = omitted[:10] + [f'and {len(omitted) - 10} more']
+    if omitted:
+        code += f"\n\n# [Omitted for brevity: {', '.join(omitted)}]"
+    return code
 
 
 def parse_feedback_response(feedback_text: str) -> Dict[str, Any]:
@@ -236,9 +1022,39 @@ def parse_feedback_response(feedback_text: str) -> Dict[str, Any]:
     return feedback if feedback else {'overall': 'Unable to generate detailed feedback.', 'tests': {}}
 
 
+def parse_partial_feedback(feedback_text: str) -> Dict[str, Any]:
+    """Recover the complete "key": "value" pairs of a JSON response that was cut off mid-generation."""
+    
+    feedback = {'tests': {}}
+    json_string = r'"((?:[^"\\]|\\.)*)"'
+    for match in re.finditer(json_string + r'\s*:\s*' + json_string, feedback_text):
+        try:
+            key, value = (json.loads(f'"{group}"') for group in match.groups())
+        except ValueError:
+            continue
+        if key == 'overall':
+            feedback['overall'] = value
+        else:
+            feedback['tests'][key] = value
+    return feedback
+
+
+def match_test_feedback(test_name: str, test_feedback: Dict[str, str]):
+    """The feedback whose key matches the test name (case-insensitive, either containing the other), or None."""
+    
+    for feedback_key, feedback_value in test_feedback.items():
+        if test_name.lower() in feedback_key.lower() or feedback_key.lower() in test_name.lower():
+            return feedback_value
+    return None
+
+
 def add_feedback_to_results(results: dict, feedback: Dict[str, Any]) -> dict:
     """Add AI feedback to the results dictionary by appending to output fields."""
     
+    # Which model tier produced the feedback
+    if 'routing' in feedback:
+        results['ai_feedback'] = feedback['routing']
+    
     # Add overall feedback to main output
     if 'overall' in feedback:
         current_output = results.get('output', '')
@@ -248,13 +1064,8 @@ def add_feedback_to_results(results: dict, feedback: Dict[str, Any]) -> dict:
     test_feedback = feedback.get('tests', {})
     for test in results.get('tests', []):
         test_name = test.get('name', '')
-        feedback_to_add = None
-        
         # Try to find matching feedback (case-insensitive)
-        for feedback_key, feedback_value in test_feedback.items():
-            if test_name.lower() in feedback_key.lower() or feedback_key.lower() in test_name.lower():
-                feedback_to_add = feedback_value
-                break
+        feedback_to_add = match_test_feedback(test_name, test_feedback)
         
         # If no specific feedback found, generate generic based on score
         if not feedback_to_add:
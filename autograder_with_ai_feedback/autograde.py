@@ -1,12 +1,24 @@
+import time
+START_TIME = time.time()
+
 import os
+import json
+import hashlib
+import functools
 import argparse
-from utils import make_py, save_results, grader
-import torch
-import torch.nn.functional as F
+import utils
+from utils import make_py, load_submission, save_results, grader, run_tests, source_hash
+from fixtures import FixtureStore, fixture_key
+from fingerprint import ast_fingerprint, ResultStore
 import numpy as np
 from typing import Tuple, Union
-import re
-import time
+import statistics
+import types
+from numpy.lib.stride_tricks import sliding_window_view
+
+# torch is not imported here: it is only needed for reference outputs missing from the fixtures
+IMPORT_TIME = time.time() - START_TIME
+TORCH_IMPORT_TIME = None
 
 IMPORTS = """
 import numpy as np
@@ -30,70 +42,219 @@ def to_tuple(
     return (x, x)
 
 
+# Compute the reference outputs missing from the fixtures up front, all seeds of a config in one call
+BATCH_REFERENCES = True
+SEEDS = range(3)
+# Set while prepare_references() runs: test() and test_pool() record their configs here instead of testing
+PLANNED_CONFIGS = None
+
+# Directory of per-test results, shared across runs; None disables reuse. A test is only run again when
+# the submission, the test's code or its configuration changed. Passed tests are also shared between
+# submissions with the same AST fingerprint (see fingerprint.py); failed ones are not, as their output
+# quotes the submission's source.
+REUSE_DIR = None
+
+FIXTURES = FixtureStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+
+
+def import_torch():
+    """Import torch on first use and remember how long that took."""
+    global TORCH_IMPORT_TIME
+    start_time = time.time()
+    import torch
+    import torch.nn.functional as F
+    if TORCH_IMPORT_TIME is None:
+        TORCH_IMPORT_TIME = time.time() - start_time
+    return torch, F
+
+
+def reference_conv2d(Input, Kernel, Bias, stride, padding, dilation, groups):
+    torch, F = import_torch()
+    # A dummy dimension as the batch dimension
+    Input_torch = torch.tensor(Input[None, ...])
+    Kernel_torch = torch.tensor(Kernel)
+    Bias_torch = torch.tensor(Bias)
+    return F.conv2d(Input_torch, Kernel_torch, Bias_torch, stride=stride, padding=padding, dilation=dilation, groups=groups)[0].numpy()
+
+
+def reference_conv2d_batch(Inputs, Kernels, Biases, stride, padding, dilation, groups):
+    """reference_conv2d for a stack of seeds in a single call. Each seed has its own kernel, so the
+    seeds are laid side by side along the channels and kept apart as extra groups."""
+    torch, F = import_torch()
+    num_seeds, c_in, X_in, Y_in = Inputs.shape
+    c_out = Kernels.shape[1]
+    Input_torch = torch.tensor(Inputs.reshape(1, num_seeds * c_in, X_in, Y_in))
+    Kernel_torch = torch.tensor(Kernels.reshape(num_seeds * c_out, *Kernels.shape[2:]))
+    Bias_torch = torch.tensor(Biases.reshape(num_seeds * c_out))
+    Output = F.conv2d(Input_torch, Kernel_torch, Bias_torch, stride=stride, padding=padding, dilation=dilation,
+                      groups=num_seeds * groups)[0]
+    return Output.reshape(num_seeds, c_out, *Output.shape[1:]).numpy()
+
+
+def reference_avg_pool2d(Input, kernel_size, stride, padding):
+    torch, F = import_torch()
+    # A dummy dimension as the batch dimension
+    Input_torch = torch.tensor(Input[None, ...])
+    return F.avg_pool2d(Input_torch, kernel_size, stride=stride, padding=padding)[0].numpy()
+
+
+def reference_avg_pool2d_batch(Inputs, kernel_size, stride, padding):
+    """reference_avg_pool2d for a stack of seeds, using the seeds as the batch dimension."""
+    torch, F = import_torch()
+    return F.avg_pool2d(torch.tensor(Inputs), kernel_size, stride=stride, padding=padding).numpy()
+
+
+def assert_close(actual, expected, atol=1e-3, rtol=1e-3):
+    """NumPy version of torch.testing.assert_close, so comparing against a fixture needs no torch."""
+    if actual.shape != expected.shape:
+        raise AssertionError(f"The values for attribute 'shape' do not match: {actual.shape} != {expected.shape}.")
+    close = np.isclose(actual, expected, atol=atol, rtol=rtol)
+    if close.all():
+        return
+    abs_diff = np.abs(actual.astype(np.float64) - expected)
+    rel_diff = abs_diff / np.maximum(np.abs(expected), np.finfo(np.float32).tiny)
+    abs_index = np.unravel_index(np.nanargmax(abs_diff) if not np.isnan(abs_diff).all() else 0, abs_diff.shape)
+    rel_index = np.unravel_index(np.nanargmax(rel_diff) if not np.isnan(rel_diff).all() else 0, rel_diff.shape)
+    mismatched = close.size - close.sum()
+    raise AssertionError(
+        f"Tensor-likes are not close!\n\n"
+        f"Mismatched elements: {mismatched} / {close.size} ({100 * mismatched / close.size:.1f}%)\n"
+        f"Greatest absolute difference: {abs_diff[abs_index]} at index {tuple(int(i) for i in abs_index)} "
+        f"(up to {atol} allowed)\n"
+        f"Greatest relative difference: {rel_diff[rel_index]} at index {tuple(int(i) for i in rel_index)} "
+        f"(up to {rtol} allowed)"
+    )
+
+
+def conv2d_inputs(config, seed):
+    # Same numbers as np.random.seed(seed), without touching the global state shared by threads
+    rng = np.random.RandomState(seed)
+    Input = rng.randn(config['c_in'], config['X_in'], config['Y_in']).astype(np.float32)
+    Kernel = rng.randn(config['c_out'], config['c_in']//config['groups'], config['X_k'], config['Y_k']).astype(np.float32)
+    Bias = rng.randn(config['c_out']).astype(np.float32)
+    return {'Input': Input, 'Kernel': Kernel, 'Bias': Bias}
+
+
+def conv2d_cases(config, seeds):
+    """
+    Random input, kernel and bias for each seed, plus the PyTorch output. Read from the fixtures if stored;
+    the missing outputs are computed together in one batched call (one call per seed without BATCH_REFERENCES).
+    """
+    keys = [fixture_key('conv2d', config, seed) for seed in seeds]
+    missing = [(key, seed) for key, seed in zip(keys, seeds) if FIXTURES.get(key) is None]
+    if missing:
+        cases = [conv2d_inputs(config, seed) for _, seed in missing]
+        params = (config['stride'], config['padding'], config['dilation'], config['groups'])
+        if BATCH_REFERENCES:
+            Outputs = reference_conv2d_batch(np.stack([case['Input'] for case in cases]),
+                                             np.stack([case['Kernel'] for case in cases]),
+                                             np.stack([case['Bias'] for case in cases]), *params)
+        else:
+            Outputs = [reference_conv2d(case['Input'], case['Kernel'], case['Bias'], *params) for case in cases]
+        for (key, _), case, Output in zip(missing, cases, Outputs):
+            case['Output'] = Output
+            FIXTURES.add(key, case)
+    return [FIXTURES.get(key) for key in keys]
+
+
+def pool_inputs(config, seed):
+    rng = np.random.RandomState(seed)
+    return {'Input': rng.randn(config['c'], config['X_in'], config['Y_in']).astype(np.float32)}
+
+
+def pool_cases(config, seeds):
+    """Random input for each seed, plus the PyTorch output. Read from the fixtures if stored, like conv2d_cases."""
+    keys = [fixture_key('avg_pool2d', config, seed) for seed in seeds]
+    missing = [(key, seed) for key, seed in zip(keys, seeds) if FIXTURES.get(key) is None]
+    if missing:
+        cases = [pool_inputs(config, seed) for _, seed in missing]
+        params = ((config['X_k'], config['Y_k']), config['stride'], config['padding'])
+        if BATCH_REFERENCES:
+            Outputs = reference_avg_pool2d_batch(np.stack([case['Input'] for case in cases]), *params)
+        else:
+            Outputs = [reference_avg_pool2d(case['Input'], *params) for case in cases]
+        for (key, _), case, Output in zip(missing, cases, Outputs):
+            case['Output'] = Output
+            FIXTURES.add(key, case)
+    return [FIXTURES.get(key) for key in keys]
+
+
 def test(conv2d, config):
 
-    c_in = config['c_in']
-    c_out = config['c_out']
-    X_in = config['X_in']
-    Y_in = config['Y_in']
-    X_k = config['X_k']
-    Y_k = config['Y_k']
+    if PLANNED_CONFIGS is not None:
+        PLANNED_CONFIGS.append(('conv2d', dict(config)))
+        return
+
     stride = config['stride']
     padding = config['padding']
     dilation = config['dilation']
     groups = config['groups']
 
-    # Test the function with 5 random inputs
-    for i in range(3):
+    # Test the function with 3 random inputs
+    for case in conv2d_cases(config, SEEDS):
 
-        np.random.seed(i)
-        # Random input, kernel and bias
-        Input = np.random.randn(c_in, X_in, Y_in).astype(np.float32)
-        Kernel = np.random.randn(c_out, c_in//groups, X_k, Y_k).astype(np.float32)
-        Bias = np.random.randn(c_out).astype(np.float32)
+        # Copies, so a submission that writes into its inputs cannot corrupt the fixtures
+        Input, Kernel, Bias = np.array(case['Input']), np.array(case['Kernel']), np.array(case['Bias'])
 
         # Calculate the output using your function
         your_output = conv2d(Input, Kernel, Bias, stride, padding, dilation, groups).astype(np.float32)
 
-        # Calculate the output using PyTorch
-        Input_torch = torch.tensor(Input[None, ...]) # A dummy dimension as the batch dimension
-        Kernel_torch = torch.tensor(Kernel)
-        Bias_torch = torch.tensor(Bias)
-        torcX_output = F.conv2d(Input_torch, Kernel_torch, Bias_torch, stride=stride, padding=padding, dilation=dilation, groups=groups)[0]
-
-        # Calculate the relative L2 norm error
+        # Compare against the PyTorch output
         # If your output is of the wrong shape, this will raise an error
-        torch.testing.assert_close(torch.as_tensor(your_output), torcX_output, atol=1e-3, rtol=1e-3)
+        assert_close(your_output, case['Output'], atol=1e-3, rtol=1e-3)
 
 
 def test_pool(avg_pool2d, config):
 
-    c = config['c']
-    X_in = config['X_in']
-    Y_in = config['Y_in']
+    if PLANNED_CONFIGS is not None:
+        PLANNED_CONFIGS.append(('avg_pool2d', dict(config)))
+        return
+
     X_k = config['X_k']
     Y_k = config['Y_k']
     stride = config['stride']
     padding = config['padding']
 
-    # Test the function with 5 random inputs
-    for i in range(3):
-
-        np.random.seed(i)
+    # Test the function with 3 random inputs
+    for case in pool_cases(config, SEEDS):
 
-        # Random input and kernel
-        Input = np.random.randn(c, X_in, Y_in).astype(np.float32)
+        Input = np.array(case['Input'])
 
         # Calculate the output using your function
         your_output = avg_pool2d(Input, (X_k, Y_k), stride, padding).astype(np.float32)
 
-        # Calculate the output using PyTorch
-        Input_torch = torch.tensor(Input[None, ...]) # A dummy dimension as the batch dimension
-        torch_output = F.avg_pool2d(Input_torch, (X_k, Y_k), stride=stride, padding=padding)[0]
-
-        # Calculate the relative L2 norm error
+        # Compare against the PyTorch output
         # If your output is of the wrong shape, this will raise an error
-        torch.testing.assert_close(torch.as_tensor(your_output), torch_output, atol=1e-3, rtol=1e-3)
+        assert_close(your_output, case['Output'], atol=1e-3, rtol=1e-3)
+
+
+def plan_configs(tests):
+    """The (op, config) pairs the tests check, recorded by running them in planning mode."""
+    global PLANNED_CONFIGS
+    PLANNED_CONFIGS = []
+    try:
+        planner = types.SimpleNamespace(conv2d=None, avg_pool2d=None)
+        for test_func in tests:
+            test_func.__wrapped__(planner)
+        return PLANNED_CONFIGS
+    finally:
+        PLANNED_CONFIGS = None
+
+
+def prepare_references(tests):
+    """
+    Compute every reference output the tests will compare against before running them.
+    The tests are first run in a planning mode that only records their configs; identical configs
+    are merged and each remaining config gets all its seeds in one batched reference call.
+    Nothing is computed (and torch is not imported) when the fixtures already hold every case.
+    Returns the number of distinct configs.
+    """
+    groups = {}
+    for op, config in plan_configs(tests):
+        groups.setdefault((op, json.dumps(config, sort_keys=True)), config)
+    for (op, _), config in groups.items():
+        (conv2d_cases if op == 'conv2d' else pool_cases)(config, SEEDS)
+    return len(groups)
 
 
 ####################################################################################################
@@ -213,29 +374,252 @@ def test_avg_pool2d(submission):
     test_pool(submission.avg_pool2d, config)
     return {'score': 10}
 
+TESTS = [
+    test_simple_convolution,
+    test_padded_convolution,
+    test_strided_convolution,
+    test_dilated_convolution,
+    test_grouped_convolution,
+    test_avg_pool2d,
+]
+
 ####################################################################################################
 
-@grader('Autograding')
-def Grade(autograder_dir):
-    start_time = time.time()
-    source_script = make_py(autograder_dir, IMPORTS, solution=False)
-    submission = __import__('submission')
-    
-    # use regex to count the number of for loops in the source_sript
-    # the pattern is for something in something
+# Performance test: time the submission against a typical acceptable solution on larger inputs.
+# Timings vary between runs and machines, so it is off unless enabled (--perf). In 'deduct' mode the test
+# is worth 0 points and takes off up to PERF_POINTS, like the for loop check; in 'award' mode it is worth
+# PERF_POINTS. It is always run again, never reused from REUSE_DIR.
+PERF_MODES = ('off', 'deduct', 'award')
+PERF_MODE = 'off'
+PERF_POINTS = 10
+PERF_FULL_RATIO = 20.0    # up to this many times slower than the baseline: full credit
+PERF_ZERO_RATIO = 400.0   # this many times slower or more: no credit (log-linear in between)
+PERF_WARMUP = 1
+PERF_REPEATS = 5
+PERF_TIME_CAP = 10.0      # seconds spent timing each function; the whole test is killed after 3x this
+
+PERF_CONV2D_CONFIG = {
+    'c_in': 8,
+    'c_out': 16,
+    'X_in': 32,
+    'Y_in': 32,
+    'X_k': 3,
+    'Y_k': 3,
+    'stride': 1,
+    'padding': 1,
+    'dilation': 1,
+    'groups': 1,
+}
+PERF_POOL_CONFIG = {
+    'c': 16,
+    'X_in': 64,
+    'Y_in': 64,
+    'X_k': 2,
+    'Y_k': 2,
+    'stride': 2,
+    'padding': 0,
+}
+
+
+def numpy_conv2d(Input, Kernel, Bias, stride=1, padding=0, dilation=1, groups=1):
+    """Vectorized NumPy convolution, the speed a good submission can reach."""
+    s_x, s_y = to_tuple(stride)
+    p_x, p_y = to_tuple(padding)
+    d_x, d_y = to_tuple(dilation)
+    c_out, c_group, X_k, Y_k = Kernel.shape
+    Input = np.pad(Input, ((0, 0), (p_x, p_x), (p_y, p_y)))
+    # (c_in, X_out, Y_out, X_k, Y_k)
+    windows = sliding_window_view(Input, ((X_k - 1) * d_x + 1, (Y_k - 1) * d_y + 1), axis=(1, 2))[:, ::s_x, ::s_y, ::d_x, ::d_y]
+    X_out, Y_out = windows.shape[1:3]
+    windows = windows.reshape(groups, c_group, X_out, Y_out, X_k, Y_k)
+    Kernel = Kernel.reshape(groups, c_out // groups, c_group, X_k, Y_k)
+    output = np.einsum('gcxyij,gocij->goxy', windows, Kernel, optimize=True).reshape(c_out, X_out, Y_out)
+    return output + Bias[:, None, None]
+
+
+def baseline_conv2d(Input, Kernel, Bias, stride=1, padding=0, dilation=1, groups=1):
+    """
+    The convolution a typical acceptable submission writes: two loops over the output positions, each
+    window multiplied with every kernel at once. The timing baseline, so ordinary solutions get full credit
+    (vectorized ones are up to about 20x faster, a third loop over the output channels about 15x slower).
+    """
+    s_x, s_y = to_tuple(stride)
+    p_x, p_y = to_tuple(padding)
+    d_x, d_y = to_tuple(dilation)
+    c_out, c_group, X_k, Y_k = Kernel.shape
+    c_in, X_in, Y_in = Input.shape
+    Input = np.pad(Input, ((0, 0), (p_x, p_x), (p_y, p_y)))
+    X_out = (X_in + 2 * p_x - d_x * (X_k - 1) - 1) // s_x + 1
+    Y_out = (Y_in + 2 * p_y - d_y * (Y_k - 1) - 1) // s_y + 1
+    Kernel = Kernel.reshape(groups, c_out // groups, c_group, X_k, Y_k)
+    output = np.zeros((c_out, X_out, Y_out), dtype=Input.dtype)
+    for x in range(X_out):
+        for y in range(Y_out):
+            window = Input[:, x * s_x:x * s_x + (X_k - 1) * d_x + 1:d_x, y * s_y:y * s_y + (Y_k - 1) * d_y + 1:d_y]
+            output[:, x, y] = np.einsum('gcij,gocij->go', window.reshape(groups, c_group, X_k, Y_k), Kernel).reshape(c_out)
+    return output + Bias[:, None, None]
+
+
+def numpy_avg_pool2d(Input, kernel_size, stride=None, padding=0):
+    """Vectorized NumPy average pooling (zero padding counted, like F.avg_pool2d). Also the timing baseline:
+    with the loops spent on the convolution, this is what a typical acceptable submission writes."""
+    X_k, Y_k = to_tuple(kernel_size)
+    s_x, s_y = to_tuple(kernel_size if stride is None else stride)
+    p_x, p_y = to_tuple(padding)
+    Input = np.pad(Input, ((0, 0), (p_x, p_x), (p_y, p_y)))
+    return sliding_window_view(Input, (X_k, Y_k), axis=(1, 2))[:, ::s_x, ::s_y].mean(axis=(-2, -1))
+
+
+def benchmark(func, *args):
+    """Median runtime of func(*args) after warmup; inf if the first call alone exceeds PERF_TIME_CAP."""
+    start_time = time.perf_counter()
+    for _ in range(PERF_WARMUP):
+        func(*args)
+    warmup_time = time.perf_counter() - start_time
+    if warmup_time > PERF_TIME_CAP:
+        return float('inf')
+    # Fit as many repeats as the remaining budget allows, at least one
+    per_call = warmup_time / max(PERF_WARMUP, 1)
+    repeats = max(1, min(PERF_REPEATS, int((PERF_TIME_CAP - warmup_time) / max(per_call, 1e-9))))
+    times = []
+    for _ in range(repeats):
+        call_start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - call_start)
+    return statistics.median(times)
+
+
+def perf_score(ratio):
+    """Map a runtime ratio (submission / baseline) to a score in the configured mode, in whole points."""
+    if ratio <= PERF_FULL_RATIO:
+        credit = 1.0
+    elif ratio >= PERF_ZERO_RATIO:
+        credit = 0.0
+    else:
+        credit = 1.0 - np.log(ratio / PERF_FULL_RATIO) / np.log(PERF_ZERO_RATIO / PERF_FULL_RATIO)
+    score = PERF_POINTS * credit if PERF_MODE == 'award' else -PERF_POINTS * (1.0 - credit)
+    # Rounded so that run-to-run noise rarely changes the score
+    return float(round(score)) or 0.0  # no -0.0 in the results
+
+
+# max_score is set by grade_tests, as PERF_MODE can be changed after import
+@grader('benchmarking', name='performance', sandbox=True, timeout=3 * PERF_TIME_CAP)
+def test_performance(submission):
+    conv = PERF_CONV2D_CONFIG
+    pool = PERF_POOL_CONFIG
+    rng = np.random.RandomState(0)
+    Input = rng.randn(conv['c_in'], conv['X_in'], conv['Y_in']).astype(np.float32)
+    Kernel = rng.randn(conv['c_out'], conv['c_in']//conv['groups'], conv['X_k'], conv['Y_k']).astype(np.float32)
+    Bias = rng.randn(conv['c_out']).astype(np.float32)
+    conv_args = (Input, Kernel, Bias, conv['stride'], conv['padding'], conv['dilation'], conv['groups'])
+    Pool_input = rng.randn(pool['c'], pool['X_in'], pool['Y_in']).astype(np.float32)
+    pool_args = (Pool_input, (pool['X_k'], pool['Y_k']), pool['stride'], pool['padding'])
+
+    # Only correct results count; wrong ones are already penalized by the tests above
+    assert_close(submission.conv2d(*conv_args).astype(np.float32), numpy_conv2d(*conv_args).astype(np.float32))
+    assert_close(submission.avg_pool2d(*pool_args).astype(np.float32), numpy_avg_pool2d(*pool_args).astype(np.float32))
+
+    output = []
+    ratios = []
+    for func_name, baseline, args in [('conv2d', baseline_conv2d, conv_args), ('avg_pool2d', numpy_avg_pool2d, pool_args)]:
+        your_time = benchmark(getattr(submission, func_name), *args)
+        baseline_time = benchmark(baseline, *args)
+        ratios.append(your_time / baseline_time)
+        if your_time == float('inf'):
+            output.append(f'{func_name}: over the {PERF_TIME_CAP:.0f} s time cap')
+        else:
+            output.append(f'{func_name}: {your_time * 1000:.2f} ms vs baseline {baseline_time * 1000:.2f} ms ({ratios[-1]:.1f}x)')
+    ratio = max(ratios)
+    output.append(f'Full credit up to {PERF_FULL_RATIO:.0f}x the baseline time, none from {PERF_ZERO_RATIO:.0f}x')
+    return {'score': perf_score(ratio), 'output': '\n'.join(output)}
+
+####################################################################################################
+
+@functools.lru_cache(maxsize=None)
+def test_source_hash(test_func):
+    return source_hash(test_func)
+
 
-    # count the number of for loops in the source_script
-    num_for_loops = len(re.findall(r"\s*for\s+\w+\s+in\s+", source_script))
+def test_result_key(submission_hash, test_func):
+    """
+    Key of a test's stored result: the submission, the test's code (see utils.source_hash) and its
+    configuration, i.e. the configs it checks, the seeds, the limits it runs under and the NumPy version.
+    """
+    config = {
+        'configs': plan_configs([test_func]) if test_func in TESTS else [],
+        'seeds': list(SEEDS),
+        'limits': [utils.SANDBOX, utils.TIMEOUT, utils.CPU_LIMIT, utils.MEMORY_LIMIT],
+        'numpy': np.__version__,
+    }
+    config_hash = hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+    key = f'{submission_hash}\n{test_source_hash(test_func)}\n{config_hash}'
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def grade_tests(autograder_dir, artifact, phases, store=None, fingerprint=None, reuse=None):
+    """
+    Import the submission made by make_py and run every test on it, timing each phase into `phases`.
+    With a store, tests whose result is stored for this exact submission (its source_hash), code and
+    configuration are not run again, nor are tests another submission with the same fingerprint passed.
+    If a dict is passed as reuse, it is filled with the number of reused and graded tests.
+    The performance test (unless PERF_MODE is 'off') is always run: its timings differ between runs.
+    """
+    stored, keys, shared_keys = {}, {}, {}
+    if store is not None:
+        for test_func in TESTS:
+            keys[test_func] = test_result_key(artifact.source_hash, test_func)
+            result = store.get(keys[test_func])
+            if result is None and fingerprint is not None:
+                shared_keys[test_func] = test_result_key(fingerprint, test_func)
+                result = store.get(shared_keys[test_func])
+            if result is not None:
+                stored[test_func] = result
+    pending = [test_func for test_func in TESTS if test_func not in stored]
+    perf = PERF_MODE != 'off'
+
+    if pending or perf:
+        phase_start = time.time()
+        submission = load_submission(autograder_dir, artifact.script)
+        phases['import_submission'] = round(time.time() - phase_start, 4)
+    
+    # number of `for something in something` loops, counted by make_py while cleaning the cells
+    num_for_loops = artifact.num_for_loops
     for_penalty = (num_for_loops-2)*5
 
-    results = {}
-    results['tests']= [
-        test_simple_convolution(submission),
-        test_padded_convolution(submission),
-        test_strided_convolution(submission),
-        test_dilated_convolution(submission),
-        test_grouped_convolution(submission),
-        test_avg_pool2d(submission),
+    if BATCH_REFERENCES and pending:
+        # Computed before the tests so that sandboxed tests inherit them instead of each computing its own
+        phase_start = time.time()
+        prepare_references(pending)
+        phases['references'] = round(time.time() - phase_start, 4)
+
+    phase_start = time.time()
+    graded = dict(zip(pending, run_tests(pending, submission))) if pending else {}
+    phases['tests'] = round(time.time() - phase_start, 4)
+    phases['each_test'] = {test['name']: test['profile']['wall_time'] for test in graded.values()}
+
+    performance = []
+    if perf:
+        # Timed alone, after the other tests, so the measurements are not skewed by concurrency
+        phase_start = time.time()
+        result = test_performance(submission)
+        if result.get('sandbox', {}).get('status') in ('timeout', 'cpu_limit'):
+            result['score'] = perf_score(float('inf'))
+        result['max_score'] = PERF_POINTS if PERF_MODE == 'award' else 0
+        phases['performance'] = round(time.time() - phase_start, 4)
+        performance.append(result)
+
+    if store is not None:
+        for test_func, result in graded.items():
+            # Timeouts and crashes can depend on the machine's load, so only clean runs are stored
+            if result.get('sandbox', {}).get('status', 'ok') == 'ok':
+                store.put(keys[test_func], result)
+                # A result with an output (a failure's traceback) quotes this submission's lines: never shown to another
+                if test_func in shared_keys and 'output' not in result:
+                    store.put(shared_keys[test_func], result)
+    if reuse is not None:
+        reuse.update(reused=len(stored), graded=len(graded))
+
+    return [stored.get(test_func) or graded[test_func] for test_func in TESTS] + performance + [
         {
             'name': 'for loops',
             'score': -for_penalty,
@@ -243,16 +627,104 @@ def Grade(autograder_dir):
             'output': f'Number of additional for loops: {num_for_loops-2}',
         }
     ]
+
+
+@grader('Autograding', sandbox=False)
+def Grade(autograder_dir, artifact=None):
+    """Grade the submission, parsed by make_py unless its artifact is passed."""
+    start_time = time.time()
+    phases = {}
+    if artifact is None:
+        artifact = make_py(autograder_dir, IMPORTS, solution=False)
+        phases['make_py'] = round(time.time() - start_time, 4)
+    phase_start = time.time()
+    results = {'fingerprint': ast_fingerprint(artifact.script)}
+    phases['fingerprint'] = round(time.time() - phase_start, 4)
+
+    if REUSE_DIR:
+        reuse = {}
+        results['tests'] = grade_tests(autograder_dir, artifact, phases, ResultStore(REUSE_DIR),
+                                       results['fingerprint'], reuse)
+        reuse['hit_rate'] = round(reuse['reused'] / (reuse['reused'] + reuse['graded']), 3)
+        results['reuse'] = reuse
+    else:
+        results['tests'] = grade_tests(autograder_dir, artifact, phases)
+
     end_time = time.time()
     results['output'] = f'autograder runtime: {end_time - start_time:.2f} seconds'
     results['execution_time'] = round(end_time - start_time)
+    results['startup'] = {
+        'import_time': round(IMPORT_TIME, 3),
+        'torch_import_time': round(TORCH_IMPORT_TIME or 0.0, 3),
+        'grading_time': round(end_time - start_time - (TORCH_IMPORT_TIME or 0.0), 3),
+    }
+    # save_results adds the 'ai_feedback' phase
+    results['phases'] = phases
     return results
 
 
+def grade_and_save(autograder_dir):
+    """
+    Grade the submission and write results/results.json. The notebook is parsed once, here, and its
+    artifact handed to both Grade and save_results (for the AI feedback).
+    """
+    start_time = time.time()
+    try:
+        artifact = make_py(autograder_dir, IMPORTS, solution=False)
+    except Exception:
+        artifact = None  # Grade runs make_py again and reports the error as the result
+    make_py_time = round(time.time() - start_time, 4)
+    results = Grade(autograder_dir, artifact)
+    if artifact is not None and 'phases' in results:
+        results['phases'] = dict(make_py=make_py_time, **results['phases'])
+    save_results(results, autograder_dir, artifact)
+    return results
+
+
+def build_fixtures():
+    """Run every test against the PyTorch reference and store the inputs and outputs it sees."""
+    FIXTURES.clear()
+    if BATCH_REFERENCES:
+        prepare_references(TESTS)
+    reference = types.SimpleNamespace(conv2d=reference_conv2d, avg_pool2d=reference_avg_pool2d)
+    for test_func in TESTS:
+        result = test_func(reference)
+        assert result['score'] == result['max_score'], f"Reference failed {result['name']}: {result.get('output')}"
+    num_cases = FIXTURES.save()
+    print(f'Fixtures: stored {num_cases} cases in {FIXTURES.path}.npy')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('autograder_dir', type=str)
+    parser.add_argument('autograder_dir', type=str, nargs='?')
+    parser.add_argument('--build-fixtures', action='store_true',
+                        help='precompute the reference inputs/outputs into fixtures.npy and exit')
+    parser.add_argument('--sandbox', action='store_true',
+                        help='run each test in a child process with time and memory limits')
+    parser.add_argument('--timeout', type=float, default=utils.TIMEOUT, help='wall-clock seconds per test')
+    parser.add_argument('--cpu-limit', type=int, default=utils.CPU_LIMIT, help='CPU seconds per test')
+    parser.add_argument('--memory-limit', type=int, default=utils.MEMORY_LIMIT, help='MB per test')
+    parser.add_argument('--parallel', choices=['thread', 'process'], default=utils.PARALLEL,
+                        help='run the tests concurrently in threads or in forked processes')
+    parser.add_argument('--workers', type=int, default=utils.WORKERS, help='number of tests run at once')
+    # A pair of flags rather than argparse.BooleanOptionalAction, which needs Python 3.9
+    parser.add_argument('--batch-references', dest='batch_references', action='store_true', default=BATCH_REFERENCES,
+                        help='compute missing reference outputs up front, batched across seeds')
+    parser.add_argument('--no-batch-references', dest='batch_references', action='store_false',
+                        help='compute each reference output when its test needs it')
+    parser.add_argument('--reuse-dir', type=str, default=REUSE_DIR,
+                        help='store per-test results here and only rerun tests whose submission, code or config changed')
+    parser.add_argument('--perf', choices=PERF_MODES, default=PERF_MODE,
+                        help='performance test: off, deduct up to PERF_POINTS, or award PERF_POINTS')
     args = parser.parse_args()
+    BATCH_REFERENCES, REUSE_DIR, PERF_MODE = args.batch_references, args.reuse_dir, args.perf
+    utils.SANDBOX = args.sandbox
+    utils.PARALLEL, utils.WORKERS = args.parallel, args.workers
+    utils.TIMEOUT, utils.CPU_LIMIT, utils.MEMORY_LIMIT = args.timeout, args.cpu_limit, args.memory_limit
+    if args.build_fixtures:
+        build_fixtures()
+        raise SystemExit(0)
+    if args.autograder_dir is None:
+        parser.error('autograder_dir is required')
     os.makedirs(args.autograder_dir+'/results', exist_ok=True)
-    results = Grade(args.autograder_dir)
-    save_results(results, args.autograder_dir)
+    grade_and_save(args.autograder_dir)
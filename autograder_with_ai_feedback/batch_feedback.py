@@ -0,0 +1,335 @@
+"""
+Add AI feedback to a whole cohort through a batch API, after grading.
+
+Batch jobs are much cheaper than one request per submission and are not limited by the
+Gradescope time limit, so they suit end-of-term regrades. Works on the layout written by
+batch_grade.py:
+
+    submissions/
+        student_a/results/results.json
+        student_b/results/results.json
+        feedback_batch.jsonl          the requests, one per cluster of submissions that failed the same way
+        feedback_clusters.json        the clusters: members, error signature and size
+        feedback_batch.json           the submitted batch, so an interrupted run can resume polling
+        feedback_output.jsonl         the responses, merged back into each results.json
+
+The endpoint speaks the OpenAI Files + Batches API; point --base-url at any compatible
+service (or a local stand-in) to use something else.
+
+Usage:
+    python batch_feedback.py submissions/
+    python batch_feedback.py submissions/ --prepare-only
+    python batch_feedback.py submissions/ --merge feedback_output.jsonl
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import requests
+
+import ai_feedback
+from ai_feedback import (get_student_code, summarize_tests, create_feedback_prompt, build_chat_request,
+                         feedback_cache_key, cache_get, cache_put, parse_feedback_response, add_feedback_to_results,
+                         choose_tier, tier_model, is_failing, request_cost, total_metrics, FULL_SCORE_MESSAGE)
+from batch_grade import find_submissions
+
+CHAT_COMPLETIONS = '/v1/chat/completions'
+FINISHED = ('completed', 'failed', 'expired', 'cancelled')
+
+# Submissions whose failures are at least this similar (Jaccard over their error signatures) share one
+# request, whose feedback is fanned out to all of them. 1.0 only groups identical signatures.
+CLUSTER_THRESHOLD = 0.9
+
+# Batch requests are billed at this fraction of the normal price
+BATCH_PRICE_FACTOR = 0.5
+
+
+class BatchEndpoint:
+    """Upload a JSONL file of requests, run it as a batch and download the responses."""
+
+    def __init__(self, base_url='https://api.openai.com', api_key=None):
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {api_key or ai_feedback.API_KEY_HERE}'
+
+    def _check(self, response):
+        if response.status_code != 200:
+            raise RuntimeError(f'Batch API error: {response.status_code} - {response.text}')
+        return response
+
+    def submit(self, batch_path):
+        """Upload the requests and start a batch. Returns the batch id."""
+        with open(batch_path, 'rb') as f:
+            upload = self._check(self.session.post(f'{self.base_url}/v1/files', data={'purpose': 'batch'},
+                                                   files={'file': (os.path.basename(batch_path), f)}))
+        batch = self._check(self.session.post(f'{self.base_url}/v1/batches', json={
+            'input_file_id': upload.json()['id'],
+            'endpoint': CHAT_COMPLETIONS,
+            'completion_window': '24h',
+        }))
+        return batch.json()['id']
+
+    def status(self, batch_id):
+        return self._check(self.session.get(f'{self.base_url}/v1/batches/{batch_id}')).json()
+
+    def download(self, file_id, output_path):
+        response = self._check(self.session.get(f'{self.base_url}/v1/files/{file_id}/content', stream=True))
+        with open(output_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                f.write(chunk)
+
+
+def has_feedback(results):
+    return '=== AI FEEDBACK ===' in results.get('output', '')
+
+
+def load_results(student_dir):
+    with open(os.path.join(student_dir, 'results', 'results.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_results(results, student_dir):
+    with open(os.path.join(student_dir, 'results', 'results.json'), 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+
+
+def pending_submissions(submissions_dir):
+    """Yield (student_dir, results, test_summaries, student_code) for graded submissions without feedback."""
+    for student_dir in find_submissions(submissions_dir):
+        if not os.path.exists(os.path.join(student_dir, 'results', 'results.json')):
+            continue
+        results = load_results(student_dir)
+        if has_feedback(results) or 'tests' not in results:
+            continue
+        yield student_dir, results, summarize_tests(results), get_student_code(student_dir)
+
+
+def apply_cached_feedback(submissions_dir):
+    """Give every pending submission whose code and results are in the feedback cache that feedback."""
+    num_applied = 0
+    for student_dir, results, test_summaries, student_code in pending_submissions(submissions_dir):
+        feedback = cache_get(feedback_cache_key(test_summaries, student_code))
+        if feedback is not None:
+            results['metrics'] = total_metrics({'cached': True, 'requests': []})
+            save_results(add_feedback_to_results(results, feedback), student_dir)
+            num_applied += 1
+    return num_applied
+
+
+def normalize_output(output):
+    """A test output without what differs between students hitting the same failure: the code lines the grader
+    quotes from the traceback, numbers and quoted strings."""
+    lines = []
+    for line in (output or '').splitlines():
+        if not line.strip() or line.startswith((' ', '\t', '---')):
+            continue
+        line = re.sub(r"'[^']*'|\"[^\"]*\"", 'STR', line)
+        lines.append(re.sub(r'-?\d+(?:\.\d+)?(?:e[-+]?\d+)?', '#', line))
+    return lines
+
+
+def error_signature(test_summaries):
+    """(tokens, description) of how a submission failed: the words of each failing test's normalized output."""
+    tokens, description = set(), []
+    for test in test_summaries:
+        if not is_failing(test):
+            continue
+        lines = normalize_output(test['output'])
+        tokens.add(test['name'])
+        tokens.update(f"{test['name']}:{word}" for line in lines for word in re.findall(r'\w+', line))
+        # Describe the failure by its exception line if there is one
+        exceptions = [line for line in lines if re.match(r'[\w.]*(?:Error|Exception|Exit)\b', line)]
+        description.append(f"{test['name']}: {(exceptions or lines or ['(no output)'])[-1]}")
+    return tokens, description
+
+
+def similarity(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def cluster_signatures(signatures, threshold):
+    """Greedy clustering: each signature joins the first cluster whose representative is at least `threshold`
+    similar, or starts a new one. Returns lists of indices; the first index of each is its representative."""
+    clusters = []
+    for i, signature in enumerate(signatures):
+        for cluster in clusters:
+            if similarity(signatures[cluster[0]], signature) >= threshold:
+                cluster.append(i)
+                break
+        else:
+            clusters.append([i])
+    return clusters
+
+
+def prepare_batch(submissions_dir, batch_path, clusters_path, threshold=CLUSTER_THRESHOLD):
+    """
+    Write the chat completion requests for the pending submissions to batch_path: one per cluster of
+    submissions with similar error signatures (threshold None: one per distinct code and results),
+    with the clusters and their stats in clusters_path. Returns the number of requests written.
+    """
+    apply_cached_feedback(submissions_dir)
+    pending, keys = [], []
+    for student_dir, results, test_summaries, student_code in pending_submissions(submissions_dir):
+        # Same routing as live feedback, minus the escalation (there is no second round in a batch)
+        tier = choose_tier(test_summaries)
+        if tier == 'none':
+            results['metrics'] = total_metrics({'cached': False, 'requests': []})
+            save_results(add_feedback_to_results(results, {
+                'overall': FULL_SCORE_MESSAGE, 'tests': {}, 'routing': {'tier': 'none', 'model': None}}), student_dir)
+            continue
+        pending.append((student_dir, test_summaries, student_code, tier))
+        keys.append(feedback_cache_key(test_summaries, student_code))
+
+    signatures = [error_signature(test_summaries) for _, test_summaries, _, _ in pending]
+    if threshold is None:
+        clusters = [[i for i, key in enumerate(keys) if key == first] for first in dict.fromkeys(keys)]
+    else:
+        # Only submissions with failing tests are clustered: with nothing failing, the feedback is about the
+        # code itself, so it is only shared between identical submissions. The tier is part of the signature,
+        # so submissions routed to different models never share feedback either.
+        failing = [i for i, (tokens, _) in enumerate(signatures) if tokens]
+        passing = [i for i, (tokens, _) in enumerate(signatures) if not tokens]
+        clusters = [[failing[j] for j in cluster] for cluster in cluster_signatures(
+            [signatures[i][0] | {pending[i][3]} for i in failing], threshold)]
+        clusters += [[i for i in passing if keys[i] == first] for first in dict.fromkeys(keys[i] for i in passing)]
+
+    cluster_stats = []
+    with open(batch_path, 'w', encoding='utf-8') as f:
+        for cluster in clusters:
+            student_dir, test_summaries, student_code, tier = pending[cluster[0]]
+            f.write(json.dumps({
+                'custom_id': os.path.basename(os.path.normpath(student_dir)),
+                'method': 'POST',
+                'url': CHAT_COMPLETIONS,
+                'body': build_chat_request(create_feedback_prompt(test_summaries, student_code), tier_model(tier)),
+            }) + '\n')
+            cluster_stats.append({
+                'representative': os.path.basename(os.path.normpath(student_dir)),
+                'size': len(cluster),
+                'members': [os.path.basename(os.path.normpath(pending[i][0])) for i in cluster],
+                'signature': signatures[cluster[0]][1],
+                'mean_similarity': round(sum(similarity(signatures[cluster[0]][0], signatures[i][0])
+                                             for i in cluster) / len(cluster), 3),
+            })
+
+    cluster_stats.sort(key=lambda cluster: -cluster['size'])
+    with open(clusters_path, 'w', encoding='utf-8') as f:
+        json.dump({'threshold': threshold, 'num_submissions': len(pending), 'clusters': cluster_stats}, f, indent=4)
+    if cluster_stats:
+        print(f'{len(pending)} submissions in {len(cluster_stats)} clusters '
+              f"(largest: {', '.join(str(cluster['size']) for cluster in cluster_stats[:5])})")
+    return len(cluster_stats)
+
+
+def run_batch(endpoint, batch_path, state_path, output_path, poll_interval=60):
+    """Submit the batch (or resume the one recorded in state_path), wait for it and download the responses."""
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            batch_id = json.load(f)['batch_id']
+        print(f'Resuming batch {batch_id}')
+    else:
+        batch_id = endpoint.submit(batch_path)
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump({'batch_id': batch_id}, f)
+        print(f'Submitted batch {batch_id}')
+
+    while True:
+        batch = endpoint.status(batch_id)
+        counts = batch.get('request_counts') or {}
+        print(f"Batch {batch_id}: {batch['status']} ({counts.get('completed', 0)}/{counts.get('total', '?')} done)")
+        if batch['status'] in FINISHED:
+            break
+        time.sleep(poll_interval)
+
+    if not batch.get('output_file_id'):
+        raise RuntimeError(f"Batch {batch_id} {batch['status']} without output")
+    endpoint.download(batch['output_file_id'], output_path)
+    os.remove(state_path)
+
+
+def merge_responses(submissions_dir, output_path, clusters_path=None):
+    """
+    Add the feedback from a batch output file to each results.json, fanning each response out to
+    the members of its cluster. Returns (merged, failed).
+    """
+    members = {}
+    if clusters_path and os.path.exists(clusters_path):
+        with open(clusters_path, 'r', encoding='utf-8') as f:
+            members = {cluster['representative']: cluster['members'] for cluster in json.load(f)['clusters']}
+
+    merged, failed = 0, 0
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            if item.get('error') or response.get('status_code') != 200:
+                print(f"{item['custom_id']}: no feedback ({item.get('error') or response.get('status_code')})")
+                failed += 1
+                continue
+            text = response['body']['choices'][0]['message']['content']
+            usage = response['body'].get('usage') or {}
+            cluster = members.get(item['custom_id'], [item['custom_id']])
+            for member in cluster:
+                student_dir = os.path.join(submissions_dir, member)
+                results = load_results(student_dir)
+                if has_feedback(results):
+                    continue
+                feedback = parse_feedback_response(text)
+                test_summaries = summarize_tests(results)
+                tier = choose_tier(test_summaries)
+                feedback['routing'] = {'tier': tier, 'model': tier_model(tier), 'escalated': False, 'batch': True,
+                                       'cluster': {'representative': item['custom_id'], 'size': len(cluster)}}
+                # The representative's request is the only one billed; batch latency is not per request
+                metrics = {'cached': False, 'batch': True, 'requests': []}
+                if member == item['custom_id']:
+                    # Only the representative's own code and results produced this feedback
+                    cache_put(feedback_cache_key(test_summaries, get_student_code(student_dir)), feedback)
+                    prompt_tokens, completion_tokens = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+                    metrics['requests'].append({
+                        'model': tier_model(tier), 'status': 200, 'latency': None, 'ttfb': None,
+                        'time_to_first_token': None, 'retries': 0, 'prompt_tokens': prompt_tokens,
+                        'completion_tokens': completion_tokens, 'estimated_tokens': False,
+                        'cost_usd': request_cost(tier_model(tier), prompt_tokens, completion_tokens, BATCH_PRICE_FACTOR),
+                    })
+                results['metrics'] = total_metrics(metrics)
+                save_results(add_feedback_to_results(results, feedback), student_dir)
+                merged += 1
+    return merged, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('submissions_dir', type=str)
+    parser.add_argument('--base-url', type=str, default='https://api.openai.com',
+                        help='batch API to use (anything compatible with the OpenAI Files + Batches API)')
+    parser.add_argument('--poll-interval', type=float, default=60, help='seconds between status checks')
+    parser.add_argument('--prepare-only', action='store_true', help='write feedback_batch.jsonl and exit')
+    parser.add_argument('--merge', type=str, default=None, help='merge an already downloaded output file and exit')
+    parser.add_argument('--cluster-threshold', type=float, default=CLUSTER_THRESHOLD,
+                        help='error signature similarity (0-1) above which submissions share one request')
+    parser.add_argument('--no-cluster', action='store_true',
+                        help='one request per distinct submission (identical ones still share)')
+    args = parser.parse_args()
+
+    batch_path = os.path.join(args.submissions_dir, 'feedback_batch.jsonl')
+    state_path = os.path.join(args.submissions_dir, 'feedback_batch.json')
+    clusters_path = os.path.join(args.submissions_dir, 'feedback_clusters.json')
+    output_path = args.merge or os.path.join(args.submissions_dir, 'feedback_output.jsonl')
+
+    if args.merge is None:
+        # An interrupted run left its batch in state_path: wait for that one instead of submitting again
+        if args.prepare_only or not os.path.exists(state_path):
+            num_requests = prepare_batch(args.submissions_dir, batch_path, clusters_path,
+                                         None if args.no_cluster else args.cluster_threshold)
+            print(f'Wrote {num_requests} requests to {batch_path}')
+            if args.prepare_only or num_requests == 0:
+                raise SystemExit(0)
+        run_batch(BatchEndpoint(args.base_url), batch_path, state_path, output_path, args.poll_interval)
+
+    merged, failed = merge_responses(args.submissions_dir, output_path, clusters_path)
+    merged += apply_cached_feedback(args.submissions_dir)
+    print(f'Added feedback to {merged} submissions ({failed} failed)')
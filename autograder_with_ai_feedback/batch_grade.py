@@ -0,0 +1,158 @@
+"""
+Grade a whole cohort of submissions with a pool of worker processes.
+
+Every entry of the submissions directory is graded as its own autograder_dir:
+
+    submissions/
+        student_a/submission/hw.ipynb   ->  student_a/results/results.json
+        student_b/submission/hw.ipynb   ->  student_b/results/results.json
+    summary.json
+
+Each worker imports autograde (and torch, if a reference output is not in the fixtures) once
+and then grades many submissions.
+
+Usage:
+    python batch_grade.py submissions/ --workers 8
+"""
+
+import os
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+
+def find_submissions(submissions_dir):
+    """Return the student directories that contain a submission/ folder, sorted by name."""
+    student_dirs = []
+    for entry in sorted(os.listdir(submissions_dir)):
+        student_dir = os.path.join(submissions_dir, entry)
+        if os.path.isdir(os.path.join(student_dir, 'submission')):
+            student_dirs.append(student_dir)
+    return student_dirs
+
+
+def _init_worker(sandbox=False, reuse_dir=None, perf_mode='off'):
+    # Pay for the numpy/autograde import once per worker instead of once per submission
+    import autograde
+    import utils
+    utils.SANDBOX = sandbox
+    autograde.REUSE_DIR = reuse_dir
+    autograde.PERF_MODE = perf_mode
+
+
+def grade_submission(student_dir):
+    """Grade one student directory and write its results.json. Runs inside a worker process."""
+    import autograde
+
+    start_time = time.time()
+    try:
+        os.makedirs(f'{student_dir}/source', exist_ok=True)
+        os.makedirs(f'{student_dir}/results', exist_ok=True)
+        results = autograde.grade_and_save(student_dir)
+        status = 'graded' if 'tests' in results else 'failed'
+        error = None if 'tests' in results else results.get('output')
+    except BaseException:
+        # Also SystemExit from a submission calling exit(): it fails this submission, not the cohort
+        results = {}
+        status = 'failed'
+        error = traceback.format_exc().splitlines()[-1]
+
+    return {
+        'student': os.path.basename(os.path.normpath(student_dir)),
+        'status': status,
+        'score': sum(test.get('score', 0) for test in results.get('tests', [])),
+        'max_score': sum(test.get('max_score', 0) for test in results.get('tests', [])),
+        'execution_time': round(time.time() - start_time, 2),
+        'error': error,
+        'reuse': results.get('reuse'),
+    }
+
+
+def _crashed(student_dir, error):
+    return {
+        'student': os.path.basename(os.path.normpath(student_dir)),
+        'status': 'crashed',
+        'score': 0,
+        'max_score': 0,
+        'execution_time': None,
+        'error': error,
+    }
+
+
+def grade_cohort(submissions_dir, workers=None, sandbox=False, reuse_dir=None, perf_mode='off'):
+    """
+    Grade every submission in submissions_dir and return the per-student summaries.
+    A submission that raises is recorded as failed; one that kills its worker process
+    (segfault, OOM kill) is recorded as crashed and the pool is restarted for the rest.
+    With reuse_dir, only tests whose submission, code or configuration changed since a previous run are run.
+    """
+    pending = find_submissions(submissions_dir)
+    summaries = {}
+
+    while pending:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(sandbox, reuse_dir, perf_mode)) as pool:
+            futures = {pool.submit(grade_submission, student_dir): student_dir for student_dir in pending}
+            broken = False
+            for future in as_completed(futures):
+                student_dir = futures[future]
+                try:
+                    summary = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    continue
+                except (Exception, SystemExit) as e:
+                    summary = _crashed(student_dir, f'{type(e).__name__}: {e}')
+                summaries[student_dir] = summary
+                print(f"{summary['student']}: {summary['status']} {summary['score']}/{summary['max_score']}")
+
+        pending = [student_dir for student_dir in pending if student_dir not in summaries]
+        if broken and pending:
+            # We cannot tell which in-flight submission killed the pool, so retry them one at a time
+            if workers == 1 or len(pending) == 1:
+                summaries[pending[0]] = _crashed(pending[0], 'Worker process died while grading this submission')
+                print(f"{summaries[pending[0]]['student']}: crashed")
+                pending = pending[1:]
+            workers = 1
+
+    return [summaries[student_dir] for student_dir in find_submissions(submissions_dir)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('submissions_dir', type=str)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--summary', type=str, default=None,
+                        help='where to write the cohort summary (default: <submissions_dir>/summary.json)')
+    parser.add_argument('--sandbox', action='store_true',
+                        help='run each test in a child process with the limits set in utils.py')
+    parser.add_argument('--reuse-dir', type=str, default=None,
+                        help='store per-test results here and only rerun tests whose submission, code or config changed')
+    parser.add_argument('--perf', choices=['off', 'deduct', 'award'], default='off',
+                        help='performance test: off, deduct up to autograde.PERF_POINTS, or award them')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    students = grade_cohort(args.submissions_dir, workers=args.workers, sandbox=args.sandbox,
+                            reuse_dir=args.reuse_dir, perf_mode=args.perf)
+    summary = {
+        'num_submissions': len(students),
+        'num_failed': sum(student['status'] != 'graded' for student in students),
+        'total_time': round(time.time() - start_time, 2),
+        'students': students,
+    }
+    if args.reuse_dir:
+        reused = sum(student['reuse']['reused'] for student in students if student.get('reuse'))
+        graded = sum(student['reuse']['graded'] for student in students if student.get('reuse'))
+        summary['reuse'] = {'reused': reused, 'graded': graded, 'hit_rate': round(reused / max(reused + graded, 1), 3)}
+    summary_path = args.summary or os.path.join(args.submissions_dir, 'summary.json')
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=4)
+    print(f"Graded {summary['num_submissions']} submissions in {summary['total_time']:.2f} seconds "
+          f"({summary['num_failed']} failed). Summary written to {summary_path}")
+    if 'reuse' in summary:
+        print(f"Reused {summary['reuse']['reused']} test results and ran {summary['reuse']['graded']} tests "
+              f"(hit rate {summary['reuse']['hit_rate']:.0%})")
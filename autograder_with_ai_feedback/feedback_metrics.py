@@ -0,0 +1,127 @@
+"""
+Report the AI feedback telemetry (results['metrics'], written by ai_feedback.py) across a directory of results:
+latency and time-to-first-byte percentiles, tokens, retries, skipped calls, cache hits and total spend.
+
+Every results.json under the directory is read, so this works on a batch_grade.py cohort as well as
+on a folder of downloaded results.
+
+Usage:
+    python feedback_metrics.py submissions/
+    python feedback_metrics.py submissions/ --json
+"""
+
+import os
+import json
+import math
+import argparse
+
+
+def find_results(results_dir):
+    """Paths of every results.json under results_dir, sorted."""
+    paths = []
+    for root, dirs, files in os.walk(results_dir):
+        dirs.sort()
+        if 'results.json' in files:
+            paths.append(os.path.join(root, 'results.json'))
+    return paths
+
+
+def percentile(values, q):
+    """Nearest-rank percentile (q in 0-100) of a list of numbers, or None if it is empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def aggregate_metrics(results_dir):
+    """Totals and percentiles over the metrics of every results.json under results_dir."""
+    metrics = []
+    for path in find_results(results_dir):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                results = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if isinstance(results.get('metrics'), dict):
+            metrics.append(results['metrics'])
+
+    requests_made = [request for submission in metrics for request in submission.get('requests', [])]
+    # Calls never sent (circuit breaker open, no time left) are not requests, so they are counted apart
+    skipped = {}
+    for submission in metrics:
+        for reason, count in (submission.get('skipped') or {}).items():
+            skipped[reason] = skipped.get(reason, 0) + count
+    latencies = [submission['latency'] for submission in metrics if submission.get('latency') is not None]
+    request_latencies = [request['latency'] for request in requests_made if request.get('latency') is not None]
+    ttfbs = [request['ttfb'] for request in requests_made if request.get('ttfb') is not None]
+    costs = [request.get('cost_usd') for request in requests_made]
+    models = {}
+    for request in requests_made:
+        model = models.setdefault(request.get('model'), {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                                                         'cost_usd': 0.0})
+        model['requests'] += 1
+        model['prompt_tokens'] += request.get('prompt_tokens', 0)
+        model['completion_tokens'] += request.get('completion_tokens', 0)
+        model['cost_usd'] = round(model['cost_usd'] + (request.get('cost_usd') or 0.0), 6)
+
+    return {
+        'submissions': len(metrics),
+        'cache_hits': sum(bool(submission.get('cached')) for submission in metrics),
+        'requests': len(requests_made),
+        'failed_requests': sum(request.get('status') != 200 for request in requests_made),
+        'retries': sum(request.get('retries', 0) for request in requests_made),
+        'skipped_requests': sum(skipped.values()),
+        'skipped': skipped,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'request_latency_p50': percentile(request_latencies, 50),
+        'request_latency_p95': percentile(request_latencies, 95),
+        'ttfb_p50': percentile(ttfbs, 50),
+        'ttfb_p95': percentile(ttfbs, 95),
+        'prompt_tokens': sum(request.get('prompt_tokens', 0) for request in requests_made),
+        'completion_tokens': sum(request.get('completion_tokens', 0) for request in requests_made),
+        'estimated_token_requests': sum(bool(request.get('estimated_tokens')) for request in requests_made),
+        'cost_usd': round(sum(cost for cost in costs if cost is not None), 6),
+        # Requests to a model missing from ai_feedback.MODEL_PRICES are not in cost_usd
+        'unpriced_requests': sum(cost is None for cost in costs),
+        'models': models,
+    }
+
+
+def _seconds(value):
+    return '-' if value is None else f'{value:.2f} s'
+
+
+def print_report(summary):
+    print(f"Submissions with metrics: {summary['submissions']} ({summary['cache_hits']} cache hits)")
+    print(f"API requests: {summary['requests']} ({summary['failed_requests']} failed, {summary['retries']} retries)")
+    if summary['skipped_requests']:
+        reasons = ', '.join(f'{reason}: {count}' for reason, count in sorted(summary['skipped'].items()))
+        print(f"Requests skipped: {summary['skipped_requests']} ({reasons})")
+    print(f"Feedback latency per submission: p50 {_seconds(summary['latency_p50'])}, "
+          f"p95 {_seconds(summary['latency_p95'])}")
+    print(f"Latency per request:             p50 {_seconds(summary['request_latency_p50'])}, "
+          f"p95 {_seconds(summary['request_latency_p95'])}")
+    print(f"Time to first byte:              p50 {_seconds(summary['ttfb_p50'])}, "
+          f"p95 {_seconds(summary['ttfb_p95'])}")
+    print(f"Tokens: {summary['prompt_tokens']} prompt, {summary['completion_tokens']} completion"
+          + (f" ({summary['estimated_token_requests']} requests estimated)" if summary['estimated_token_requests'] else ''))
+    for model, stats in sorted(summary['models'].items(), key=lambda item: str(item[0])):
+        print(f"  {model}: {stats['requests']} requests, {stats['prompt_tokens']} prompt + "
+              f"{stats['completion_tokens']} completion tokens, ${stats['cost_usd']:.4f}")
+    print(f"Total spend: ${summary['cost_usd']:.4f}"
+          + (f" (plus {summary['unpriced_requests']} requests to unpriced models)" if summary['unpriced_requests'] else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('results_dir', type=str, help='directory searched recursively for results.json files')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+
+    summary = aggregate_metrics(args.results_dir)
+    if args.json:
+        print(json.dumps(summary, indent=4))
+    else:
+        print_report(summary)
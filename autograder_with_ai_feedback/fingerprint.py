@@ -0,0 +1,174 @@
+"""
+Structural fingerprints of submissions, so results can be reused for code that only differs in
+variable names, annotations, docstrings or formatting.
+
+The fingerprint is a hash of the submission's AST after canonicalization:
+  - local variables of every function are renamed in order of first appearance
+    (function and parameter names are kept: tests call them, possibly by keyword)
+  - docstrings, other bare string/constant expressions and type annotations are dropped
+  - formatting, comments and the spelling of constants (0x10 vs 16, '' vs "") are already gone in the AST
+
+Two submissions with the same fingerprint behave identically, so a test one of them passed does not need to
+run for the other. Failed tests and AI feedback are not shared: they quote the submission's own source.
+"""
+
+import os
+import ast
+import json
+import hashlib
+import tempfile
+
+# Bump whenever canonicalization changes, so stored results keyed by old fingerprints are not reused
+FINGERPRINT_VERSION = 2
+
+
+class _Canonicalizer(ast.NodeTransformer):
+
+    def __init__(self):
+        self.names = [{}]  # one renaming per enclosing function; the module scope renames nothing
+
+    def _local(self, name):
+        for names in reversed(self.names):
+            if name in names:
+                return names[name]
+        return name
+
+    def visit_FunctionDef(self, node):
+        node.decorator_list = [self.visit(decorator) for decorator in node.decorator_list]
+        node.returns = None
+        for arg in node.args.posonlyargs + node.args.args + node.args.kwonlyargs + [node.args.vararg, node.args.kwarg]:
+            if arg is not None:
+                arg.annotation = None
+        node.args.defaults = [self.visit(default) for default in node.args.defaults]
+        node.args.kw_defaults = [default and self.visit(default) for default in node.args.kw_defaults]
+
+        params = {arg.arg for arg in node.args.posonlyargs + node.args.args + node.args.kwonlyargs}
+        params |= {arg.arg for arg in (node.args.vararg, node.args.kwarg) if arg is not None}
+        global_names = {name for child in _walk_scope(node.body) if isinstance(child, ast.Global) for name in child.names}
+        nonlocal_names = {name for child in _walk_scope(node.body) if isinstance(child, ast.Nonlocal)
+                          for name in child.names}
+        # Names bound in this function (Python makes them local), in the order they first appear.
+        # '#' cannot occur in an identifier, so the new names never collide with real ones.
+        # Parameters and globals shadow the renamings of enclosing functions; nonlocals resolve to them.
+        names = {name: name for name in params | global_names}
+        for child in _walk_scope(node.body):
+            for name in _bound_names(child):
+                if name not in names and name not in nonlocal_names:
+                    names[name] = f'v#{len(self.names)}.{len(names) - len(params | global_names)}'
+        self.names.append(names)
+        node.body = _strip_docstrings([self.visit(statement) for statement in node.body])
+        self.names.pop()
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        args = node.args.posonlyargs + node.args.args + node.args.kwonlyargs + [node.args.vararg, node.args.kwarg]
+        self.names.append({arg.arg: arg.arg for arg in args if arg is not None})
+        node = self.generic_visit(node)
+        self.names.pop()
+        return node
+
+    def visit_ClassDef(self, node):
+        # Class attributes keep their names (they are reached through attributes, which are never renamed)
+        self.names.append({name: name for child in _walk_scope(node.body) for name in _bound_names(child)})
+        node = self.generic_visit(node)
+        node.body = _strip_docstrings(node.body)
+        self.names.pop()
+        return node
+
+    def visit_Name(self, node):
+        node.id = self._local(node.id)
+        return node
+
+    def visit_arg(self, node):
+        node.annotation = None
+        return node
+
+    def visit_Nonlocal(self, node):
+        node.names = [self._local(name) for name in node.names]
+        return node
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            node.name = self._local(node.name)
+        return self.generic_visit(node)
+
+    def visit_AnnAssign(self, node):
+        if node.value is None:
+            return None
+        return self.visit(ast.Assign(targets=[node.target], value=node.value))
+
+    def visit_Module(self, node):
+        node.body = _strip_docstrings([self.visit(statement) for statement in node.body])
+        return node
+
+
+def _walk_scope(body):
+    """Nodes of a function body in order, without descending into nested functions, classes or lambdas."""
+    stack = list(reversed(body))
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        stack.extend(reversed([child for child in ast.iter_child_nodes(node) if not isinstance(child, ast.Lambda)]))
+
+
+def _bound_names(node):
+    if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+        return [node.id]
+    if isinstance(node, ast.ExceptHandler) and node.name:
+        return [node.name]
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return [(alias.asname or alias.name).split('.')[0] for alias in node.names]
+    return []
+
+
+def _strip_docstrings(body):
+    """Drop statements that do nothing: docstrings and other bare constants, and `pass` (to_py turns prints
+    into `pass`, so code with and without prints compares equal)."""
+    body = [statement for statement in body if statement is not None and not isinstance(statement, ast.Pass) and not (
+        isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Constant))]
+    return body or [ast.Pass()]
+
+
+def ast_fingerprint(source: str):
+    """Hash of the canonical AST of `source`, or None if it does not parse."""
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return None
+    tree = _Canonicalizer().visit(tree)
+    dump = ast.dump(tree, annotate_fields=False, include_attributes=False)
+    return hashlib.sha256(f'v{FINGERPRINT_VERSION}\n{dump}'.encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        return ast_fingerprint(f.read())
+
+
+class ResultStore:
+    """Results by key, one JSON file each, shared by every grading run pointed at the same directory."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, key: str):
+        try:
+            with open(self._file(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, value):
+        """Store atomically, so concurrent graders never read a partial file."""
+        os.makedirs(os.path.dirname(self._file(key)), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._file(key)), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, self._file(key))
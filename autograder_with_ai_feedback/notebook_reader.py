@@ -0,0 +1,183 @@
+"""
+Streaming reader for .ipynb files.
+
+Student notebooks often carry tens of MB of base64 plot outputs that grading never uses.
+iter_code_cells reads the notebook in chunks and only decodes the `cell_type` and `source`
+of each cell; outputs, attachments and metadata are skipped without being materialized,
+and reading stops as soon as the cells array ends.
+"""
+
+import re
+import json
+
+CHUNK_SIZE = 1 << 20  # characters read at a time
+
+_STRUCTURE = re.compile(r'["\[\]{}]')
+_SCALAR_END = re.compile(r'[,\]}\s]')
+_DECODER = json.JSONDecoder()
+
+
+class _JsonStream:
+    """A position in a JSON document that is read from a file chunk by chunk."""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.mark = None  # start of a value being kept for decoding
+
+    def more(self):
+        """Read the next chunk, dropping the consumed text that is not being kept. False at end of file."""
+        data = self.f.read(self.chunk_size)
+        if not data:
+            return False
+        # pos may point one past the buffer, just after an escape character
+        keep = min(self.pos, len(self.buf)) if self.mark is None else self.mark
+        self.buf = self.buf[keep:] + data
+        self.pos -= keep
+        if self.mark is not None:
+            self.mark = 0
+        return True
+
+    def _need_more(self):
+        if not self.more():
+            raise ValueError('Unexpected end of notebook')
+
+    def peek(self):
+        """Next non-whitespace character, without consuming it."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self._need_more()
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f'Expected {char!r} in notebook, found {found!r}')
+        self.pos += 1
+
+    def skip_separator(self):
+        """Consume a ',' if there is one. True if another item follows."""
+        if self.peek() == ',':
+            self.pos += 1
+            return True
+        return False
+
+    def skip_string(self):
+        self.pos += 1
+        while True:
+            # str.find is much faster than a regex over long base64 strings
+            quote = self.buf.find('"', self.pos)
+            escape = self.buf.find('\\', self.pos, len(self.buf) if quote == -1 else quote)
+            if escape != -1:
+                # Skip the escaped character, which may be in the next chunk
+                self.pos = escape + 2
+                while self.pos > len(self.buf):
+                    self._need_more()
+            elif quote == -1:
+                self.pos = len(self.buf)
+                self._need_more()
+            else:
+                self.pos = quote + 1
+                return
+
+    def skip_value(self):
+        char = self.peek()
+        if char == '"':
+            return self.skip_string()
+        if char in '[{':
+            depth = 0
+            while True:
+                match = _STRUCTURE.search(self.buf, self.pos)
+                if match is None:
+                    self.pos = len(self.buf)
+                    self._need_more()
+                    continue
+                self.pos = match.start()
+                if match.group() == '"':
+                    self.skip_string()
+                    continue
+                self.pos += 1
+                depth += 1 if match.group() in '[{' else -1
+                if depth == 0:
+                    return
+        # number, true, false or null
+        while True:
+            match = _SCALAR_END.search(self.buf, self.pos)
+            if match is not None:
+                self.pos = match.start()
+                return
+            self.pos = len(self.buf)
+            if not self.more():
+                return
+
+    def read_value(self):
+        """Decode the next value in place, reading further chunks until it is complete."""
+        self.peek()
+        self.mark = self.pos
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.mark)
+            except json.JSONDecodeError:
+                end = None
+            # Strings, arrays and objects end with a closing character, a number may go on in the next chunk
+            if end is not None and (end < len(self.buf) or self.buf[self.mark] in '"[{'):
+                break
+            if not self.more():
+                if end is None:
+                    raise ValueError('Invalid or truncated value in notebook')
+                break
+        self.mark = None
+        self.pos = end
+        return value
+
+
+def _iter_cells(stream):
+    stream.expect('[')
+    if stream.peek() == ']':
+        return
+    while True:
+        stream.expect('{')
+        cell_type, source = None, None
+        if stream.peek() != '}':
+            while True:
+                key = stream.read_value()
+                stream.expect(':')
+                if key == 'cell_type':
+                    cell_type = stream.read_value()
+                elif key == 'source' and cell_type in (None, 'code'):
+                    source = stream.read_value()
+                else:
+                    stream.skip_value()
+                if not stream.skip_separator():
+                    break
+        stream.expect('}')
+        if cell_type == 'code':
+            source = source or []
+            yield source.splitlines(keepends=True) if isinstance(source, str) else source
+        if not stream.skip_separator():
+            stream.expect(']')
+            return
+
+
+def iter_code_cells(notebook_path, chunk_size=CHUNK_SIZE):
+    """Yield the source of every code cell as a list of lines, in notebook order."""
+    with open(notebook_path, 'r', encoding='utf-8') as f:
+        stream = _JsonStream(f, chunk_size)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.read_value()
+            stream.expect(':')
+            if key == 'cells':
+                # Everything after the cells (notebook metadata) is never read
+                yield from _iter_cells(stream)
+                return
+            stream.skip_value()
+            if not stream.skip_separator():
+                stream.expect('}')
+                return
@@ -1,72 +1,196 @@
+import dis
+import functools
+import hashlib
+import importlib.util
+import inspect
 import json
 import os
 import re
+import signal
+import sys
+import time
 import yaml
 import traceback
-import torch
+import tracemalloc
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+from concurrent.futures import ThreadPoolExecutor
+from notebook_reader import iter_code_cells
 from ai_feedback import enhance_results_with_ai_feedback
 
 
-def to_py(
-        notebook_path,
-        script_path,
-        autograded_only=True,
-        imports = ""
-        ):
+# One pass over a cell: a small lexer where strings are matched as whole tokens, so a '#' or
+# 'import' inside a string is never mistaken for a comment or an import statement.
+# The cell is lexed with a '\n' in front, so that each line-level token starts with the newline before its line.
+# Every alternative then starts with a fixed character ('\n', a quote, '#', 'i' or 'f'), which lets the engine
+# skip ahead to those characters instead of trying the pattern at every position.
+# String prefixes are left out of the string token: they are kept as code like the rest of the line.
+CELL_TOKENS = re.compile(r"""
+    \n(?:
+        (?P<docstring>(?P<indent>[ \t]*)(?P<docstring_text>[rRuU]?(?:\"\"\"[\s\S]*?\"\"\"|'''[\s\S]*?'''))
+            [ \t]*(?:\#[^\n]*)?(?=\n|\Z))
+      | (?P<print>(?P<print_indent>[ \t]*)print[ \t]*\(.*\)[ \t]*(?:\#[^\n]*)?$)
+      | (?=[ \t]*(?:[\#\n]|\Z))(?P<blank>(?:[ \t]*(?:\#[^\n]*)?\n)*[ \t]*(?:\#[^\n]*)?(?=\n|\Z))
+    )
+  | "(?P<string>""[\s\S]*?\"\"\"|(?:[^"\\\n]|\\.)*")
+  | '(?P<single_quoted>''[\s\S]*?'''|(?:[^'\\\n]|\\.)*')
+  | \#(?P<comment>[^\n]*)
+  | i(?<!\wi)(?P<import>mport\b)
+  | f(?<!\wf)(?P<for>or\s+\w+\s+in(?=\s))
+""", re.MULTILINE | re.VERBOSE)
+# Blank and comment-only lines, skipped when looking for the statement after a docstring
+BLANK_LINES = re.compile(r'(?:[ \t]*(?:\#[^\n]*)?\n)*')
+# A line without a comment in a run of blank lines
+BLANK_LINE = re.compile(r'\n[ \t]*(?:\n|\Z)')
+# Strings and comments, removed from the code before counting its brackets
+STRINGS_AND_COMMENTS = re.compile(r"""\"\"\"[\s\S]*?\"\"\"|'''[\s\S]*?'''|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|\#[^\n]*""")
+
+
+def clean_cell(cell_source):
+    """
+    Clean one code cell in a single pass:
+    drop comments and docstrings, replace single-line print(...) statements with pass,
+    collapse runs of blank lines, and detect import statements and `for x in` loops along the way.
+    Returns (cleaned_source, has_import, num_for_loops).
     """
-    Convert a Jupyter notebook to a Python script.
+    found = {'import': False, 'for': 0}
+    # Bracket depth of the code before `checked`, the end of the last docstring or print line looked at
+    brackets = {'checked': 0, 'depth': 0}
+
+    def starts_statement(match):
+        # A line inside open brackets or after a backslash continues the statement before it
+        code = STRINGS_AND_COMMENTS.sub('', match.string[brackets['checked']:match.start()])
+        brackets['depth'] += code.count('(') + code.count('[') + code.count('{') \
+            - code.count(')') - code.count(']') - code.count('}')
+        brackets['checked'] = match.end()
+        return brackets['depth'] <= 0 and not code.endswith('\\')
+
+    def replace(match):
+        kind = match.lastgroup
+        if kind == 'string' or kind == 'single_quoted':
+            return match.group()
+        if kind == 'blank':
+            # Comment-only lines disappear; actual blank lines collapse into one
+            return '\n' if BLANK_LINE.search(match.group()) else ''
+        if kind == 'docstring':
+            indent = match.group('indent')
+            if not starts_statement(match):
+                return '\n' + indent + match.group('docstring_text')
+            # Keep a pass in its place unless a statement follows at the same level:
+            # the docstring may be the only statement of its block
+            next_line = BLANK_LINES.match(match.string, match.end() + 1).end()
+            following = match.string[next_line:next_line + len(indent) + 1]
+            if not indent or (following[:-1] == indent and following[-1:] not in ('', ' ', '\t', '\n', '#')):
+                return ''
+            return '\n' + indent + 'pass'
+        if kind == 'print':
+            if not starts_statement(match):
+                return match.group()
+            return '\n' + match.group('print_indent') + 'pass'
+        if kind == 'import':
+            found['import'] = True
+            return match.group()
+        if kind == 'for':
+            found['for'] += 1
+            return match.group()
+        return ''  # comment; it leaves its leading spaces behind
+
+    cell_source = CELL_TOKENS.sub(replace, '\n' + cell_source)
+    return cell_source.lstrip('\n'), found['import'], found['for']
+
+
+class SubmissionArtifact:
+    """
+    A notebook parsed once: the script made from its cleaned cells, the script's hash and the number of for loops
+    in it. make_py returns it so that grading and the AI feedback (through save_results) use it instead of
+    reading source/submission.py or the notebook again.
+    """
+
+    def __init__(self, notebook_path, script, num_for_loops):
+        self.notebook_path = notebook_path
+        self.script = script
+        self.num_for_loops = num_for_loops
+        self.source_hash = hashlib.sha256(script.encode('utf-8')).hexdigest()
+
+
+def parse_notebook(notebook_path, autograded_only=True, imports=""):
+    """
+    Parse and clean a notebook in one pass, returning a SubmissionArtifact.
     if autograded_only is True, only cells starting with '# AUTOGRADED' will be included in the script.
     Since the imports will be added to the script, the imports should be passed as a string.
     """
-    with open(notebook_path, 'r', encoding='utf-8') as f:
-        notebook = json.load(f)
-
     script_cells = []
+    num_for_loops = 0
 
-    if autograded_only:
-        script_cells += [imports]
-
-    for cell in notebook['cells']:
-        if cell['cell_type'] != 'code':
-            continue
-        cell = cell['source']
+    # Streams the notebook: only code cell sources are decoded, outputs are skipped
+    for cell in iter_code_cells(notebook_path):
         if len(cell) == 0:
             continue
         if autograded_only and not cell[0].startswith('# AUTOGRADED'):
             continue
         
-        cell_source = ''.join(cell)
-        
-        # removing docstrings
-        cell_source = re.sub(r'(\'\'\'.*?\'\'\')|(\"\"\".*?\"\"\")', '', cell_source, flags=re.DOTALL)
-        # remove all comments
-        cell_source = re.sub(r'#.*', '', cell_source)
+        cell_source, has_import, cell_for_loops = clean_cell(''.join(cell))
 
         # checking if there is any import statement in the cell if autograded_only is True
-        # anything like import x or from this import that. use re to match import with surrounding spaces
         if autograded_only:
-            assert not re.search(r'(?<!\w)import(?!\w)', cell_source), \
+            assert not has_import, \
                 f'Found import statement in your code. Please remove it!'
 
-        script_cells.append(cell_source)
+        script_cells.append(cell_source.strip())
+        num_for_loops += cell_for_loops
+
+    script_source = ('\n\n'+100*'#'+'\n\n').join(([imports] if autograded_only else []) + script_cells)
+    return SubmissionArtifact(notebook_path, script_source, num_for_loops)
 
-    script_source = ('\n\n'+100*'#'+'\n\n').join(script_cells)
-    script_source = re.sub(r'\n\s*\n', '\n\n', script_source)
-    # Replace print statements with pass at the same indentation level
-    script_source = re.sub(r'^(\s*)print\s*\((.*)\)\s*$', r'\1pass', script_source, flags=re.MULTILINE)
+
+def to_py(
+        notebook_path,
+        script_path,
+        autograded_only=True,
+        imports = "",
+        stats=None
+        ):
+    """
+    Convert a Jupyter notebook to a Python script (see parse_notebook).
+    If a dict is passed as stats, it is filled with the number of `for x in` loops in the script.
+    """
+    artifact = parse_notebook(notebook_path, autograded_only, imports)
+    if stats is not None:
+        stats['num_for_loops'] = artifact.num_for_loops
 
     with open(script_path, 'w', encoding='utf-8') as f:
-        # using regex to remove docstrings:
-        f.write(script_source)
-    return script_source
+        f.write(artifact.script)
+    return artifact.script
 
 
 def make_py(autograder_dir: str, imports: str, solution=True):
+    """Write source/submission.py from the submitted notebook and return its SubmissionArtifact."""
     notebooks = [f for f in os.listdir(f'{autograder_dir}/submission') if f.endswith('.ipynb')]
     assert len(notebooks) == 1, f'Expected 1 notebook in submission, found {len(notebooks)}'
     if solution:
         to_py(f'{autograder_dir}/source/solution.ipynb', f'{autograder_dir}/source/solution.py', autograded_only=False)
-    return to_py(f'{autograder_dir}/submission/{notebooks[0]}', f'{autograder_dir}/source/submission.py', imports=imports)
+    artifact = parse_notebook(f'{autograder_dir}/submission/{notebooks[0]}', imports=imports)
+    # Still written: the import below gives it as the file name, so tracebacks show the student's lines
+    with open(f'{autograder_dir}/source/submission.py', 'w', encoding='utf-8') as f:
+        f.write(artifact.script)
+    return artifact
+
+
+def load_submission(autograder_dir: str, source: str = None):
+    """
+    Import source/submission.py as a fresh module, compiling `source` instead of reading the file if given.
+    Unlike __import__('submission'), this does not depend on the working directory and
+    does not reuse a module cached in sys.modules, so one process can grade many submissions.
+    """
+    spec = importlib.util.spec_from_file_location('submission', f'{autograder_dir}/source/submission.py')
+    submission = importlib.util.module_from_spec(spec)
+    if source is None:
+        spec.loader.exec_module(submission)
+    else:
+        exec(compile(source, spec.origin, 'exec'), submission.__dict__)
+    return submission
 
 
 def load_yaml(yaml_path):
@@ -75,56 +199,212 @@ def load_yaml(yaml_path):
     
 
 def load_model(model_class, config_path, state_dict_path):
+    import torch  # imported here so autograders that never load a model skip the torch import
     model_config = load_yaml(config_path)
     model: torch.nn.Module = model_class(**model_config)
     model.load_state_dict(torch.load(state_dict_path))
     return model
 
 
-def save_results(results: dict, autograder_dir: str):
+def save_results(results: dict, autograder_dir: str, artifact: SubmissionArtifact = None):
+    """Add the AI feedback and write results/results.json. Pass make_py's artifact so the feedback uses the code
+    already parsed instead of reading it back from disk."""
     
-    results = enhance_results_with_ai_feedback(results, autograder_dir)
-with open(f'{autograder_dir}/results/results.json', 'w', encoding='utf-8') as f:
+    start_time = time.time()
+    results = enhance_results_with_ai_feedback(results, autograder_dir,
+                                               student_code=artifact.script if artifact is not None else None)
+    if 'phases' in results:
+        results['phases']['ai_feedback'] = round(time.time() - start_time, 4)
+    with open(f'{autograder_dir}/results/results.json', 'w', encoding='utf-8') as f:
         json.dump(results, f, indent=4)
 
 
-# Decorator to catch errors of a grader function
-def grader(action, name=None, max_score=None):
+# Sandbox: run each graded test in a child process with resource limits (Linux/macOS only).
+# Turned on with `python autograde.py <dir> --sandbox`; a limit of None disables it.
+SANDBOX = False
+TIMEOUT = 60         # wall-clock seconds per test
+CPU_LIMIT = 60       # CPU seconds per test (RLIMIT_CPU)
+MEMORY_LIMIT = 4096  # MB a test may allocate on top of what the grader already uses (RLIMIT_AS)
 
-    def decorator(test_func):
+# Parallel: run the tests passed to run_tests concurrently.
+# None runs them one after another; 'thread' runs them in threads of this process;
+# 'process' runs each test in a forked child process (with the sandbox limits if SANDBOX is on).
+PARALLEL = None
+WORKERS = 4
+
+# Profile: every test records wall time, CPU time and the process's peak RSS.
+# TRACE_MEMORY also records the peak traced allocation with tracemalloc; it makes tests several
+# times slower, and tests running in threads of the same process share one tracemalloc peak.
+TRACE_MEMORY = False
 
-        def wrapper(*args, **kwargs):
-            
-            try:
-                result = test_func(*args, **kwargs) # {'score': score, 'output': output}
 
-            except Exception as e:
+def _max_rss_mb():
+    # Peak resident set size of this process so far; ru_maxrss is in KB on Linux and bytes on macOS
+    if resource is None:
+        return 0.0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
 
-                tb = traceback.format_exc()
-                tb_lines = tb.splitlines()
-                filtered_tb_lines = []
+
+def run_test(test_func, args, kwargs):
+    """
+    Call a test and turn any exception into a zero score with a traceback filtered to the submission.
+    Test results (dicts with a score) get a 'profile' entry with wall time, CPU time and peak allocation.
+    """
+    if TRACE_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+        tracemalloc.reset_peak()
+    start_time, start_cpu_time, start_rss = time.perf_counter(), time.thread_time(), _max_rss_mb()
+    try:
+        result = test_func(*args, **kwargs) # {'score': score, 'output': output}
+
+    except Exception as e:
+
+        tb = traceback.format_exc()
+        tb_lines = tb.splitlines()
+        filtered_tb_lines = []
+        include_next_line = False
+        for line in tb_lines:
+            # If the error is in student submission:
+            if "/source/submission.py" in line:
+                include_next_line = True
+                error_location = line.split(',')[-1].strip() + ':'
+                # Get line number of the code from this line
+            elif include_next_line:
+                # Include the code line following the module path
+                filtered_tb_lines.append(error_location+'\n'+line)
                 include_next_line = False
-                for line in tb_lines:
-                    # If the error is in student submission:
-                    if "/autograder/source/submission.py" in line:
-                        include_next_line = True
-                        error_location = line.split(',')[-1].strip() + ':'
-                        # Get line number of the code from this line
-                    elif include_next_line:
-                        # Include the code line following the module path
-                        filtered_tb_lines.append(error_location+'\n'+line)
-                        include_next_line = False
-                
-                # Always include the last line (the exception type and message)
-                filtered_tb_lines.append(tb_lines[-1])
+        
+        # Always include the last line (the exception type and message)
+        filtered_tb_lines.append(tb_lines[-1])
+
+        # concatenate the lines
+        output = ('\n'+50*'-'+'\n').join(filtered_tb_lines)
+
+        result = {
+            'score': 0.0,
+            'output': output,
+        }
+
+    if 'score' in result:
+        result['profile'] = {
+            'wall_time': round(time.perf_counter() - start_time, 4),
+            'cpu_time': round(time.thread_time() - start_cpu_time, 4),
+            'max_rss_mb': round(_max_rss_mb(), 1),
+            'rss_growth_mb': round(_max_rss_mb() - start_rss, 1),
+        }
+        if tracemalloc.is_tracing():
+            result['profile']['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+
+    return result
+
+
+def _address_space_mb():
+    # Current virtual memory size of this process, from /proc on Linux
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmSize:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _sandbox_child(conn, test_func, args, kwargs, cpu_limit, memory_limit):
+    if cpu_limit is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        limit = int(cpu_limit) if hard == resource.RLIM_INFINITY else min(int(cpu_limit), hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+    if memory_limit is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = (_address_space_mb() + int(memory_limit)) * 1024 * 1024
+        limit = limit if hard == resource.RLIM_INFINITY else min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+    start_time = time.time()
+    try:
+        result = run_test(test_func, args, kwargs)
+        last_line = result.get('output', '').splitlines()[-1:]
+        # MemoryError or a subclass such as numpy's _ArrayMemoryError
+        if last_line and last_line[0].split(':')[0].endswith('MemoryError'):
+            result['sandbox'] = {'status': 'out_of_memory'}
+    except BaseException as e:
+        # e.g. SystemExit from a submission calling exit()
+        result = {'score': 0.0, 'output': f'{type(e).__name__}: {e}',
+                  'profile': {'wall_time': round(time.time() - start_time, 4)}}
+    result.setdefault('sandbox', {'status': 'ok'})
+    result['sandbox']['elapsed_time'] = round(time.time() - start_time, 3)
+    result['sandbox']['peak_memory_mb'] = round(_max_rss_mb(), 1)
+    conn.send(result)
+    conn.close()
+
+
+def run_sandboxed(test_func, args, kwargs, timeout=None, cpu_limit=None, memory_limit=None):
+    """
+    Run a test in a forked child process with wall-clock, CPU and memory limits.
+    A test that exceeds a limit scores 0 with a message saying which limit and when,
+    and the parent process carries on with the next test.
+    """
+    import multiprocessing
+    context = multiprocessing.get_context('fork')
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=_sandbox_child, args=(child_conn, test_func, args, kwargs, cpu_limit, memory_limit))
+
+    start_time = time.time()
+    process.start()
+    child_conn.close()
+    # poll() also returns when the child dies without sending anything; recv() then raises EOFError
+    timed_out = not parent_conn.poll(timeout)
+    try:
+        result = None if timed_out else parent_conn.recv()
+    except EOFError:
+        result = None
+    elapsed_time = time.time() - start_time
+    if process.is_alive():
+        process.kill()
+    process.join()
 
-                # concatenate the lines
-                output = ('\n'+50*'-'+'\n').join(filtered_tb_lines)
+    if result is None:
+        if timed_out:
+            status, output = 'timeout', f'Timed out after {elapsed_time:.1f} s (limit {timeout} s)'
+        elif process.exitcode == -signal.SIGXCPU:
+            status, output = 'cpu_limit', f'CPU time limit exceeded after {elapsed_time:.1f} s (limit {cpu_limit} s)'
+        elif process.exitcode == -signal.SIGKILL:
+            status, output = 'out_of_memory', f'Killed after {elapsed_time:.1f} s, most likely out of memory (limit {memory_limit} MB)'
+        else:
+            status, output = 'crashed', f'Test process crashed after {elapsed_time:.1f} s (exit code {process.exitcode})'
+        result = {'score': 0.0, 'output': output, 'sandbox': {'status': status, 'elapsed_time': round(elapsed_time, 3)},
+                  'profile': {'wall_time': round(elapsed_time, 4)}}
+    elif result['sandbox']['status'] == 'out_of_memory':
+        result['output'] = (f"Out of memory after {result['sandbox']['elapsed_time']:.1f} s / "
+                            f"{result['sandbox']['peak_memory_mb']:.0f} MB (limit {memory_limit} MB)\n" + result['output'])
+    return result
 
-                result = {
-                    'score': 0.0,
-                    'output': output,
-                }
+
+# Decorator to catch errors of a grader function
+def grader(action, name=None, max_score=None, sandbox=None, timeout=None):
+    """
+    sandbox: run the test in a child process with the TIMEOUT, CPU_LIMIT and MEMORY_LIMIT limits.
+    None follows the module-level SANDBOX and PARALLEL settings.
+    timeout: wall-clock limit for this test when sandboxed, instead of TIMEOUT.
+    """
+
+    def decorator(test_func):
+
+        # functools.wraps keeps the undecorated test reachable as wrapper.__wrapped__
+        @functools.wraps(test_func)
+        def wrapper(*args, **kwargs):
+            
+            if SANDBOX if sandbox is None else sandbox:
+                result = run_sandboxed(test_func, args, kwargs, timeout=TIMEOUT if timeout is None else timeout,
+                                       cpu_limit=CPU_LIMIT, memory_limit=MEMORY_LIMIT)
+            elif sandbox is None and PARALLEL == 'process':
+                # No limits, but still a separate process so pure-Python submissions run in parallel
+                result = run_sandboxed(test_func, args, kwargs)
+            else:
+                result = run_test(test_func, args, kwargs)
 
             if name is not None:
                 result['name'] = name
@@ -135,4 +415,53 @@ def grader(action, name=None, max_score=None):
         
         return wrapper
     
-    return decorator
\ No newline at end of file
+    return decorator
+
+
+# Module constants a test reads go into its source_hash by value
+_HASHED_CONSTANTS = (bool, int, float, str, bytes, tuple, list, dict, range, type(None))
+
+
+def source_hash(func):
+    """
+    sha256 of a function's source (with its decorators) and of every function of its module it uses,
+    recursively, together with the values of the module constants they read. It changes whenever
+    something that can change the function's behavior is edited, and only then.
+    Globals that a function of the module assigns (state such as a timing, not configuration) are left out.
+    """
+    func = inspect.unwrap(func)  # a grader wrapper's globals are this module's, not the test's
+    module_globals = func.__globals__
+    assigned = {instruction.argval for value in list(module_globals.values())
+                if inspect.isfunction(value) and value.__module__ == func.__module__
+                for instruction in dis.get_instructions(value) if instruction.opname == 'STORE_GLOBAL'}
+    seen, parts = set(), []
+    stack = [func]
+    while stack:
+        current = stack.pop()
+        if current in seen:
+            continue
+        seen.add(current)
+        parts.append(inspect.getsource(current))
+        codes = [current.__code__]
+        while codes:
+            code = codes.pop()
+            codes.extend(const for const in code.co_consts if inspect.iscode(const))
+            for name in code.co_names:
+                value = module_globals.get(name)
+                if inspect.isfunction(value) and value.__module__ == func.__module__:
+                    stack.append(inspect.unwrap(value))
+                elif isinstance(value, _HASHED_CONSTANTS) and name not in assigned:
+                    parts.append(f'{name} = {value!r}')
+    return hashlib.sha256('\n'.join(sorted(set(parts))).encode('utf-8')).hexdigest()
+
+
+def run_tests(tests, *args):
+    """
+    Run independent grader tests and return their results in the order of `tests`.
+    With PARALLEL set, the tests are dispatched to a pool of WORKERS threads; in 'process' mode
+    each of those threads waits on a forked child, so the total time approaches the slowest test.
+    """
+    if not PARALLEL:
+        return [test(*args) for test in tests]
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        return list(pool.map(lambda test: test(*args), tests))
@@ -0,0 +1,122 @@
+"""
+Benchmark utils.to_py (single tokenizer pass) against the previous stacked-regex version
+on a large synthetic notebook: the cleaning alone on the same cells, then the whole conversion
+including reading the notebook.
+
+Usage:
+    python benchmark_to_py.py [--cells 400] [--repeats 5]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+from utils import clean_cell, to_py  # noqa: E402
+
+CELL = '''# AUTOGRADED
+def function_{i}(Input, kernel_size, stride=None, padding=0):
+    """
+    Average pooling, cell {i}.
+    """
+    # unpack the arguments
+    X_k, Y_k = to_tuple(kernel_size)
+    s_x, s_y = to_tuple(kernel_size if stride is None else stride)
+    label = "cell #{i}"  # a '#' inside a string
+
+    print("pooling", label)
+    output = []
+    for c in range(Input.shape[0]):
+        row = [Input[c, x:x + X_k, y:y + Y_k].mean() for x in range(0, Input.shape[1], s_x) for y in range(0, Input.shape[2], s_y)]
+        output.append(row)
+
+
+    return output
+'''
+
+
+def legacy_clean(cells, imports=""):
+    """The previous cleaning: four regex passes per cell plus two over the whole script."""
+    script_cells = [imports]
+    for cell_source in cells:
+        cell_source = re.sub(r'(\'\'\'.*?\'\'\')|(\"\"\".*?\"\"\")', '', cell_source, flags=re.DOTALL)
+        cell_source = re.sub(r'#.*', '', cell_source)
+        assert not re.search(r'(?<!\w)import(?!\w)', cell_source)
+        script_cells.append(cell_source)
+    script_source = ('\n\n' + 100 * '#' + '\n\n').join(script_cells)
+    script_source = re.sub(r'\n\s*\n', '\n\n', script_source)
+    script_source = re.sub(r'^(\s*)print\s*\((.*)\)\s*$', r'\1pass', script_source, flags=re.MULTILINE)
+    # Grade() counted the for loops with one more regex pass
+    len(re.findall(r"\s*for\s+\w+\s+in\s+", script_source))
+    return script_source
+
+
+def single_pass_clean(cells, imports=""):
+    """The cleaning done by utils.parse_notebook."""
+    script_cells = [imports]
+    for cell_source in cells:
+        cell_source, has_import, num_for_loops = clean_cell(cell_source)
+        assert not has_import
+        script_cells.append(cell_source.strip())
+    return ('\n\n' + 100 * '#' + '\n\n').join(script_cells)
+
+
+def legacy_to_py(notebook_path, script_path, imports=""):
+    """The previous to_py: json.load, then legacy_clean on the autograded cells."""
+    with open(notebook_path, 'r', encoding='utf-8') as f:
+        notebook = json.load(f)
+    cells = [''.join(cell['source']) for cell in notebook['cells']
+             if cell['cell_type'] == 'code' and cell['source'] and cell['source'][0].startswith('# AUTOGRADED')]
+    script_source = legacy_clean(cells, imports)
+    with open(script_path, 'w', encoding='utf-8') as f:
+        f.write(script_source)
+    return script_source
+
+
+def make_notebook(path, num_cells):
+    cells = [{'cell_type': 'code', 'metadata': {}, 'outputs': [], 'source': CELL.format(i=i).splitlines(True)}
+             for i in range(num_cells)]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'cells': cells, 'metadata': {}, 'nbformat': 4, 'nbformat_minor': 5}, f)
+
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cells', type=int, default=400)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    cells = [CELL.format(i=i) for i in range(args.cells)]
+    legacy_clean_time = best_time(lambda: legacy_clean(cells), args.repeats)
+    single_pass_clean_time = best_time(lambda: single_pass_clean(cells), args.repeats)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        notebook_path = os.path.join(tmpdir, 'notebook.ipynb')
+        script_path = os.path.join(tmpdir, 'submission.py')
+        make_notebook(notebook_path, args.cells)
+
+        legacy = best_time(lambda: legacy_to_py(notebook_path, script_path), args.repeats)
+        stats = {}
+        single_pass = best_time(lambda: to_py(notebook_path, script_path, stats=stats), args.repeats)
+
+    print(f'{args.cells} cells, best of {args.repeats}')
+    print('cleaning')
+    print(f'  regex passes:      {legacy_clean_time * 1000:8.1f} ms')
+    print(f'  single token pass: {single_pass_clean_time * 1000:8.1f} ms  '
+          f'({legacy_clean_time / single_pass_clean_time:.2f}x)')
+    print('to_py (json.load vs streaming reader, cleaning, writing the script)')
+    print(f'  regex passes:      {legacy * 1000:8.1f} ms')
+    print(f'  single token pass: {single_pass * 1000:8.1f} ms  ({legacy / single_pass:.2f}x)')
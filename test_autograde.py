@@ -0,0 +1,225 @@
+"""
+Tests for grading with autograde.py: per-test result reuse from REUSE_DIR, the opt-in performance test, and the
+batched reference outputs against the per-config references.
+
+Run with: python -m pytest test_autograde.py
+"""
+
+import os
+import sys
+import json
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+import autograde
+from fixtures import FixtureStore, fixture_key
+
+CONV2D = '''# AUTOGRADED
+def conv2d(Input, Kernel, Bias, stride=1, padding=0, dilation=1, groups=1):
+    s_x, s_y = to_tuple(stride)
+    p_x, p_y = to_tuple(padding)
+    d_x, d_y = to_tuple(dilation)
+    c_out, c_group, X_k, Y_k = Kernel.shape
+    Input = np.pad(Input, ((0, 0), (p_x, p_x), (p_y, p_y)))
+    X_out = (Input.shape[1] - d_x * (X_k - 1) - 1) // s_x + 1
+    Y_out = (Input.shape[2] - d_y * (Y_k - 1) - 1) // s_y + 1
+    out = np.zeros((c_out, X_out, Y_out), dtype=np.float32)
+    K = Kernel.reshape(groups, c_out // groups, c_group * X_k * Y_k)
+    for x in range(X_out):
+        for y in range(Y_out):
+            patch = Input[:, x*s_x:x*s_x + d_x*(X_k-1)+1:d_x, y*s_y:y*s_y + d_y*(Y_k-1)+1:d_y]
+            out[:, x, y] = np.einsum('gok,gk->go', K, patch.reshape(groups, -1)).reshape(c_out)
+    return out + Bias[:, None, None]
+'''
+
+AVG_POOL2D = '''# AUTOGRADED
+def avg_pool2d(Input, kernel_size, stride=None, padding=0):
+    X_k, Y_k = to_tuple(kernel_size)
+    s_x, s_y = to_tuple(kernel_size if stride is None else stride)
+    p_x, p_y = to_tuple(padding)
+    Input = np.pad(Input, ((0, 0), (p_x, p_x), (p_y, p_y)))
+    return np.lib.stride_tricks.sliding_window_view(Input, (X_k, Y_k), axis=(1, 2))[:, ::s_x, ::s_y].mean(axis=(-2, -1))
+'''
+
+# A conv2d that fails on every test, quoting its own line in the traceback
+BROKEN_CONV2D = '''# AUTOGRADED
+def conv2d(Input, Kernel, Bias, stride=1, padding=0, dilation=1, groups=1):
+    alice_secret = Input @ Kernel  # alice's comment
+    return alice_secret
+'''
+
+
+def make_student(tmp_path, name, *cells):
+    autograder_dir = tmp_path / name
+    os.makedirs(autograder_dir / 'submission')
+    os.makedirs(autograder_dir / 'source')
+    os.makedirs(autograder_dir / 'results')
+    notebook = {'cells': [{'cell_type': 'code', 'source': cell.splitlines(True)} for cell in cells]}
+    with open(autograder_dir / 'submission' / 'hw.ipynb', 'w', encoding='utf-8') as f:
+        json.dump(notebook, f)
+    return str(autograder_dir)
+
+
+@pytest.fixture
+def reuse_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(autograde, 'REUSE_DIR', str(tmp_path / 'reuse'))
+    return autograde.REUSE_DIR
+
+
+def scores(results):
+    return {test['name']: test['score'] for test in results['tests']}
+
+
+def test_failures_are_not_shared_between_submissions(tmp_path, reuse_dir):
+    alice = make_student(tmp_path, 'alice', BROKEN_CONV2D, AVG_POOL2D)
+    bob = make_student(tmp_path, 'bob', BROKEN_CONV2D.replace('alice_secret', 'bob_value').replace(
+        "  # alice's comment", ''), AVG_POOL2D)
+
+    alice_results = autograde.Grade(alice)
+    bob_results = autograde.Grade(bob)
+    # Same code up to a local name and a comment: the fingerprints match
+    assert alice_results['fingerprint'] == bob_results['fingerprint']
+    assert 'alice_secret' in json.dumps(alice_results['tests'])
+
+    # The passed test is shared, the failed ones are run again on bob's own code
+    assert bob_results['reuse'] == {'reused': 1, 'graded': 5, 'hit_rate': round(1 / 6, 3)}
+    assert scores(bob_results) == scores(alice_results)
+    bob_output = json.dumps(bob_results['tests'])
+    assert 'alice' not in bob_output
+    assert 'bob_value = Input @ Kernel' in bob_output
+
+
+def test_resubmission_reuses_every_test(tmp_path, reuse_dir):
+    first = autograde.Grade(make_student(tmp_path, 'first', BROKEN_CONV2D, AVG_POOL2D))
+    again = autograde.Grade(make_student(tmp_path, 'again', BROKEN_CONV2D, AVG_POOL2D))
+    assert again['reuse'] == {'reused': 6, 'graded': 0, 'hit_rate': 1.0}
+    assert again['tests'] == first['tests']
+
+
+def test_passed_tests_are_shared(tmp_path, reuse_dir):
+    autograde.Grade(make_student(tmp_path, 'alice', CONV2D, AVG_POOL2D))
+    # Every local renamed (out, X_out, c_out, patch): same fingerprint
+    renamed = CONV2D.replace('out', 'result').replace('patch', 'window')
+    results = autograde.Grade(make_student(tmp_path, 'bob', renamed, AVG_POOL2D))
+    assert results['reuse']['reused'] == 6
+    assert sum(scores(results).values()) == 100
+
+
+
+
+def test_config_change_misses_the_store(tmp_path, reuse_dir, monkeypatch):
+    student = make_student(tmp_path, 'alice', CONV2D, AVG_POOL2D)
+    first = autograde.Grade(student)
+    assert first['reuse']['graded'] == 6
+    assert autograde.Grade(student)['reuse'] == {'reused': 6, 'graded': 0, 'hit_rate': 1.0}
+
+    # Other seeds or limits: the stored results were not produced under them, so every test runs again
+    monkeypatch.setattr(autograde, 'SEEDS', range(1, 4))
+    results = autograde.Grade(student)
+    assert results['reuse'] == {'reused': 0, 'graded': 6, 'hit_rate': 0.0}
+    assert scores(results) == scores(first)
+    monkeypatch.setattr(autograde.utils, 'TIMEOUT', autograde.utils.TIMEOUT + 1)
+    assert autograde.Grade(student)['reuse']['reused'] == 0
+    # Back to the first configuration: its results are still stored
+    monkeypatch.setattr(autograde, 'SEEDS', range(3))
+    monkeypatch.setattr(autograde.utils, 'TIMEOUT', autograde.utils.TIMEOUT - 1)
+    assert autograde.Grade(student)['reuse']['reused'] == 6
+
+def test_performance_test_is_opt_in(tmp_path, monkeypatch):
+    assert autograde.PERF_MODE == 'off'
+
+    def not_run(submission):
+        raise AssertionError('the performance test ran with PERF_MODE off')
+
+    benchmark = autograde.test_performance
+    monkeypatch.setattr(autograde, 'test_performance', not_run)
+    results = autograde.Grade(make_student(tmp_path, 'off', CONV2D, AVG_POOL2D))
+    assert 'performance' not in scores(results) and 'performance' not in results['phases']
+
+    # Enabled: the loops of CONV2D run at the speed of the baseline, so full credit
+    monkeypatch.setattr(autograde, 'test_performance', benchmark)
+    monkeypatch.setattr(autograde, 'PERF_TIME_CAP', 2.0)
+    for mode, max_score, score in [('award', autograde.PERF_POINTS, autograde.PERF_POINTS), ('deduct', 0, 0)]:
+        monkeypatch.setattr(autograde, 'PERF_MODE', mode)
+        results = autograde.Grade(make_student(tmp_path, mode, CONV2D, AVG_POOL2D))
+        [performance] = [test for test in results['tests'] if test['name'] == 'performance']
+        assert (performance['score'], performance['max_score']) == (score, max_score), performance['output']
+        assert 'conv2d:' in performance['output'] and 'avg_pool2d:' in performance['output']
+
+
+def test_perf_score(monkeypatch):
+    monkeypatch.setattr(autograde, 'PERF_MODE', 'award')
+    assert [autograde.perf_score(ratio) for ratio in (0.1, 20.0, 89.4, 400.0, float('inf'))] == [10, 10, 5, 0, 0]
+    monkeypatch.setattr(autograde, 'PERF_MODE', 'deduct')
+    assert [autograde.perf_score(ratio) for ratio in (0.1, 20.0, 89.4, 400.0, float('inf'))] == [0, 0, -5, -10, -10]
+
+# Every combination the batched call has to keep apart: groups, and int or tuple stride, padding and dilation
+MIXED_CONV2D_CONFIGS = [
+    {'c_in': 3, 'c_out': 4, 'X_in': 9, 'Y_in': 7, 'X_k': 3, 'Y_k': 2, 'stride': 1, 'padding': 0, 'dilation': 1,
+     'groups': 1},
+    {'c_in': 4, 'c_out': 6, 'X_in': 10, 'Y_in': 11, 'X_k': 3, 'Y_k': 3, 'stride': (2, 1), 'padding': (1, 2),
+     'dilation': 1, 'groups': 2},
+    {'c_in': 6, 'c_out': 6, 'X_in': 12, 'Y_in': 9, 'X_k': 2, 'Y_k': 3, 'stride': 3, 'padding': 2,
+     'dilation': (2, 1), 'groups': 3},
+    {'c_in': 4, 'c_out': 8, 'X_in': 8, 'Y_in': 8, 'X_k': 1, 'Y_k': 1, 'stride': 2, 'padding': 0, 'dilation': 2,
+     'groups': 4},
+]
+MIXED_POOL_CONFIGS = [
+    {'c': 3, 'X_in': 9, 'Y_in': 7, 'X_k': 2, 'Y_k': 3, 'stride': None, 'padding': 0},
+    {'c': 2, 'X_in': 10, 'Y_in': 10, 'X_k': 4, 'Y_k': 3, 'stride': (2, 1), 'padding': (1, 0)},
+]
+
+
+def conv2d_params(config):
+    return config['stride'], config['padding'], config['dilation'], config['groups']
+
+
+def pool_params(config):
+    return (config['X_k'], config['Y_k']), config['stride'], config['padding']
+
+
+@pytest.mark.parametrize('config', MIXED_CONV2D_CONFIGS)
+def test_conv2d_batch_matches_per_config_reference(config):
+    cases = [autograde.conv2d_inputs(config, seed) for seed in range(4)]
+    batched = autograde.reference_conv2d_batch(*(np.stack([case[name] for case in cases])
+                                                 for name in ('Input', 'Kernel', 'Bias')), *conv2d_params(config))
+    for case, output in zip(cases, batched):
+        expected = autograde.reference_conv2d(case['Input'], case['Kernel'], case['Bias'], *conv2d_params(config))
+        assert output.shape == expected.shape
+        assert torch.allclose(torch.tensor(output), torch.tensor(expected), atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize('config', MIXED_POOL_CONFIGS)
+def test_avg_pool2d_batch_matches_per_config_reference(config):
+    inputs = np.stack([autograde.pool_inputs(config, seed)['Input'] for seed in range(4)])
+    batched = autograde.reference_avg_pool2d_batch(inputs, *pool_params(config))
+    for Input, output in zip(inputs, batched):
+        expected = autograde.reference_avg_pool2d(Input, *pool_params(config))
+        assert torch.allclose(torch.tensor(output), torch.tensor(expected), atol=1e-6, rtol=1e-6)
+
+
+def test_prepared_references_match_per_config_reference(tmp_path, monkeypatch):
+    monkeypatch.setattr(autograde, 'FIXTURES', FixtureStore(str(tmp_path / 'fixtures')))
+    planned = autograde.plan_configs(autograde.TESTS)
+    # The tests check conv2d and avg_pool2d in configs that differ in every parameter, some of them twice
+    assert {op for op, _ in planned} == {'conv2d', 'avg_pool2d'}
+    assert len({conv2d_params(config) for op, config in planned if op == 'conv2d'}) >= 4
+    num_configs = autograde.prepare_references(autograde.TESTS)
+    assert num_configs == len({(op, json.dumps(config, sort_keys=True)) for op, config in planned})
+
+    for op, config in planned:
+        for seed in autograde.SEEDS:
+            case = autograde.FIXTURES.get(fixture_key(op, config, seed))
+            if op == 'conv2d':
+                inputs = autograde.conv2d_inputs(config, seed)
+                expected = autograde.reference_conv2d(inputs['Input'], inputs['Kernel'], inputs['Bias'],
+                                                      *conv2d_params(config))
+            else:
+                inputs = autograde.pool_inputs(config, seed)
+                expected = autograde.reference_avg_pool2d(inputs['Input'], *pool_params(config))
+            assert all(np.array_equal(case[name], inputs[name]) for name in inputs)
+            assert torch.allclose(torch.tensor(np.array(case['Output'])), torch.tensor(expected),
+                                  atol=1e-5, rtol=1e-5), (op, config, seed)
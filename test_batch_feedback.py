@@ -0,0 +1,126 @@
+"""
+Tests for the clustering in batch_feedback.py: submissions whose failures differ only in line numbers, values
+or quoted strings get the same error signature and share one request, and merge_responses fans the response
+to that request out to every member of the cluster.
+
+Run with: python -m pytest test_batch_feedback.py
+"""
+
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+import ai_feedback
+import batch_feedback
+from batch_feedback import error_signature, cluster_signatures, prepare_batch, merge_responses
+
+
+def traceback(function, code_line, exception):
+    # As the grader writes it: the function and the line of student code, then the exception
+    return f'in {function}:\n    {code_line}\n' + '-' * 50 + f'\n{exception}'
+
+
+def conv2d_shape_error(size, line):
+    return traceback('conv2d', f'out[:, x] = np.einsum(Kernel, Input[:, x:x + {line}])',
+                     f"ValueError: operands could not be broadcast together with shapes ({size},{size + 1}) "
+                     f"('{chr(97 + size % 26)}')")
+
+
+def graded(conv2d_output='', pool_output=''):
+    return [{'name': 'simple convolution', 'score': 0 if conv2d_output else 10, 'max_score': 10,
+             'output': conv2d_output},
+            {'name': 'average pooling', 'score': 0 if pool_output else 10, 'max_score': 10, 'output': pool_output}]
+
+
+POOL_ERROR = traceback('avg_pool2d', 'return windows.mean(axis=(-2, -1))',
+                       'AssertionError: Tensor-likes are not close!')
+
+
+def test_signature_ignores_line_numbers_values_and_strings():
+    first, description = error_signature(graded(conv2d_shape_error(3, 7)))
+    assert error_signature(graded(conv2d_shape_error(12, 41)))[0] == first
+    assert description == ['simple convolution: ValueError: operands could not be broadcast together with '
+                           'shapes (#,#) (STR)']
+    # The code line the grader quotes is not part of the signature either
+    other_line = traceback('conv2d', 'out = np.zeros((3, 3))', conv2d_shape_error(5, 2).splitlines()[-1])
+    assert error_signature(graded(other_line))[0] == first
+
+    assert error_signature(graded(pool_output=POOL_ERROR))[0] != first
+    assert error_signature(graded(conv2d_shape_error(3, 7), POOL_ERROR))[0] > first
+    assert error_signature(graded()) == (set(), [])
+
+
+def test_similar_signatures_cluster_together():
+    signatures = [error_signature(graded(conv2d_shape_error(3, 7)))[0],
+                  error_signature(graded(pool_output=POOL_ERROR))[0],
+                  error_signature(graded(conv2d_shape_error(8, 11)))[0],
+                  error_signature(graded(conv2d_shape_error(3, 7), POOL_ERROR))[0],
+                  error_signature(graded(pool_output=POOL_ERROR.replace('(-2, -1)', '(1, 2)')))[0]]
+    assert cluster_signatures(signatures, 1.0) == [[0, 2], [1, 4], [3]]
+    # Failing both tests shares the conv2d words with the first cluster: a low threshold lets it join
+    assert cluster_signatures(signatures, 0.5) == [[0, 2, 3], [1, 4]]
+    assert cluster_signatures(signatures, 0.0) == [[0, 1, 2, 3, 4]]
+
+
+@pytest.fixture
+def submissions(monkeypatch, tmp_path):
+    monkeypatch.setattr(ai_feedback, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(ai_feedback, '_cache_size', None)
+    submissions_dir = tmp_path / 'submissions'
+    students = {'student_a': graded(conv2d_shape_error(3, 7)),
+                'student_b': graded(conv2d_shape_error(4, 9)),
+                'student_c': graded(conv2d_shape_error(16, 12)),
+                'student_d': graded(pool_output=POOL_ERROR),
+                'student_e': graded(pool_output=POOL_ERROR.replace('(-2, -1)', '(1, 2)'))}
+    for i, (student, student_tests) in enumerate(students.items()):
+        student_dir = submissions_dir / student
+        for folder in ('submission', 'results', 'source'):
+            (student_dir / folder).mkdir(parents=True)
+        (student_dir / 'source' / 'submission.py').write_text(f'def conv2d(Input, Kernel):\n    return {i}\n')
+        (student_dir / 'results' / 'results.json').write_text(json.dumps({'tests': student_tests, 'output': ''}))
+    return submissions_dir
+
+
+def response(custom_id, content, status_code=200):
+    return {'custom_id': custom_id, 'error': None, 'response': {'status_code': status_code, 'body': {
+        'choices': [{'message': {'content': json.dumps(content)}}],
+        'usage': {'prompt_tokens': 900, 'completion_tokens': 100}}}}
+
+
+def test_responses_fan_out_to_every_member(submissions):
+    batch_path, clusters_path = submissions / 'feedback_batch.jsonl', submissions / 'feedback_clusters.json'
+    assert prepare_batch(str(submissions), str(batch_path), str(clusters_path), threshold=1.0) == 2
+    requests = [json.loads(line) for line in batch_path.read_text().splitlines()]
+    assert [request['custom_id'] for request in requests] == ['student_a', 'student_d']
+    clusters = json.loads(clusters_path.read_text())['clusters']
+    assert [cluster['members'] for cluster in clusters] == [['student_a', 'student_b', 'student_c'],
+                                                            ['student_d', 'student_e']]
+
+    conv2d_feedback = {'overall': 'Check the output shape.', 'tests': {'simple convolution': 'Pad first.'}}
+    output_path = submissions / 'feedback_output.jsonl'
+    output_path.write_text('\n'.join(json.dumps(item) for item in [
+        response('student_a', conv2d_feedback), response('student_d', {}, status_code=500)]) + '\n')
+    assert merge_responses(str(submissions), str(output_path), str(clusters_path)) == (3, 1)
+
+    for student in ('student_a', 'student_b', 'student_c'):
+        results = batch_feedback.load_results(str(submissions / student))
+        assert 'Check the output shape.' in results['output']
+        assert 'Pad first.' in results['tests'][0]['output']
+        # Billed once, to the representative
+        assert results['metrics']['prompt_tokens'] == (900 if student == 'student_a' else 0)
+    for student in ('student_d', 'student_e'):
+        assert not batch_feedback.has_feedback(batch_feedback.load_results(str(submissions / student)))
+
+    # Only the representative's own code and results are cached
+    cached = [batch_feedback.cache_get(ai_feedback.feedback_cache_key(
+        ai_feedback.summarize_tests({'tests': summaries}), ai_feedback.get_student_code(str(submissions / student))))
+        for student, summaries in [('student_a', graded(conv2d_shape_error(3, 7))),
+                                  ('student_b', graded(conv2d_shape_error(4, 9)))]]
+    assert cached[0]['overall'] == 'Check the output shape.' and cached[1] is None
+
+    # Merging again does not add the feedback twice
+    assert merge_responses(str(submissions), str(output_path), str(clusters_path)) == (0, 1)
+    assert batch_feedback.load_results(str(submissions / 'student_b'))['output'].count('=== AI FEEDBACK ===') == 1
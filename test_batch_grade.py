@@ -0,0 +1,71 @@
+"""
+Tests for batch_grade.py: a submission that fails in any way, including by calling exit(), is recorded
+as that student's failure and the rest of the cohort is still graded and summarized.
+
+Run with: python -m pytest test_batch_grade.py
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+AUTOGRADER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback')
+
+SOLUTION = '''# AUTOGRADED
+def conv2d(Input, Kernel, Bias, stride=1, padding=0, dilation=1, groups=1):
+    s_x, s_y = to_tuple(stride)
+    p_x, p_y = to_tuple(padding)
+    d_x, d_y = to_tuple(dilation)
+    c_out, c_group, X_k, Y_k = Kernel.shape
+    Input = np.pad(Input, ((0, 0), (p_x, p_x), (p_y, p_y)))
+    X_out = (Input.shape[1] - d_x * (X_k - 1) - 1) // s_x + 1
+    Y_out = (Input.shape[2] - d_y * (Y_k - 1) - 1) // s_y + 1
+    out = np.zeros((c_out, X_out, Y_out), dtype=np.float32)
+    K = Kernel.reshape(groups, c_out // groups, c_group * X_k * Y_k)
+    for x in range(X_out):
+        for y in range(Y_out):
+            patch = Input[:, x*s_x:x*s_x + d_x*(X_k-1)+1:d_x, y*s_y:y*s_y + d_y*(Y_k-1)+1:d_y]
+            out[:, x, y] = np.einsum('gok,gk->go', K, patch.reshape(groups, -1)).reshape(c_out)
+    return out + Bias[:, None, None]
+
+# AUTOGRADED
+def avg_pool2d(Input, kernel_size, stride=None, padding=0):
+    X_k, Y_k = to_tuple(kernel_size)
+    s_x, s_y = to_tuple(kernel_size if stride is None else stride)
+    p_x, p_y = to_tuple(padding)
+    Input = np.pad(Input, ((0, 0), (p_x, p_x), (p_y, p_y)))
+    return np.lib.stride_tricks.sliding_window_view(Input, (X_k, Y_k), axis=(1, 2))[:, ::s_x, ::s_y].mean(axis=(-2, -1))
+'''
+
+
+def write_submission(submissions_dir, student, *cells):
+    os.makedirs(submissions_dir / student / 'submission')
+    notebook = {'cells': [{'cell_type': 'code', 'source': cell.splitlines(True)} for cell in cells]}
+    with open(submissions_dir / student / 'submission' / 'hw.ipynb', 'w', encoding='utf-8') as f:
+        json.dump(notebook, f)
+
+
+def test_exiting_submission_does_not_abort_the_cohort(tmp_path):
+    submissions_dir = tmp_path / 'submissions'
+    write_submission(submissions_dir, 'a_exits_on_import', SOLUTION, '# AUTOGRADED\nraise SystemExit(3)\n')
+    write_submission(submissions_dir, 'b_normal', SOLUTION)
+    write_submission(submissions_dir, 'c_exits_in_test',
+                     SOLUTION.replace('    s_x, s_y = to_tuple(stride)', '    exit(4)', 1))
+
+    process = subprocess.run([sys.executable, os.path.join(AUTOGRADER_DIR, 'batch_grade.py'), str(submissions_dir),
+                              '--workers', '2'], capture_output=True, text=True, timeout=600)
+    assert process.returncode == 0, process.stderr
+
+    with open(submissions_dir / 'summary.json', 'r', encoding='utf-8') as f:
+        summary = json.load(f)
+    students = {student['student']: student for student in summary['students']}
+    assert sorted(students) == ['a_exits_on_import', 'b_normal', 'c_exits_in_test']
+    assert summary['num_submissions'] == 3 and summary['num_failed'] == 2
+
+    assert students['b_normal']['status'] == 'graded'
+    assert students['b_normal']['score'] == students['b_normal']['max_score'] == 100
+    assert students['a_exits_on_import']['status'] == 'failed'
+    assert students['a_exits_on_import']['error'] == 'SystemExit: 3'
+    assert students['c_exits_in_test']['status'] == 'failed'
+    assert students['c_exits_in_test']['error'] == 'SystemExit: 4'
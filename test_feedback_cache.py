@@ -0,0 +1,153 @@
+"""
+Tests for the on-disk AI feedback cache in ai_feedback.py: feedback is only reused for the same student code,
+never for another student's code with the same AST fingerprint, and eviction neither lists the whole cache on
+every put nor deletes the circuit breaker's state.
+
+Run with: python -m pytest test_feedback_cache.py
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+import ai_feedback
+from fingerprint import ast_fingerprint
+
+ALICE_CODE = 'def conv2d(Input, Kernel):\n    alice_secret = Input @ Kernel  # my trick\n    return alice_secret\n'
+BOB_CODE = 'def conv2d(Input, Kernel):\n    bob_value = Input @ Kernel\n    return bob_value\n'
+
+RESULTS = {'tests': [{'name': 'simple convolution', 'score': 0, 'max_score': 10,
+                      'output': 'ValueError: matmul: Input operand 1 has a mismatch'}]}
+
+
+class EchoAPI:
+    """A chat completions stub whose feedback quotes the variable the prompt's code assigns, as a model would."""
+
+    def __init__(self):
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                stub.requests += 1
+                name = re.search(r'(\w+) = Input @ Kernel', data['messages'][-1]['content']).group(1)
+                feedback = {'overall': f'`{name} = Input @ Kernel` multiplies the wrong axes.',
+                            'tests': {'simple convolution': f'Fix {name}.'}}
+                body = json.dumps({'choices': [{'message': {'content': json.dumps(feedback)}}],
+                                   'usage': {'prompt_tokens': 100, 'completion_tokens': 20}}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(ai_feedback, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(ai_feedback, 'CIRCUIT_BREAKER', ai_feedback.CircuitBreaker())
+    monkeypatch.setattr(ai_feedback, '_cache_size', None)
+    return ai_feedback.CACHE_DIR
+
+
+@pytest.fixture
+def api(monkeypatch, cache_dir):
+    stub = EchoAPI()
+    monkeypatch.setattr(ai_feedback, 'API_URL', stub.url)
+    monkeypatch.setattr(ai_feedback, 'API_KEY_HERE', 'test-key')
+    monkeypatch.setattr(ai_feedback, 'STREAM_FEEDBACK', False)
+    yield stub
+    stub.close()
+
+
+def feedback_for(code, tmp_path):
+    results = dict(RESULTS, fingerprint=ast_fingerprint(code))
+    results = ai_feedback.enhance_results_with_ai_feedback(json.loads(json.dumps(results)), str(tmp_path),
+                                                          student_code=code)
+    return results['output']
+
+
+def test_same_fingerprint_does_not_share_feedback(api, tmp_path):
+    assert ast_fingerprint(ALICE_CODE) == ast_fingerprint(BOB_CODE)
+    assert ai_feedback.feedback_cache_key(ai_feedback.summarize_tests(RESULTS), ALICE_CODE) != \
+           ai_feedback.feedback_cache_key(ai_feedback.summarize_tests(RESULTS), BOB_CODE)
+
+    alice_output = feedback_for(ALICE_CODE, tmp_path)
+    bob_output = feedback_for(BOB_CODE, tmp_path)
+    assert 'alice_secret' in alice_output
+    assert 'alice' not in bob_output and 'bob_value' in bob_output
+    assert api.requests == 2
+
+
+def test_resubmission_uses_cached_feedback(api, tmp_path):
+    first = feedback_for(ALICE_CODE, tmp_path)
+    # Trailing whitespace and blank lines do not change the code
+    again = feedback_for(ALICE_CODE.replace('\n', '  \n\n'), tmp_path)
+    assert api.requests == 1
+    assert first == again
+
+
+def cached_keys(cache_dir):
+    return {file[:-len('.json')] for _, _, files in os.walk(cache_dir) for file in files
+            if file.endswith('.json') and file != 'circuit.json'}
+
+
+def test_eviction_keeps_circuit_breaker_state(cache_dir, monkeypatch):
+    for _ in range(ai_feedback.CIRCUIT_FAILURES):
+        ai_feedback.CIRCUIT_BREAKER.record_failure()
+    assert not ai_feedback.CIRCUIT_BREAKER.allow()
+    # The breaker's files are older than every entry, so least recently used first would delete them first
+    now = time.time()
+    for file in ('circuit.json', 'circuit.json.lock'):
+        os.utime(os.path.join(cache_dir, file), (now - 3600, now - 3600))
+
+    # Room for about two entries
+    monkeypatch.setattr(ai_feedback, 'CACHE_MAX_MB', 2500 / (1024 * 1024))
+    keys = [f'{i:02x}' * 32 for i in range(10)]
+    for i, key in enumerate(keys):
+        ai_feedback.cache_put(key, {'overall': 'x' * 1000})
+        os.utime(ai_feedback._cache_path(key), (now - 60 + i, now - 60 + i))  # put order, whatever the clock
+    assert keys[-1] in cached_keys(cache_dir) and len(cached_keys(cache_dir)) <= 2
+
+    assert os.path.exists(os.path.join(cache_dir, 'circuit.json'))
+    assert os.path.exists(os.path.join(cache_dir, 'circuit.json.lock'))
+    # Also for a new process, which loads the state from the file
+    assert not ai_feedback.CircuitBreaker().allow()
+
+
+def test_puts_do_not_list_the_cache(cache_dir, monkeypatch):
+    evictions = []
+    evict_cache = ai_feedback.evict_cache
+    monkeypatch.setattr(ai_feedback, 'evict_cache', lambda: evictions.append(1) or evict_cache())
+
+    for i in range(50):
+        ai_feedback.cache_put(f'{i:064x}', {'overall': 'x' * 1000})
+    # Only the first put of the process lists the cache
+    assert len(evictions) == 1 and len(cached_keys(cache_dir)) == 50
+
+    # Then only the put that takes the entries stored since over the limit, which evicts down to 90% of it
+    entry_size = os.path.getsize(ai_feedback._cache_path(f'{0:064x}'))
+    monkeypatch.setattr(ai_feedback, 'CACHE_MAX_MB', 55.5 * entry_size / (1024 * 1024))
+    for i in range(50, 60):
+        ai_feedback.cache_put(f'{i:064x}', {'overall': 'x' * 1000})
+        assert len(evictions) == (1 if i < 55 else 2)
+    assert len(cached_keys(cache_dir)) == 49 + 4
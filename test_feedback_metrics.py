@@ -0,0 +1,81 @@
+"""
+Tests for feedback_metrics.py: aggregate_metrics totals the telemetry that ai_feedback.py writes to each
+results.json (requests, retries, tokens, spend per model, cache hits and skipped calls) and takes its
+latency percentiles over the submissions that have one.
+
+Run with: python -m pytest test_feedback_metrics.py
+"""
+
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+import ai_feedback
+from feedback_metrics import aggregate_metrics, percentile, print_report
+
+
+def request(model, prompt_tokens, completion_tokens, latency, status=200, retries=0, estimated=False):
+    return {'model': model, 'status': status, 'latency': latency, 'ttfb': latency / 2,
+            'time_to_first_token': None, 'retries': retries, 'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens, 'estimated_tokens': estimated,
+            'cost_usd': ai_feedback.request_cost(model, prompt_tokens, completion_tokens)}
+
+
+def write_results(directory, metrics):
+    os.makedirs(directory / 'results')
+    with open(directory / 'results' / 'results.json', 'w', encoding='utf-8') as f:
+        json.dump({'tests': [], 'metrics': metrics}, f)
+
+
+def test_totals(tmp_path):
+    fast, large = ai_feedback.FAST_MODEL, ai_feedback.MODEL
+    # An escalated submission, one with a retried failure, a cache hit and one whose call was skipped
+    write_results(tmp_path / 'alice', ai_feedback.total_metrics({'cached': False, 'requests': [
+        request(fast, 1000, 200, 1.0), request(large, 1000, 300, 3.0)]}, latency=4.0))
+    write_results(tmp_path / 'bob', ai_feedback.total_metrics({'cached': False, 'requests': [
+        request(large, 2000, 0, 2.0, status=503, retries=2), request('local-model', 500, 100, 1.0, estimated=True)]},
+        latency=6.0))
+    write_results(tmp_path / 'carol', ai_feedback.total_metrics({'cached': True, 'requests': []}, latency=0.01))
+    write_results(tmp_path / 'dave', ai_feedback.total_metrics({'cached': False, 'requests': [],
+                                                                 'skipped': {'circuit_open': 1}}))
+    # Results without metrics (graded before telemetry) or unreadable ones are left out
+    os.makedirs(tmp_path / 'erin' / 'results')
+    (tmp_path / 'erin' / 'results' / 'results.json').write_text('{"tests": [')
+    write_results(tmp_path / 'frank', None)
+
+    summary = aggregate_metrics(str(tmp_path))
+    assert (summary['submissions'], summary['cache_hits']) == (4, 1)
+    assert (summary['requests'], summary['failed_requests'], summary['retries']) == (4, 1, 2)
+    assert (summary['skipped_requests'], summary['skipped']) == (1, {'circuit_open': 1})
+    assert (summary['prompt_tokens'], summary['completion_tokens']) == (4500, 600)
+    assert summary['estimated_token_requests'] == 1
+
+    assert summary['models'][fast] == {'requests': 1, 'prompt_tokens': 1000, 'completion_tokens': 200,
+                                       'cost_usd': ai_feedback.request_cost(fast, 1000, 200)}
+    assert summary['models'][large]['requests'] == 2 and summary['models'][large]['prompt_tokens'] == 3000
+    # The model missing from MODEL_PRICES is counted apart, not as free
+    assert summary['unpriced_requests'] == 1
+    expected_cost = sum(ai_feedback.request_cost(*args) for args in [(fast, 1000, 200), (large, 1000, 300),
+                                                                      (large, 2000, 0)])
+    assert abs(summary['cost_usd'] - expected_cost) < 1e-6 and summary['cost_usd'] > 0
+
+    # Per submission: 0.01, 4 and 6 s (dave's latency is unknown); per request: 1, 1, 2 and 3 s
+    assert (summary['latency_p50'], summary['latency_p95']) == (4.0, 6.0)
+    assert (summary['request_latency_p50'], summary['request_latency_p95']) == (1.0, 3.0)
+    assert (summary['ttfb_p50'], summary['ttfb_p95']) == (0.5, 1.5)
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3.0], 95) == 3.0
+    values = list(range(1, 101))
+    assert [percentile(values, q) for q in (0, 50, 95, 100)] == [1, 50, 95, 100]
+
+
+def test_empty_directory(tmp_path, capsys):
+    summary = aggregate_metrics(str(tmp_path))
+    assert summary['submissions'] == summary['requests'] == 0 and summary['cost_usd'] == 0
+    assert summary['latency_p50'] is None
+    print_report(summary)
+    assert 'Total spend: $0.0000' in capsys.readouterr().out
@@ -0,0 +1,158 @@
+"""
+Tests for the structural fingerprint (autograder_with_ai_feedback/fingerprint.py): submissions that only
+differ in local names, docstrings, annotations or formatting share a fingerprint, and submissions that
+can behave differently do not.
+
+Run with: python -m pytest test_fingerprint.py
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+from fingerprint import ast_fingerprint, ResultStore
+
+BASE = '''
+SCALE = 2
+
+def avg_pool2d(Input, kernel_size, stride=None):
+    X_k, Y_k = kernel_size
+    step = stride or X_k
+    output = []
+    for x in range(0, len(Input), step):
+        row = [sum(Input[x][y:y + Y_k]) / Y_k for y in range(0, len(Input[0]), step)]
+        output.append(row)
+    return output
+
+class Helper:
+    factor = SCALE
+
+    def scaled(self, value):
+        result = value * self.factor
+        return result
+'''
+
+# Same behavior: local names, docstrings, comments, annotations, formatting and constant spelling changed
+EQUIVALENT = '''
+SCALE = 0x2
+
+def avg_pool2d(Input, kernel_size, stride=None) -> list:
+    """Average pooling."""
+    kx, ky = kernel_size  # unpack
+    s = stride or kx
+    out: list = []
+
+
+    for i in range(0, len(Input), s):
+        r = [sum(Input[i][j:j + ky]) / ky for j in range(0, len(Input[0]), s)]
+        out.append(r)
+    return out
+
+class Helper:
+    """Helps."""
+    factor = SCALE
+
+    def scaled(self, value: float) -> float:
+        res = value * self.factor
+        return res
+'''
+
+# Each changes what the code does, or how the tests can call it
+DIFFERENT = {
+    'parameter name': BASE.replace('def avg_pool2d(Input, kernel_size, stride=None)',
+                                   'def avg_pool2d(Input, kernel, stride=None)').replace('= kernel_size', '= kernel'),
+    'function name': BASE.replace('def avg_pool2d', 'def avg_pool'),
+    'default value': BASE.replace('stride=None', 'stride=1'),
+    'constant': BASE.replace('SCALE = 2', 'SCALE = 3'),
+    'operator': BASE.replace('/ Y_k', '// Y_k'),
+    'swapped variables': BASE.replace('X_k, Y_k = kernel_size', 'Y_k, X_k = kernel_size'),
+    'class attribute': BASE.replace('factor = SCALE', 'scale = SCALE').replace('self.factor', 'self.scale'),
+    'extra statement': BASE.replace('    return output', '    output.reverse()\n    return output'),
+}
+
+
+def test_equivalent_code_shares_fingerprint():
+    assert ast_fingerprint(BASE) is not None
+    assert ast_fingerprint(BASE) == ast_fingerprint(EQUIVALENT)
+
+
+@pytest.mark.parametrize('change', sorted(DIFFERENT))
+def test_different_code_has_different_fingerprint(change):
+    assert ast_fingerprint(DIFFERENT[change]) != ast_fingerprint(BASE)
+
+
+def test_equivalent_code_behaves_the_same():
+    # The premise of sharing results: run both and compare
+    results = []
+    for source in (BASE, EQUIVALENT):
+        namespace = {}
+        exec(source, namespace)
+        results.append((namespace['avg_pool2d']([[1, 2, 3, 4]] * 4, (2, 2)), namespace['Helper']().scaled(5)))
+    assert results[0] == results[1]
+
+
+def test_globals_are_not_renamed():
+    # `total` is the module's in the first and a local in the second
+    uses_global = 'total = 0\ndef add(x):\n    global total\n    total = total + x\n    return total\n'
+    uses_local = 'total = 0\ndef add(x):\n    result = 0\n    result = result + x\n    return result\n'
+    assert ast_fingerprint(uses_global) != ast_fingerprint(uses_local)
+    reads_global = 'limit = 3\ndef f(x):\n    return min(x, limit)\n'
+    assert ast_fingerprint(reads_global) != ast_fingerprint(reads_global.replace('limit', 'cap'))
+
+
+def test_nested_functions_and_closures():
+    a = 'def outer(x):\n    y = x + 1\n    def inner(z):\n        nonlocal y\n        y += z\n        return y\n    return inner\n'
+    b = 'def outer(x):\n    q = x + 1\n    def inner(z):\n        nonlocal q\n        q += z\n        return q\n    return inner\n'
+    assert ast_fingerprint(a) == ast_fingerprint(b)
+    # Parameters of the inner function shadow the outer locals
+    c = 'def outer(x):\n    y = 1\n    def inner(y):\n        return y\n    return inner(x) + y\n'
+    d = 'def outer(x):\n    w = 1\n    def inner(y):\n        return y\n    return inner(x) + w\n'
+    e = 'def outer(x):\n    w = 1\n    def inner(y):\n        return w\n    return inner(x) + w\n'
+    assert ast_fingerprint(c) == ast_fingerprint(d)
+    assert ast_fingerprint(d) != ast_fingerprint(e)
+
+
+def test_global_in_nested_function_is_the_module_name():
+    # inner's `y` is the module's, not outer's local `y`
+    a = 'y = 0\ndef outer(x):\n    y = x\n    def inner():\n        global y\n        y = 5\n    inner()\n    return y\n'
+    b = 'y = 0\ndef outer(x):\n    y = x\n    def inner():\n        nonlocal y\n        y = 5\n    inner()\n    return y\n'
+    c = 'y = 0\ndef outer(x):\n    w = x\n    def inner():\n        global y\n        y = 5\n    inner()\n    return w\n'
+    assert ast_fingerprint(a) != ast_fingerprint(b)
+    assert ast_fingerprint(a) == ast_fingerprint(c)
+
+
+def test_other_binding_forms_are_renamed():
+    a = ('def f(items):\n    try:\n        total = sum(v for v in items)\n    except TypeError as error:\n'
+         '        total = str(error)\n    key = lambda item: item\n    with open("x") as handle:\n        pass\n'
+         '    return total, key\n')
+    b = ('def f(items):\n    try:\n        acc = sum(w for w in items)\n    except TypeError as e:\n'
+         '        acc = str(e)\n    k = lambda item: item\n    with open("x") as fh:\n        pass\n'
+         '    return acc, k\n')
+    assert ast_fingerprint(a) == ast_fingerprint(b)
+
+
+def test_prints_turned_into_pass_compare_equal():
+    # to_py replaces print statements with pass
+    assert ast_fingerprint('def f(x):\n    pass\n    return x\n') == ast_fingerprint('def f(x):\n    return x\n')
+
+
+def test_syntax_error_has_no_fingerprint():
+    assert ast_fingerprint('def f(:\n') is None
+
+
+def test_result_store_round_trip(tmp_path):
+    store = ResultStore(str(tmp_path / 'store'))
+    key = ast_fingerprint(BASE)
+    assert store.get(key) is None
+    value = {'name': 'average pooling', 'score': 10, 'max_score': 10, 'output': 'é'}
+    store.put(key, value)
+    assert store.get(key) == value
+    store.put(key, dict(value, score=5))
+    assert store.get(key)['score'] == 5
+    # A damaged entry reads as missing instead of failing the grading run
+    with open(store._file(key), 'w', encoding='utf-8') as f:
+        f.write('{"truncated": ')
+    assert store.get(key) is None
+    assert not [name for name in os.listdir(os.path.dirname(store._file(key))) if name.endswith('.tmp')]
@@ -0,0 +1,89 @@
+"""
+Tests for the golden fixture store (fixtures.py): saved cases come back identical from the memory map, and a
+store written by another FIXTURES_VERSION is ignored and rebuilt instead of serving stale references.
+
+Run with: python -m pytest test_fixtures.py
+"""
+
+import os
+import sys
+import json
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+import autograde
+import fixtures
+from fixtures import FixtureStore, fixture_key
+
+CONFIG = {'c_in': 2, 'c_out': 3, 'X_in': 6, 'Y_in': 5, 'X_k': 3, 'Y_k': 2,
+          'stride': 1, 'padding': 1, 'dilation': 1, 'groups': 1}
+
+
+def case(seed):
+    rng = np.random.RandomState(seed)
+    return {'Input': rng.randn(2, 6, 5).astype(np.float32), 'Bias': rng.randn(3).astype(np.float32)}
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'fixtures')
+    store = FixtureStore(path)
+    assert store.get(fixture_key('conv2d', CONFIG, 0)) is None
+    for seed in range(3):
+        store.add(fixture_key('conv2d', CONFIG, seed), case(seed))
+    assert store.save() == 3
+
+    loaded = FixtureStore(path)
+    assert isinstance(loaded.data, np.memmap) and loaded.cases == {}
+    for seed in range(3):
+        arrays = loaded.get(fixture_key('conv2d', CONFIG, seed))
+        assert arrays.keys() == {'Input', 'Bias'}
+        for name, array in case(seed).items():
+            assert arrays[name].dtype == np.float32 and np.array_equal(arrays[name], array)
+            assert not arrays[name].flags.writeable
+
+    # Saving again keeps the stored cases next to the new ones, while the old memory map stays readable
+    loaded.add(fixture_key('avg_pool2d', CONFIG, 0), {'Input': np.ones((1, 2, 2))})
+    assert loaded.save() == 4
+    assert np.array_equal(loaded.get(fixture_key('conv2d', CONFIG, 2))['Input'], case(2)['Input'])
+    reloaded = FixtureStore(path)
+    assert np.array_equal(reloaded.get(fixture_key('avg_pool2d', CONFIG, 0))['Input'], np.ones((1, 2, 2)))
+    assert np.array_equal(reloaded.get(fixture_key('conv2d', CONFIG, 1))['Bias'], case(1)['Bias'])
+
+
+def test_key_depends_on_op_config_and_seed():
+    key = fixture_key('conv2d', CONFIG, 0)
+    assert fixture_key('conv2d', dict(reversed(CONFIG.items())), 0) == key
+    assert len({key, fixture_key('avg_pool2d', CONFIG, 0), fixture_key('conv2d', CONFIG, 1),
+                fixture_key('conv2d', dict(CONFIG, stride=2), 0)}) == 4
+
+
+def test_stale_store_is_rebuilt(tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / 'fixtures')
+    monkeypatch.setattr(autograde, 'FIXTURES', FixtureStore(path))
+    expected = autograde.conv2d_cases(CONFIG, [0, 1])
+    autograde.FIXTURES.save()
+    # A store written with wrong references by an older version of the generator
+    old = FixtureStore(path)
+    for seed in (0, 1):
+        wrong = np.zeros_like(expected[seed]['Output'])
+        old.add(fixture_key('conv2d', CONFIG, seed), dict(expected[seed], Output=wrong))
+    old.save()
+
+    monkeypatch.setattr(fixtures, 'FIXTURES_VERSION', fixtures.FIXTURES_VERSION + 1)
+    store = FixtureStore(path)
+    assert 'ignoring' in capsys.readouterr().out
+    assert store.index == {} and store.data is None
+    monkeypatch.setattr(autograde, 'FIXTURES', store)
+    rebuilt = autograde.conv2d_cases(CONFIG, [0, 1])
+    assert len(store.cases) == 2
+    for old_case, new_case in zip(expected, rebuilt):
+        assert np.array_equal(old_case['Output'], new_case['Output'])
+
+    assert store.save() == 2
+    with open(path + '.json', 'r', encoding='utf-8') as f:
+        saved = json.load(f)
+    assert saved['version'] == fixtures.FIXTURES_VERSION
+    assert all(key.startswith(f'v{fixtures.FIXTURES_VERSION}/') for key in saved['index'])
+    reloaded = FixtureStore(path)
+    assert np.array_equal(reloaded.get(fixture_key('conv2d', CONFIG, 1))['Output'], expected[1]['Output'])
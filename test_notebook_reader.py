@@ -0,0 +1,151 @@
+"""
+Tests for the streaming notebook reader (autograder_with_ai_feedback/notebook_reader.py):
+iter_code_cells must yield exactly the code cells json.load sees, whatever the chunk boundaries.
+
+Run with: python -m pytest test_notebook_reader.py
+"""
+
+import os
+import sys
+import json
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+from notebook_reader import iter_code_cells
+
+# Small chunks put every escape, quote and bracket on a chunk boundary somewhere
+CHUNK_SIZES = [1, 2, 3, 7, 64, 1 << 20]
+
+TRICKY_STRINGS = [
+    '', '"', '\\', '\\"', '"\\', '}]', '{"cells": []}', '\n', '\t\r\n', 'é', '😀', '\u2028', '\x00', 'a' * 300,
+]
+
+
+def reference_code_cells(notebook_path):
+    with open(notebook_path, 'r', encoding='utf-8') as f:
+        notebook = json.load(f)
+    cells = []
+    for cell in notebook.get('cells', []):
+        if cell.get('cell_type') == 'code':
+            source = cell.get('source', [])
+            cells.append(source.splitlines(keepends=True) if isinstance(source, str) else source)
+    return cells
+
+
+def write_notebook(tmp_path, notebook, **dump_options):
+    path = tmp_path / 'notebook.ipynb'
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(notebook, f, **dump_options)
+    return str(path)
+
+
+def check_against_json_load(path):
+    expected = reference_code_cells(path)
+    for chunk_size in CHUNK_SIZES:
+        assert list(iter_code_cells(path, chunk_size=chunk_size)) == expected, f'chunk_size={chunk_size}'
+
+
+def code_cell(source, outputs=None):
+    return {'cell_type': 'code', 'execution_count': 1, 'metadata': {'tags': ['x']}, 'outputs': outputs or [],
+            'source': source}
+
+
+def test_typical_notebook(tmp_path):
+    notebook = {
+        'cells': [
+            {'cell_type': 'markdown', 'metadata': {}, 'source': ['# Title\n', 'Some "quoted" text']},
+            code_cell(['# AUTOGRADED\n', 'def f(x):\n', '    return x + 1']),
+            code_cell(['print("hi")'], outputs=[
+                {'output_type': 'stream', 'name': 'stdout', 'text': ['hi\n']},
+                {'output_type': 'display_data', 'data': {'image/png': 'iVBORw0KGgo' * 1000}, 'metadata': {}},
+            ]),
+            {'cell_type': 'raw', 'metadata': {}, 'source': 'raw "cell" {with} [brackets]'},
+        ],
+        'metadata': {'kernelspec': {'name': 'python3'}},
+        'nbformat': 4,
+        'nbformat_minor': 5,
+    }
+    for dump_options in ({'indent': 1}, {}, {'ensure_ascii': False}, {'separators': (',', ':')}):
+        check_against_json_load(write_notebook(tmp_path, notebook, **dump_options))
+
+
+@pytest.mark.parametrize('text', TRICKY_STRINGS)
+def test_tricky_strings(tmp_path, text):
+    notebook = {
+        'metadata': {'note': text, 'list': [text, {'k': text}]},
+        'cells': [
+            code_cell([text, 'x = 1\n', text], outputs=[{'output_type': 'stream', 'text': [text, ']}"']}]),
+            {'cell_type': 'markdown', 'source': [text]},
+            code_cell(text),
+        ],
+    }
+    for ensure_ascii in (True, False):
+        check_against_json_load(write_notebook(tmp_path, notebook, indent=1, ensure_ascii=ensure_ascii))
+
+
+def test_string_source_and_missing_fields(tmp_path):
+    notebook = {'cells': [
+        {'cell_type': 'code', 'source': 'a = 1\nb = 2\n'},
+        {'cell_type': 'code'},
+        {'source': ['x'], 'cell_type': 'code'},  # source before cell_type
+        {'source': ['not code'], 'cell_type': 'markdown'},
+        {},
+    ]}
+    check_against_json_load(write_notebook(tmp_path, notebook, indent=1))
+
+
+def test_empty_notebooks(tmp_path):
+    for notebook in ({}, {'cells': []}, {'metadata': {'a': [1, 2, {'b': None}]}, 'nbformat': 4}):
+        path = write_notebook(tmp_path, notebook, indent=1)
+        assert list(iter_code_cells(path, chunk_size=1)) == reference_code_cells(path)
+
+
+def test_scalars(tmp_path):
+    notebook = {'nbformat': 4, 'flag': True, 'nothing': None, 'ratio': -1.5e-3,
+                'cells': [dict(code_cell(['y = 2']), execution_count=None, trusted=False)], 'after': 12345}
+    check_against_json_load(write_notebook(tmp_path, notebook, indent=1))
+    check_against_json_load(write_notebook(tmp_path, notebook, separators=(',', ':')))
+
+
+def test_random_notebooks(tmp_path):
+    rng = random.Random(0)
+    alphabet = 'ab "\\{}[]:,\n\té😀'
+
+    def random_text():
+        return ''.join(rng.choice(alphabet) for _ in range(rng.randrange(0, 20)))
+
+    def random_value(depth=0):
+        kind = rng.randrange(6 if depth < 3 else 4)
+        if kind == 0:
+            return random_text()
+        if kind == 1:
+            return rng.choice([None, True, False, rng.randrange(-1000, 1000), rng.random()])
+        if kind in (2, 3):
+            return [random_text() for _ in range(rng.randrange(3))]
+        if kind == 4:
+            return [random_value(depth + 1) for _ in range(rng.randrange(3))]
+        return {random_text(): random_value(depth + 1) for _ in range(rng.randrange(3))}
+
+    for _ in range(50):
+        cells = []
+        for _ in range(rng.randrange(6)):
+            cell = {'cell_type': rng.choice(['code', 'code', 'markdown', 'raw']),
+                    'metadata': random_value(), 'source': [random_text() for _ in range(rng.randrange(4))]}
+            if rng.random() < 0.5:
+                cell['outputs'] = [random_value() for _ in range(rng.randrange(3))]
+            cells.append(cell)
+        notebook = {'metadata': random_value(), 'cells': cells, 'nbformat': 4}
+        check_against_json_load(write_notebook(tmp_path, notebook, indent=rng.choice([None, 1]),
+                                               ensure_ascii=rng.random() < 0.5))
+
+
+def test_truncated_notebook(tmp_path):
+    path = write_notebook(tmp_path, {'cells': [code_cell(['x = 1'])]}, indent=1)
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text[:len(text) // 2])
+    with pytest.raises(ValueError):
+        list(iter_code_cells(path, chunk_size=3))
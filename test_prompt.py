@@ -0,0 +1,98 @@
+"""
+Tests for the token-budgeted prompt in ai_feedback.py: select_relevant_code never goes over its budget,
+keeps the functions the failing tests point at before anything else, and keeps the code in its original order.
+
+Run with: python -m pytest test_prompt.py
+"""
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+import ai_feedback
+from ai_feedback import select_relevant_code, count_tokens
+
+CONV2D = '''def conv2d(Input, Kernel, Bias, stride=1, padding=0, dilation=1, groups=1):
+    Input = pad_input(Input, padding)
+    out = np.zeros(output_shape(Input, Kernel, stride, dilation))
+    for x in range(out.shape[1]):
+        out[:, x] = np.einsum('okl,ckl->o', Kernel, Input[:, x:x + Kernel.shape[2]])
+    return out + Bias[:, None, None]
+'''
+PAD_INPUT = '''def pad_input(Input, padding):
+    p_x, p_y = to_tuple(padding)
+    return np.pad(Input, ((0, 0), (p_x, p_x), (p_y, p_y)))
+'''
+AVG_POOL2D = '''def avg_pool2d(Input, kernel_size, stride=None, padding=0):
+    X_k, Y_k = to_tuple(kernel_size)
+    windows = sliding_window_view(pad_input(Input, padding), (X_k, Y_k), axis=(1, 2))
+    return windows.mean(axis=(-2, -1))
+'''
+
+
+def unrelated(i, lines=8):
+    return f'def helper_{i}(values):\n' + ''.join(f'    values = values + {j}  # step {j}\n'
+                                                  for j in range(lines)) + '    return values\n'
+
+
+def failing_conv2d():
+    return [{'name': 'simple convolution', 'score': 0, 'max_score': 10,
+             'output': 'in conv2d:\n    out[:, x] = np.einsum(...)\n--------\nValueError: operands could not be broadcast'},
+            {'name': 'average pooling', 'score': 10, 'max_score': 10, 'output': ''}]
+
+
+def test_code_within_budget_is_unchanged():
+    code = CONV2D + '\n' + AVG_POOL2D
+    assert select_relevant_code(code, failing_conv2d(), count_tokens(code)) == code
+
+
+def test_failing_function_is_kept_first():
+    code = '\n'.join([unrelated(0), AVG_POOL2D, unrelated(1), PAD_INPUT, CONV2D, unrelated(2)])
+    budget = count_tokens(CONV2D) + count_tokens(PAD_INPUT) + 60
+    selected = select_relevant_code(code, failing_conv2d(), budget)
+    assert count_tokens(selected) <= budget
+    # The function in the traceback, then the helper it calls; the rest is listed as omitted
+    assert CONV2D.strip() in selected and PAD_INPUT.strip() in selected
+    assert selected.index('def pad_input') < selected.index('def conv2d')
+    assert 'def avg_pool2d' not in selected and 'def helper_' not in selected
+    assert selected.endswith('# [Omitted for brevity: helper_0, avg_pool2d, helper_1, helper_2]')
+
+    # A budget for the failing function only
+    selected = select_relevant_code(code, failing_conv2d(), count_tokens(CONV2D) + 45)
+    assert CONV2D.strip() in selected and 'def pad_input' not in selected
+
+
+def test_test_name_ranks_functions_without_a_traceback():
+    code = '\n'.join([unrelated(0), CONV2D, AVG_POOL2D])
+    tests = [{'name': 'average pooling', 'score': 0, 'max_score': 10, 'output': 'AssertionError: Tensor-likes are not close!'}]
+    selected = select_relevant_code(code, tests, count_tokens(AVG_POOL2D) + 45)
+    assert AVG_POOL2D.strip() in selected and 'def conv2d' not in selected
+
+
+def test_budget_is_never_exceeded():
+    rng = random.Random(0)
+    for _ in range(200):
+        regions = [unrelated(i, rng.randrange(1, 30)) for i in range(rng.randrange(1, 30))]
+        regions.insert(rng.randrange(len(regions) + 1), CONV2D)
+        regions.insert(rng.randrange(len(regions) + 1), f'STEPS = {rng.randrange(100)}\n')
+        code = '\n'.join(regions)
+        budget = rng.randrange(50, count_tokens(code) + 50)
+        selected = select_relevant_code(code, failing_conv2d(), budget)
+        assert count_tokens(selected) <= budget, (len(regions), budget)
+
+
+def test_region_larger_than_budget_is_truncated():
+    code = CONV2D.replace('    return out', ''.join(f'    out = out * {i}\n' for i in range(200)) + '    return out')
+    code += '\n' + AVG_POOL2D
+    selected = select_relevant_code(code, failing_conv2d(), 100)
+    assert count_tokens(selected) <= 100
+    assert selected.startswith('def conv2d(') and '...' in selected and 'avg_pool2d' in selected.splitlines()[-1]
+
+
+def test_prompt_stays_within_budget(monkeypatch):
+    monkeypatch.setattr(ai_feedback, 'PROMPT_TOKEN_BUDGET', 600)
+    code = '\n'.join([CONV2D, AVG_POOL2D] + [unrelated(i, 20) for i in range(40)])
+    prompt = ai_feedback.create_feedback_prompt(failing_conv2d(), code)
+    assert count_tokens(prompt) <= 600
+    assert CONV2D.strip() in prompt and 'def helper_39' not in prompt
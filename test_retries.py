@@ -0,0 +1,218 @@
+"""
+Tests for the API retries and the circuit breaker in ai_feedback.py, against a stub HTTP server that
+answers with scripted statuses (429 with Retry-After, 5xx, 4xx, 200).
+
+Run with: python -m pytest test_retries.py
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import multiprocessing
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+import ai_feedback
+
+OK_BODY = {'choices': [{'message': {'content': '{"overall": "ok", "tests": {}}'}}],
+           'usage': {'prompt_tokens': 10, 'completion_tokens': 5}}
+
+
+class StubAPI:
+    """An HTTP server answering each POST with the next scripted (status, headers) and counting requests."""
+
+    def __init__(self, delay=0.0):
+        self.script = []
+        self.requests = 0
+        self.delay = delay
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with stub.lock:
+                    stub.requests += 1
+                    status, headers = stub.script.pop(0) if stub.script else (200, {})
+                time.sleep(stub.delay)
+                body = json.dumps(OK_BODY if status == 200 else {'error': {'message': 'scripted'}}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def api(monkeypatch, tmp_path):
+    stub = StubAPI()
+    monkeypatch.setattr(ai_feedback, 'API_URL', stub.url)
+    monkeypatch.setattr(ai_feedback, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(ai_feedback, 'MAX_RETRIES', 3)
+    monkeypatch.setattr(ai_feedback, 'RETRY_BASE_DELAY', 0.01)
+    monkeypatch.setattr(ai_feedback, 'RETRY_MAX_DELAY', 2.0)
+    monkeypatch.setattr(ai_feedback, 'CIRCUIT_FAILURES', 5)
+    monkeypatch.setattr(ai_feedback, 'CIRCUIT_COOLDOWN', 0.5)
+    monkeypatch.setattr(ai_feedback, 'CIRCUIT_BREAKER', ai_feedback.CircuitBreaker())
+    yield stub
+    stub.close()
+
+
+def post(deadline=None):
+    stats = {}
+    response = ai_feedback.post_with_retries({'Content-Type': 'application/json'},
+                                             {'model': 'm', 'messages': []}, deadline, stats)
+    return response, stats
+
+
+def test_success_first_try(api):
+    response, stats = post()
+    assert response.status_code == 200 and api.requests == 1 and stats['attempts'] == 1
+
+
+def test_rate_limit_honors_retry_after(api):
+    api.script = [(429, {'Retry-After': '0.3'}), (200, {})]
+    start_time = time.time()
+    response, stats = post()
+    assert response.status_code == 200 and api.requests == 2 and stats['attempts'] == 2
+    assert time.time() - start_time >= 0.3
+
+
+def test_server_errors_are_retried(api):
+    api.script = [(500, {}), (502, {}), (503, {}), (200, {})]
+    response, stats = post()
+    assert response.status_code == 200 and api.requests == 4 and stats['status'] == 200
+
+
+def test_gives_up_after_max_retries(api):
+    api.script = [(503, {})] * 10
+    response, stats = post()
+    assert response.status_code == 503 and api.requests == ai_feedback.MAX_RETRIES + 1
+
+
+def test_client_errors_are_not_retried(api):
+    api.script = [(400, {}), (200, {})]
+    response, _ = post()
+    assert response.status_code == 400 and api.requests == 1
+
+
+def test_long_retry_after_gives_up(api):
+    api.script = [(429, {'Retry-After': '60'}), (200, {})]
+    response, _ = post()
+    assert response.status_code == 429 and api.requests == 1
+
+
+def test_retry_after_http_date():
+    assert ai_feedback.parse_retry_after(formatdate(time.time() + 30, usegmt=True)) == pytest.approx(30, abs=2)
+    assert ai_feedback.parse_retry_after('5') == 5
+    assert ai_feedback.parse_retry_after('soon') is None
+    assert ai_feedback.parse_retry_after(None) is None
+
+
+def test_retry_does_not_pass_deadline(api):
+    api.script = [(429, {'Retry-After': '1.5'}), (200, {})]
+    response, _ = post(deadline=time.time() + 1.0)
+    assert response.status_code == 429 and api.requests == 1
+
+
+def test_no_request_after_deadline(api):
+    response, stats = post(deadline=time.time() - 1)
+    assert response is None and api.requests == 0 and stats['skipped'] == 'deadline'
+
+
+def test_connection_errors_are_retried(api, monkeypatch):
+    monkeypatch.setattr(ai_feedback, 'API_URL', 'http://127.0.0.1:9/v1/chat/completions')
+    response, stats = post()
+    assert response is None and stats['attempts'] == ai_feedback.MAX_RETRIES + 1
+
+
+def test_breaker_opens_after_consecutive_failures(api):
+    api.script = [(500, {})] * ai_feedback.CIRCUIT_FAILURES
+    response, _ = post()  # 4 attempts
+    response, stats = post()  # the 5th failure opens the breaker, then no more requests
+    assert api.requests == ai_feedback.CIRCUIT_FAILURES
+    response, stats = post()
+    assert response is None and stats['skipped'] == 'circuit_open' and api.requests == ai_feedback.CIRCUIT_FAILURES
+
+
+def open_breaker():
+    for _ in range(ai_feedback.CIRCUIT_FAILURES):
+        ai_feedback.CIRCUIT_BREAKER.record_failure()
+
+
+def test_half_open_lets_one_probe_through(api):
+    open_breaker()
+    time.sleep(ai_feedback.CIRCUIT_COOLDOWN + 0.1)
+    api.delay = 0.3  # the probe is still in flight while the others ask
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(post()[0])) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert api.requests == 1
+    assert sum(response is not None for response in results) == 1
+    # The probe succeeded: the breaker is closed again
+    api.delay = 0.0
+    assert post()[0].status_code == 200 and api.requests == 2
+
+
+def test_failed_probe_reopens(api):
+    open_breaker()
+    time.sleep(ai_feedback.CIRCUIT_COOLDOWN + 0.1)
+    api.script = [(500, {})] * 10
+    response, stats = post()
+    # The probe failed and reopened the breaker, so it is not retried
+    assert response is None and api.requests == 1 and stats['attempts'] == 1 and 'skipped' not in stats
+    assert post()[0] is None and api.requests == 1
+    time.sleep(ai_feedback.CIRCUIT_COOLDOWN + 0.1)
+    api.script = []
+    assert post()[0].status_code == 200
+
+
+def _claim_probe(cache_dir, cooldown, results):
+    ai_feedback.CACHE_DIR, ai_feedback.CIRCUIT_COOLDOWN = cache_dir, cooldown
+    results.put(ai_feedback.CircuitBreaker().allow())
+
+
+@pytest.mark.skipif(ai_feedback.fcntl is None, reason='file locks need fcntl')
+def test_half_open_probe_is_shared_across_processes(api):
+    open_breaker()
+    time.sleep(ai_feedback.CIRCUIT_COOLDOWN + 0.1)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_claim_probe, args=(ai_feedback.CACHE_DIR, ai_feedback.CIRCUIT_COOLDOWN,
+                                                                    results)) for _ in range(6)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert sum(results.get() for _ in processes) == 1
+
+
+def test_breaker_without_cache_dir(api, monkeypatch):
+    monkeypatch.setattr(ai_feedback, 'CACHE_DIR', '')
+    open_breaker()
+    assert not ai_feedback.CIRCUIT_BREAKER.allow()
+    time.sleep(ai_feedback.CIRCUIT_COOLDOWN + 0.1)
+    assert ai_feedback.CIRCUIT_BREAKER.allow()
+    assert not ai_feedback.CIRCUIT_BREAKER.allow()
+    ai_feedback.CIRCUIT_BREAKER.record_success()
+    assert ai_feedback.CIRCUIT_BREAKER.allow()
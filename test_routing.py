@@ -0,0 +1,114 @@
+"""
+Tests for the model cascade in ai_feedback.py: choose_tier sends submissions that lost points to the large
+MODEL and full-score ones to FULL_SCORE_TIER, and a low-confidence answer from FAST_MODEL (not JSON, no
+overall assessment, or nothing about a failing test) is escalated to MODEL.
+
+Run with: python -m pytest test_routing.py
+"""
+
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+import ai_feedback
+from ai_feedback import choose_tier, is_low_confidence
+
+PASSED = {'name': 'simple convolution', 'score': 10, 'max_score': 10, 'output': ''}
+FAILED = {'name': 'average pooling', 'score': 4, 'max_score': 10, 'output': 'AssertionError: not close'}
+DEDUCTION = {'name': 'for loops', 'score': -5, 'max_score': 0, 'output': ''}
+NO_DEDUCTION = {'name': 'for loops', 'score': 0, 'max_score': 0, 'output': ''}
+
+
+def test_choose_tier(monkeypatch):
+    assert choose_tier([PASSED, NO_DEDUCTION]) == ai_feedback.FULL_SCORE_TIER == 'fast'
+    assert choose_tier([PASSED, FAILED]) == 'large'
+    # A deduction from a test worth 0 points is a lost point too
+    assert choose_tier([PASSED, DEDUCTION]) == 'large'
+    monkeypatch.setattr(ai_feedback, 'FULL_SCORE_TIER', 'none')
+    assert choose_tier([PASSED]) == 'none' and choose_tier([FAILED]) == 'large'
+
+
+def low_confidence(feedback, tests):
+    text = feedback if isinstance(feedback, str) else json.dumps(feedback)
+    return is_low_confidence(text, ai_feedback.parse_feedback_response(text), tests)
+
+
+def test_low_confidence():
+    good = {'overall': 'Well done.', 'tests': {'Average Pooling': 'Divide by the window size.'}}
+    assert not low_confidence(good, [PASSED, FAILED])
+    assert not low_confidence('Sure! Here it is:\n```json\n' + json.dumps(good) + '\n```', [PASSED, FAILED])
+    # Nothing about the passed test is needed
+    assert not low_confidence({'overall': 'Well done.', 'tests': {}}, [PASSED])
+
+    assert low_confidence('Your code looks great!', [PASSED])
+    assert low_confidence('{"overall": "Well done.", "tests": {', [PASSED])
+    assert low_confidence({'overall': '  ', 'tests': {}}, [PASSED])
+    assert low_confidence({'tests': {}}, [PASSED])
+    assert low_confidence({'overall': 'Well done.', 'tests': ['average pooling']}, [PASSED])
+    assert low_confidence({'overall': 'Well done.', 'tests': {'simple convolution': 'Fine.'}}, [PASSED, FAILED])
+
+
+class Models:
+    """Stands in for request_feedback: answers each model with its scripted response text."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def __call__(self, prompt, model, deadline=None, metrics=None):
+        self.calls.append(model)
+        text = self.responses[model]
+        return ai_feedback.parse_feedback_response(text) if text else {}, text, bool(text)
+
+
+@pytest.fixture
+def models(monkeypatch, tmp_path):
+    monkeypatch.setattr(ai_feedback, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(ai_feedback, '_cache_size', None)
+
+    def install(fast, large):
+        stub = Models({ai_feedback.FAST_MODEL: fast, ai_feedback.MODEL: large})
+        monkeypatch.setattr(ai_feedback, 'request_feedback', stub)
+        return stub
+    return install
+
+
+LARGE = json.dumps({'overall': 'From the large model.', 'tests': {'simple convolution': 'Correct.'}})
+
+
+def test_confident_fast_answer_is_kept(models):
+    stub = models(json.dumps({'overall': 'From the fast model.', 'tests': {}}), LARGE)
+    feedback = ai_feedback.generate_feedback({'tests': [PASSED]}, 'def conv2d(): pass')
+    assert stub.calls == [ai_feedback.FAST_MODEL]
+    assert feedback['overall'] == 'From the fast model.'
+    assert feedback['routing'] == {'tier': 'fast', 'model': ai_feedback.FAST_MODEL, 'escalated': False}
+
+
+def test_low_confidence_fast_answer_is_escalated(models):
+    stub = models('I cannot help with that.', LARGE)
+    feedback = ai_feedback.generate_feedback({'tests': [PASSED]}, 'def conv2d(): pass')
+    assert stub.calls == [ai_feedback.FAST_MODEL, ai_feedback.MODEL]
+    assert feedback['overall'] == 'From the large model.'
+    assert feedback['routing'] == {'tier': 'large', 'model': ai_feedback.MODEL, 'escalated': True}
+
+    # The escalated answer is cached: the same submission makes no request
+    stub.calls.clear()
+    assert ai_feedback.generate_feedback({'tests': [PASSED]}, 'def conv2d(): pass')['routing']['cached']
+    assert stub.calls == []
+
+
+def test_failing_submission_goes_straight_to_the_large_model(models):
+    stub = models('I cannot help with that.', LARGE)
+    feedback = ai_feedback.generate_feedback({'tests': [PASSED, FAILED]}, 'def avg_pool2d(): pass')
+    assert stub.calls == [ai_feedback.MODEL]
+    assert feedback['routing'] == {'tier': 'large', 'model': ai_feedback.MODEL, 'escalated': False}
+
+
+def test_failed_escalation_keeps_the_fast_answer(models):
+    stub = models('{"overall": "Fine.", "tests": []}', '')
+    feedback = ai_feedback.generate_feedback({'tests': [PASSED]}, 'def conv2d(): pass')
+    assert stub.calls == [ai_feedback.FAST_MODEL, ai_feedback.MODEL]
+    assert feedback['overall'] == 'Fine.' and feedback['routing']['escalated'] is False
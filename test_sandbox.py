@@ -0,0 +1,107 @@
+"""
+Tests for the sandbox in utils.py (run_sandboxed, `python autograde.py <dir> --sandbox`): a test that exhausts
+memory, spins the CPU, sleeps past its timeout, segfaults or exits scores 0 with a message saying what
+happened, and the grader carries on with the next test.
+
+Run with: python -m pytest test_sandbox.py
+"""
+
+import os
+import sys
+import time
+import ctypes
+import faulthandler
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+import utils
+
+pytestmark = pytest.mark.skipif(utils.resource is None or sys.platform == 'win32',
+                                reason='the sandbox forks and sets resource limits (Linux/macOS only)')
+
+
+@utils.grader('testing a memory bomb', name='memory bomb', max_score=10)
+def memory_bomb(submission):
+    blocks = []
+    while True:
+        blocks.append(bytearray(16 * 2**20))
+
+
+@utils.grader('testing a CPU spin', name='cpu spin', max_score=10)
+def cpu_spin(submission):
+    while True:
+        pass
+
+
+@utils.grader('testing a sleep', name='sleep', max_score=10, timeout=1)
+def sleep(submission):
+    time.sleep(60)
+    return {'score': 10}
+
+
+@utils.grader('testing a segfault', name='segfault', max_score=10)
+def segfault(submission):
+    faulthandler.disable()  # pytest's traceback dump on SIGSEGV, in the child only
+    ctypes.string_at(0)
+
+
+@utils.grader('testing exit()', name='exit', max_score=10)
+def exits(submission):
+    sys.exit(3)
+
+
+@utils.grader('testing a correct submission', name='correct', max_score=10)
+def correct(submission):
+    assert submission == 'submission'
+    return {'score': 10}
+
+
+@pytest.fixture
+def sandbox(monkeypatch):
+    monkeypatch.setattr(utils, 'SANDBOX', True)
+    monkeypatch.setattr(utils, 'TIMEOUT', 20)
+    monkeypatch.setattr(utils, 'CPU_LIMIT', 1)
+    monkeypatch.setattr(utils, 'MEMORY_LIMIT', 256)
+
+
+def test_failures_are_contained(sandbox):
+    start_time = time.time()
+    results = utils.run_tests([memory_bomb, cpu_spin, sleep, segfault, exits, correct], 'submission')
+    assert time.time() - start_time < 20
+    results = {result['name']: result for result in results}
+    for name in ('memory bomb', 'cpu spin', 'sleep', 'segfault', 'exit'):
+        assert results[name]['score'] == 0 and results[name]['max_score'] == 10, name
+    assert results['correct']['score'] == 10 and results['correct']['sandbox']['status'] == 'ok'
+
+    assert results['memory bomb']['sandbox']['status'] == 'out_of_memory'
+    assert results['memory bomb']['output'].startswith('Out of memory after')
+    assert 'MemoryError' in results['memory bomb']['output']
+
+    assert results['cpu spin']['sandbox']['status'] == 'cpu_limit'
+    assert results['cpu spin']['output'].startswith('CPU time limit exceeded') and '(limit 1 s)' in \
+           results['cpu spin']['output']
+
+    assert results['sleep']['sandbox']['status'] == 'timeout'
+    assert results['sleep']['output'].startswith('Timed out after') and '(limit 1 s)' in results['sleep']['output']
+
+    assert results['segfault']['sandbox']['status'] == 'crashed'
+    assert results['segfault']['output'].startswith('Test process crashed') and '(exit code -11)' in \
+           results['segfault']['output']
+
+    assert results['exit']['output'] == 'SystemExit: 3'
+
+
+def test_parallel_processes_contain_failures(sandbox, monkeypatch):
+    monkeypatch.setattr(utils, 'PARALLEL', 'process')
+    results = utils.run_tests([segfault, memory_bomb, correct, cpu_spin], 'submission')
+    assert [result['score'] for result in results] == [0, 0, 10, 0]
+    assert [result['sandbox']['status'] for result in results] == ['crashed', 'out_of_memory', 'ok', 'cpu_limit']
+
+
+def test_run_sandboxed_without_limits():
+    # PARALLEL = 'process' without SANDBOX: a crash is still contained in its child
+    result = utils.run_sandboxed(segfault.__wrapped__, ('submission',), {})
+    assert result['score'] == 0 and result['sandbox']['status'] == 'crashed'
+    result = utils.run_sandboxed(correct.__wrapped__, ('submission',), {})
+    assert result['score'] == 10 and result['sandbox']['status'] == 'ok'
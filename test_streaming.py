@@ -0,0 +1,147 @@
+"""
+Tests for the streamed (SSE) responses in ai_feedback.py, against a stub HTTP server that writes scripted
+events: read_streamed_feedback must assemble the text from chunks split anywhere, close the stream at the
+deadline while the server is still generating, and stop at a malformed event, keeping what arrived before.
+
+Run with: python -m pytest test_streaming.py
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autograder_with_ai_feedback'))
+import ai_feedback
+
+FEEDBACK = {'overall': 'Good work overall.',
+            'tests': {'simple convolution': 'Añade el sesgo 😀 after the sum.', 'avg_pool2d': 'Correct.'}}
+USAGE = {'prompt_tokens': 120, 'completion_tokens': 30}
+
+
+def event(payload):
+    return f'data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n'.encode()
+
+
+def delta(content):
+    return event({'choices': [{'index': 0, 'delta': {'content': content}}]})
+
+
+def split_text(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class StreamingAPI:
+    """An HTTP server answering each POST with a text/event-stream of scripted writes; a number is a pause."""
+
+    def __init__(self):
+        self.script = []
+        self.requests = []
+        self.stop = threading.Event()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                stub.requests.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                try:
+                    for item in stub.script:
+                        if isinstance(item, (int, float)):
+                            if stub.stop.wait(item):
+                                return
+                            continue
+                        self.wfile.write(item)
+                        self.wfile.flush()
+                except OSError:
+                    pass  # the client closed the stream
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.stop.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def api(monkeypatch, tmp_path):
+    stub = StreamingAPI()
+    monkeypatch.setattr(ai_feedback, 'API_URL', stub.url)
+    monkeypatch.setattr(ai_feedback, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(ai_feedback, 'CIRCUIT_BREAKER', ai_feedback.CircuitBreaker())
+    monkeypatch.setattr(ai_feedback, 'STREAM_FEEDBACK', True)
+    yield stub
+    stub.close()
+
+
+def request(deadline=None):
+    metrics = {'requests': []}
+    feedback, text, complete = ai_feedback.request_feedback('prompt', ai_feedback.MODEL, deadline, metrics)
+    return feedback, text, complete, metrics
+
+
+def test_chunks_are_assembled(api):
+    text = json.dumps(FEEDBACK, ensure_ascii=False)
+    stream = b''.join([b': keep-alive\n\n', b'event: message\n'] + [delta(part) for part in split_text(text, 5)]
+                      + [event({'choices': [], 'usage': USAGE}), event('[DONE]')])
+    # Written a few bytes at a time: events, lines and multi-byte characters are split across reads
+    api.script = [stream[i:i + 7] for i in range(0, len(stream), 7)]
+
+    feedback, feedback_text, complete, metrics = request()
+    assert api.requests[0]['stream'] is True and api.requests[0]['stream_options'] == {'include_usage': True}
+    assert complete and feedback_text == text
+    assert feedback['overall'] == FEEDBACK['overall'] and feedback['tests'] == FEEDBACK['tests']
+    [stats] = metrics['requests']
+    assert (stats['prompt_tokens'], stats['completion_tokens']) == (120, 30)
+
+
+def test_read_streamed_feedback_records_usage_and_first_token(api):
+    api.script = [delta('{"overall": '), delta('"ok"}'), event({'choices': [], 'usage': USAGE}), event('[DONE]')]
+    response = ai_feedback.get_session().post(api.url, json={'stream': True}, stream=True, timeout=5)
+    stats = {}
+    assert ai_feedback.read_streamed_feedback(response, stats=stats) == ('{"overall": "ok"}', True)
+    assert stats['usage'] == USAGE and stats['first_token_time'] <= time.time()
+
+
+def test_deadline_cuts_off_the_stream(api):
+    text = json.dumps(FEEDBACK, ensure_ascii=False)
+    cut = text.index('"simple convolution"')
+    # The first part arrives at once, then the server keeps the stream open as if still generating
+    api.script = [delta(part) for part in split_text(text[:cut], 8)] + [30.0] + \
+                 [delta(text[cut:]), event('[DONE]')]
+
+    start_time = time.time()
+    feedback, feedback_text, complete, metrics = request(deadline=start_time + 1.0)
+    assert time.time() - start_time < 5
+    assert not complete and feedback_text == text[:cut]
+    # The complete pairs are kept
+    assert feedback == {'overall': FEEDBACK['overall'], 'tests': {}}
+    # No usage block arrived: the tokens are estimated from the text
+    assert metrics['requests'][0]['estimated_tokens']
+
+
+def test_malformed_event_ends_the_stream(api, capsys):
+    api.script = [delta('{"overall": "Good work overall.", '), event('{"choices": [{"delta": {"content": "tru'),
+                  delta('"tests": {}}'), event('[DONE]')]
+
+    feedback, feedback_text, complete, _ = request()
+    assert not complete and feedback_text == '{"overall": "Good work overall.", '
+    assert feedback == {'overall': 'Good work overall.', 'tests': {}}
+    assert 'AI Feedback Stream Error' in capsys.readouterr().out
+
+
+def test_stream_closed_before_done(api):
+    api.script = [delta('{"overall": "Good'), delta(' work."')]
+    _, feedback_text, complete, _ = request()
+    assert not complete and feedback_text == '{"overall": "Good work."'
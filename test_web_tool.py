@@ -0,0 +1,212 @@
+"""
+Tests for the web_tool job queue and artifact store (web_tool/app.py), through the Flask test client:
+a job goes from queued to running to done (or failed) on the bounded worker pool, a bundle uploaded again
+is served from the store without being reprocessed, and identical uploads arriving together share one job.
+
+Run with: python -m pytest test_web_tool.py
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import zipfile
+import threading
+
+import pytest
+
+WEB_TOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web_tool')
+GENERATED_EXISTED = os.path.isdir(os.path.join(WEB_TOOL_DIR, 'generated'))
+sys.path.insert(0, WEB_TOOL_DIR)
+import app
+
+JSON = {'Accept': 'application/json'}
+ArtifactStore = app.ArtifactStore
+
+
+@pytest.fixture(scope='module', autouse=True)
+def remove_generated_dir():
+    # Importing app creates web_tool/generated
+    yield
+    if not GENERATED_EXISTED:
+        shutil.rmtree(app.GENERATED_DIR, ignore_errors=True)
+
+
+def bundle(name='bundle', utils=True):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        if utils:
+            zf.writestr(f'{name}/utils.py', 'import json\n\ndef save_results(results, autograder_dir):\n    pass\n')
+        zf.writestr(f'{name}/autograde.py', f'# {name}\n' + 'import utils\n' * 100)
+    return buffer.getvalue()
+
+
+class Gate:
+    """Stands in for stream_zip_with_ai: counts the bundles processed and holds them until opened."""
+
+    def __init__(self, stream_zip_with_ai):
+        self.stream_zip_with_ai = stream_zip_with_ai
+        self.opened = threading.Event()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, src, dst, progress=None):
+        with self.lock:
+            self.calls += 1
+        assert self.opened.wait(20)
+        self.stream_zip_with_ai(src, dst, progress=progress)
+
+
+@pytest.fixture
+def gate(monkeypatch):
+    gate = Gate(app.stream_zip_with_ai)
+    monkeypatch.setattr(app, 'stream_zip_with_ai', gate)
+    yield gate
+    gate.opened.set()  # lets the workers of a failed test finish
+
+
+@pytest.fixture
+def store_dir(monkeypatch, tmp_path):
+    directory = tmp_path / 'generated'
+    directory.mkdir()
+    # create_app stores bundles in GENERATED_DIR: use a temporary directory instead
+    monkeypatch.setattr(app, 'ArtifactStore', lambda: ArtifactStore(directory))
+    return directory
+
+
+@pytest.fixture
+def client(store_dir, gate):
+    return app.create_app().test_client()
+
+
+def upload(client, data, filename='bundle.zip'):
+    return client.post('/process', data={'bundle': (io.BytesIO(data), filename)}, headers=JSON)
+
+
+def wait_for(client, job_id, statuses=('done', 'failed')):
+    for _ in range(400):
+        status = client.get(f'/status/{job_id}').get_json()
+        if status['status'] in statuses:
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f'job {job_id} still {status}')
+
+
+def test_job_lifecycle(client, gate, store_dir):
+    uploads = [bundle(f'bundle{i}') for i in range(3)]
+    job_ids = []
+    for data in uploads:
+        response = upload(client, data)
+        assert response.status_code == 202
+        body = response.get_json()
+        assert body['status_url'] == f"/status/{body['job_id']}"
+        assert body['download_url'] == f"/download/{body['job_id']}"
+        job_ids.append(body['job_id'])
+    assert len(set(job_ids)) == 3
+
+    # Two workers: two jobs are running, the third waits in the queue
+    wait_for(client, job_ids[1], statuses=('running',))
+    statuses = [client.get(f'/status/{job_id}').get_json() for job_id in job_ids]
+    assert [status['status'] for status in statuses] == ['running', 'running', 'queued']
+    assert all(status['progress'] == 0.0 and 'download_url' not in status for status in statuses)
+    # Not downloadable yet
+    assert client.get(f'/download/{job_ids[0]}').status_code == 302
+
+    gate.opened.set()
+    for job_id, data in zip(job_ids, uploads):
+        status = wait_for(client, job_id)
+        assert status == {'job_id': job_id, 'status': 'done', 'progress': 1.0, 'error': None, 'cached': False,
+                          'download_url': f'/download/{job_id}'}
+        response = client.get(status['download_url'])
+        assert response.status_code == 200 and response.mimetype == 'application/zip'
+        assert response.data == app.make_zip_with_ai(data)
+    assert sorted(path.name for path in store_dir.iterdir()) == sorted(f'{job_id}.zip' for job_id in job_ids)
+
+
+def test_failed_job(client, gate, store_dir):
+    gate.opened.set()
+    job_id = upload(client, bundle(utils=False)).get_json()['job_id']
+    status = wait_for(client, job_id)
+    assert status['status'] == 'failed' and status['error'] == 'Could not find utils.py in the uploaded zip.'
+    assert 'download_url' not in status
+    assert client.get(f'/download/{job_id}').status_code == 302
+    assert list(store_dir.iterdir()) == []  # no bundle, not even a .part
+
+
+def test_bad_uploads(client):
+    assert upload(client, bundle(), filename='bundle.tar').status_code == 400
+    assert client.get('/status/unknown').status_code == 404
+
+
+def test_same_bundle_is_not_processed_again(client, gate, store_dir, monkeypatch, tmp_path):
+    gate.opened.set()
+    data = bundle()
+    job_id = upload(client, data).get_json()['job_id']
+    assert wait_for(client, job_id)['cached'] is False
+    downloaded = client.get(f'/download/{job_id}').data
+
+    # The same bytes under another name: done at once, from the store
+    response = upload(client, data, filename='copy.zip')
+    assert response.get_json()['job_id'] == job_id
+    status = client.get(f'/status/{job_id}').get_json()
+    assert status['status'] == 'done' and status['cached'] is True
+    assert client.get(f'/download/{job_id}').data == downloaded
+    assert gate.calls == 1
+
+    # A different bundle, or the same one with another ai_feedback.py, is processed
+    other_job_id = upload(client, bundle('other')).get_json()['job_id']
+    assert other_job_id != job_id
+    wait_for(client, other_job_id)
+    ai_feedback = tmp_path / 'ai_feedback.py'
+    ai_feedback.write_bytes(app.AI_FEEDBACK_PATH.read_bytes() + b'\n# changed\n')
+    monkeypatch.setattr(app, 'AI_FEEDBACK_PATH', ai_feedback)
+    new_job_id = upload(client, data).get_json()['job_id']
+    assert new_job_id != job_id
+    wait_for(client, new_job_id)
+    assert gate.calls == 3
+    assert len(list(store_dir.iterdir())) == 3
+
+
+def test_concurrent_identical_uploads_share_one_job(client, gate, store_dir):
+    data = bundle()
+    barrier = threading.Barrier(8)
+    responses = []
+
+    def post():
+        test_client = client.application.test_client()
+        barrier.wait()
+        responses.append(upload(test_client, data))
+
+    threads = [threading.Thread(target=post) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [response.status_code for response in responses] == [202] * 8
+    job_ids = {response.get_json()['job_id'] for response in responses}
+    assert len(job_ids) == 1
+    job_id = job_ids.pop()
+    gate.opened.set()
+    assert wait_for(client, job_id)['status'] == 'done'
+    assert gate.calls == 1
+    assert [path.name for path in store_dir.iterdir()] == [f'{job_id}.zip']
+
+
+def test_queue_full(tmp_path):
+    gate = Gate(app.stream_zip_with_ai)
+    jobs = app.JobQueue(ArtifactStore(tmp_path), workers=1, max_pending=2)
+    try:
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            monkeypatch.setattr(app, 'stream_zip_with_ai', gate)
+            for i in range(2):
+                jobs.submit(io.BytesIO(bundle(f'b{i}')), f'{i:064x}')
+            with pytest.raises(app.QueueFull):
+                jobs.submit(io.BytesIO(bundle('b2')), f'{2:064x}')
+            # A duplicate of a pending job joins it instead of being turned away
+            assert jobs.submit(io.BytesIO(bundle('b0')), f'{0:064x}') == jobs.store.key(f'{0:064x}')
+            gate.opened.set()
+            jobs.executor.shutdown(wait=True)
+    finally:
+        gate.opened.set()
@@ -0,0 +1,195 @@
+"""
+Tests for the streaming bundle rewrite in web_tool/app.py: stream_zip_with_ai copies every entry's compressed
+bytes through copy_zip_entry, so the output must read back with zipfile to the same contents as the upload,
+apart from the rewritten utils.py and the added ai_feedback.py.
+
+Run with: python -m pytest test_zip_bundle.py
+"""
+
+import io
+import os
+import sys
+import shutil
+import random
+import struct
+import zipfile
+
+import pytest
+
+WEB_TOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web_tool')
+GENERATED_EXISTED = os.path.isdir(os.path.join(WEB_TOOL_DIR, 'generated'))
+sys.path.insert(0, WEB_TOOL_DIR)
+import app
+
+UTILS_PY = 'import json\n\ndef save_results(results, autograder_dir):\n    print(results)\n'
+
+
+@pytest.fixture(scope='module', autouse=True)
+def remove_generated_dir():
+    # Importing app creates web_tool/generated
+    yield
+    if not GENERATED_EXISTED:
+        shutil.rmtree(app.GENERATED_DIR, ignore_errors=True)
+
+
+class Unseekable(io.RawIOBase):
+    """A write-only stream without seek or tell, so ZipFile writes data descriptors after each entry."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def entries():
+    rng = random.Random(0)
+    return {
+        'bundle/utils.py': UTILS_PY.encode(),
+        'bundle/ai_feedback.py': b'# an old version, replaced\n',
+        'bundle/autograde.py': b'import utils\n' * 200,
+        'bundle/tests/utils.py': b'# not the root utils.py, copied as is\n',
+        'bundle/fixtures/weights.bin': bytes(rng.randrange(256) for _ in range(300000)),
+        'bundle/fixtures/zeros.bin': bytes(100000),
+        'bundle/empty.txt': b'',
+        'bundle/élève/notes.txt': 'café'.encode(),
+    }
+
+
+def write_bundle(target, compression_for, directories=True, force_zip64=False):
+    with zipfile.ZipFile(target, 'w') as zf:
+        if directories:
+            zf.mkdir('bundle/')
+            zf.mkdir('bundle/fixtures/')
+        for name, data in entries().items():
+            info = zipfile.ZipInfo(name, (2024, 1, 2, 3, 4, 6))
+            info.compress_type = compression_for(name)
+            info.external_attr = 0o644 << 16
+            if force_zip64:
+                with zf.open(info, 'w', force_zip64=True) as f:
+                    f.write(data)
+            else:
+                zf.writestr(info, data)
+
+
+def bundle_bytes(compression_for, **options):
+    buffer = io.BytesIO()
+    write_bundle(buffer, compression_for, **options)
+    return buffer.getvalue()
+
+
+def check_round_trip(upload):
+    progress = []
+    out = io.BytesIO()
+    app.stream_zip_with_ai(io.BytesIO(upload), out, progress=progress.append)
+
+    with zipfile.ZipFile(io.BytesIO(upload)) as src_zip, zipfile.ZipFile(out) as out_zip:
+        assert out_zip.testzip() is None
+        src_infos = {info.filename: info for info in src_zip.infolist()}
+        out_infos = {info.filename: info for info in out_zip.infolist()}
+        assert set(out_infos) == set(src_infos)
+        for name, info in src_infos.items():
+            if name in ('bundle/utils.py', 'bundle/ai_feedback.py'):
+                continue
+            out_info = out_infos[name]
+            assert out_zip.read(name) == src_zip.read(name), name
+            # Copied through, not recompressed
+            assert (out_info.compress_type, out_info.compress_size, out_info.CRC) == \
+                   (info.compress_type, info.compress_size, info.CRC), name
+            assert (out_info.date_time, out_info.external_attr, out_info.is_dir()) == \
+                   (info.date_time, info.external_attr, info.is_dir()), name
+            assert not out_info.flag_bits & 0x08, name
+
+        utils_text = out_zip.read('bundle/utils.py').decode()
+        assert utils_text == app.ensure_import_and_call_in_utils(UTILS_PY) and utils_text != UTILS_PY
+        assert out_zip.read('bundle/ai_feedback.py') == app.AI_FEEDBACK_PATH.read_bytes()
+
+    assert progress == sorted(progress) and progress[-1] == 1.0
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2,
+                                         zipfile.ZIP_LZMA])
+def test_round_trip(compression):
+    check_round_trip(bundle_bytes(lambda name: compression))
+
+
+def test_mixed_compression():
+    check_round_trip(bundle_bytes(
+        lambda name: zipfile.ZIP_STORED if name.endswith('.bin') else zipfile.ZIP_DEFLATED))
+
+
+def test_data_descriptors():
+    # Entries written to an unseekable stream have their CRC and sizes after the data instead of in the header
+    stream = Unseekable()
+    write_bundle(stream, lambda name: zipfile.ZIP_DEFLATED)
+    upload = stream.buffer.getvalue()
+    with zipfile.ZipFile(io.BytesIO(upload)) as zf:
+        assert all(info.flag_bits & 0x08 for info in zf.infolist() if not info.is_dir())
+    check_round_trip(upload)
+
+
+def test_zip64_entries():
+    # force_zip64 writes a zip64 extra field in the local headers and zip64 sizes in the data descriptors
+    check_round_trip(bundle_bytes(lambda name: zipfile.ZIP_DEFLATED, directories=False, force_zip64=True))
+
+
+def test_strip_zip64_extra():
+    # ZipFile writes its own zip64 field for entries that need one, so a copied one would appear twice
+    zip64 = struct.pack('<HHQQ', 1, 16, 5 << 32, 6 << 32)
+    timestamp = struct.pack('<HHBL', 0x5455, 5, 1, 1700000000)
+    assert app._strip_zip64_extra(timestamp + zip64 + timestamp) == timestamp + timestamp
+    assert app._strip_zip64_extra(zip64) == b''
+    assert app._strip_zip64_extra(b'') == b''
+
+
+def test_output_can_be_processed_again():
+    once = check_round_trip(bundle_bytes(lambda name: zipfile.ZIP_DEFLATED))
+    out = io.BytesIO()
+    app.stream_zip_with_ai(io.BytesIO(once), out)
+    with zipfile.ZipFile(io.BytesIO(once)) as first, zipfile.ZipFile(out) as second:
+        assert second.testzip() is None
+        assert {info.filename: second.read(info) for info in second.infolist()} == \
+               {info.filename: first.read(info) for info in first.infolist()}
+
+
+def test_make_zip_with_ai_matches_stream():
+    upload = bundle_bytes(lambda name: zipfile.ZIP_DEFLATED)
+    out = io.BytesIO()
+    app.stream_zip_with_ai(io.BytesIO(upload), out)
+    assert app.make_zip_with_ai(upload) == out.getvalue()
+
+
+def test_copy_zip_entry():
+    upload = bundle_bytes(lambda name: zipfile.ZIP_DEFLATED)
+    out = io.BytesIO()
+    copied = []
+    with zipfile.ZipFile(io.BytesIO(upload)) as src_zip, zipfile.ZipFile(out, 'w') as out_zip:
+        info = src_zip.getinfo('bundle/fixtures/weights.bin')
+        app.copy_zip_entry(src_zip, out_zip, info, on_copied=copied.append)
+        out_zip.writestr('after.txt', b'written after the copied entry')
+    assert sum(copied) == info.compress_size
+    with zipfile.ZipFile(out) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ['bundle/fixtures/weights.bin', 'after.txt']
+        assert zf.read('bundle/fixtures/weights.bin') == entries()['bundle/fixtures/weights.bin']
+
+
+def test_bad_local_header():
+    upload = bytearray(bundle_bytes(lambda name: zipfile.ZIP_DEFLATED))
+    with zipfile.ZipFile(io.BytesIO(bytes(upload))) as zf:
+        offset = zf.getinfo('bundle/autograde.py').header_offset
+    upload[offset:offset + 4] = b'XXXX'
+    with pytest.raises(zipfile.BadZipFile):
+        app.stream_zip_with_ai(io.BytesIO(bytes(upload)), io.BytesIO())
+
+
+def test_missing_utils():
+    upload = io.BytesIO()
+    with zipfile.ZipFile(upload, 'w') as zf:
+        zf.writestr('bundle/autograde.py', 'x = 1\n')
+    with pytest.raises(RuntimeError):
+        app.stream_zip_with_ai(io.BytesIO(upload.getvalue()), io.BytesIO())
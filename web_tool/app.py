@@ -1,18 +1,41 @@
 import io
 import os
 import re
-import shutil
+import copy
+import hashlib
+import struct
 import tempfile
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from flask import Flask, render_template, request, send_file, flash, redirect, url_for
-import uuid
+from flask import Flask, render_template, request, send_file, flash, redirect, url_for, jsonify
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 AI_FEEDBACK_PATH = BASE_DIR / "ai_feedback.py"
 GENERATED_DIR = (BASE_DIR / "web_tool" / "generated")
 GENERATED_DIR.mkdir(parents=True, exist_ok=True)
 
+# Uploads up to this size are processed in memory; larger ones (e.g. bundles with model weights) are spooled to disk
+UPLOAD_SPOOL_BYTES = 16 * 1024 * 1024
+COPY_CHUNK_BYTES = 1024 * 1024
+
+# Bundles are processed in the background by this many worker threads; uploads beyond
+# MAX_PENDING_JOBS waiting or running jobs are turned away instead of piling up
+JOB_WORKERS = 2
+MAX_PENDING_JOBS = 16
+JOB_RETENTION_SECONDS = 3600  # how long /status remembers a finished job
+
+# Generated bundles are named by the hash of their upload and of ai_feedback.py, so a bundle uploaded
+# again is served from GENERATED_DIR instead of being reprocessed. Every EVICTION_INTERVAL_SECONDS, bundles
+# not generated or downloaded for GENERATED_MAX_AGE_SECONDS are deleted, then the least recently used
+# ones until the directory is under GENERATED_MAX_MB.
+GENERATED_MAX_MB = 2048
+GENERATED_MAX_AGE_SECONDS = 7 * 24 * 3600
+EVICTION_INTERVAL_SECONDS = 600
+ARTIFACT_VERSION = 1  # bump when stream_zip_with_ai changes what it writes, so old bundles are not served
+
 
 def ensure_import_and_call_in_utils(utils_text: str) -> str:
     """Insert AI feedback import and enhancer call INTO save_results, right before writing results.json.
@@ -62,82 +85,319 @@ def ensure_import_and_call_in_utils(utils_text: str) -> str:
 
 def make_zip_with_ai(upload_zip_bytes: bytes) -> bytes:
     """Process uploaded autograder zip and return modified zip bytes."""
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdir_path = Path(tmpdir)
-        src_dir = tmpdir_path / "src"
-        out_dir = tmpdir_path / "out"
-        src_dir.mkdir()
-        out_dir.mkdir()
-
-        # Extract upload
-        with zipfile.ZipFile(io.BytesIO(upload_zip_bytes)) as zf:
-            zf.extractall(src_dir)
-
-        # Locate utils.py
-        utils_path = None
-        for p in src_dir.rglob("utils.py"):
-            utils_path = p
-            break
-        if not utils_path:
-            raise RuntimeError("Could not find utils.py in the uploaded zip.")
+    out_buf = io.BytesIO()
+    stream_zip_with_ai(io.BytesIO(upload_zip_bytes), out_buf)
+    return out_buf.getvalue()
+
 
-        # Read and modify utils.py
-        utils_text = utils_path.read_text(encoding="utf-8")
-        modified_utils = ensure_import_and_call_in_utils(utils_text)
-        utils_path.write_text(modified_utils, encoding="utf-8")
+def stream_zip_with_ai(src, dst, progress=None) -> None:
+    """Write the bundle read from the seekable file `src` to `dst` with AI feedback added.
+
+    Only utils.py is rewritten and ai_feedback.py added next to it. Every other entry's compressed
+    bytes are copied through as they are, so model weights and data are never decompressed,
+    recompressed or held in memory. progress, if given, is called with the fraction done so far.
+    """
+    with zipfile.ZipFile(src) as src_zip:
+        infos = src_zip.infolist()
+        total_bytes = max(sum(info.compress_size for info in infos), 1)
+        done_bytes = 0
+
+        def advance(num_bytes):
+            nonlocal done_bytes
+            done_bytes += num_bytes
+            if progress is not None:
+                progress(min(done_bytes / total_bytes, 1.0))
+
+        # The utils.py closest to the root of the bundle
+        candidates = [info for info in infos if not info.is_dir() and info.filename.split("/")[-1] == "utils.py"]
+        if not candidates:
+            raise RuntimeError("Could not find utils.py in the uploaded zip.")
+        utils_info = min(candidates, key=lambda info: info.filename.count("/"))
+        utils_dir = utils_info.filename[:-len("utils.py")]
 
-        # Copy ai_feedback.py into same directory as utils.py
         if not AI_FEEDBACK_PATH.exists():
             raise RuntimeError("ai_feedback.py not found in repository root.")
-        shutil.copy2(AI_FEEDBACK_PATH, utils_path.parent / "ai_feedback.py")
 
-        # Re-zip contents
-        mem_buf = io.BytesIO()
-        with zipfile.ZipFile(mem_buf, mode="w", compression=zipfile.ZIP_DEFLATED) as out_zip:
-            for path in src_dir.rglob("*"):
-                if path.is_file():
-                    arcname = path.relative_to(src_dir).as_posix()
-                    out_zip.write(path, arcname)
-        mem_buf.seek(0)
-        return mem_buf.read()
+        with zipfile.ZipFile(dst, mode="w", compression=zipfile.ZIP_DEFLATED) as out_zip:
+            for info in infos:
+                if info.filename == utils_info.filename:
+                    # Read and modify utils.py
+                    utils_text = src_zip.read(info).decode("utf-8")
+                    utils_out = zipfile.ZipInfo(info.filename, info.date_time)
+                    utils_out.external_attr = info.external_attr
+                    out_zip.writestr(utils_out, ensure_import_and_call_in_utils(utils_text),
+                                     compress_type=zipfile.ZIP_DEFLATED)
+                    advance(info.compress_size)
+                elif info.filename == utils_dir + "ai_feedback.py":
+                    advance(info.compress_size)  # replaced by the current version below
+                else:
+                    copy_zip_entry(src_zip, out_zip, info, on_copied=advance)
+
+            # Copy ai_feedback.py into same directory as utils.py
+            out_zip.write(AI_FEEDBACK_PATH, utils_dir + "ai_feedback.py")
+
+
+def copy_zip_entry(src_zip: zipfile.ZipFile, out_zip: zipfile.ZipFile, info: zipfile.ZipInfo, on_copied=None) -> None:
+    """Append an entry of src_zip to out_zip by copying its compressed bytes, without decompressing them.
+    on_copied, if given, is called with the number of bytes after every chunk."""
+    src_fp = src_zip.fp
+    src_fp.seek(info.header_offset)
+    local_header = src_fp.read(zipfile.sizeFileHeader)
+    if len(local_header) != zipfile.sizeFileHeader or local_header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+    name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+    src_fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+    out_info = copy.copy(info)
+    # The CRC and sizes are known from the central directory, so they go in the local header
+    # instead of a data descriptor after the data
+    out_info.flag_bits &= ~0x08
+    out_info.extra = _strip_zip64_extra(info.extra)
+    out_info.header_offset = out_zip.fp.tell()
+    out_zip.fp.write(out_info.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        chunk = src_fp.read(min(COPY_CHUNK_BYTES, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+        out_zip.fp.write(chunk)
+        remaining -= len(chunk)
+        if on_copied is not None:
+            on_copied(len(chunk))
+
+    # Register the entry the way ZipFile.write does, so close() lists it in the central directory
+    out_zip.filelist.append(out_info)
+    out_zip.NameToInfo[out_info.filename] = out_info
+    out_zip.start_dir = out_zip.fp.tell()
+
+
+def _strip_zip64_extra(extra: bytes) -> bytes:
+    """Drop the zip64 extra field, which ZipFile writes again itself when the entry needs it."""
+    fields = []
+    i = 0
+    while i + 4 <= len(extra):
+        field_id, size = struct.unpack("<HH", extra[i:i + 4])
+        if field_id != 1:
+            fields.append(extra[i:i + 4 + size])
+        i += 4 + size
+    return b"".join(fields)
+
+
+def spool_upload(stream):
+    """Copy an upload into memory, or to a temporary file once it is larger than UPLOAD_SPOOL_BYTES.
+
+    Returns the spooled file and the sha256 of its contents, computed on the way through.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    digest = hashlib.sha256()
+    while True:
+        chunk = stream.read(COPY_CHUNK_BYTES)
+        if not chunk:
+            break
+        digest.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+
+class ArtifactStore:
+    """Generated bundles in a directory, one <key>.zip each, with size- and age-based eviction.
+
+    Hits and downloads refresh a bundle's mtime, so eviction removes the least recently used first.
+    """
+
+    def __init__(self, directory: Path = GENERATED_DIR, max_mb: float = GENERATED_MAX_MB,
+                 max_age: float = GENERATED_MAX_AGE_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_age = max_age
+
+    def key(self, upload_digest: str) -> str:
+        """Key of the bundle generated from an upload with this sha256 by the current ai_feedback.py."""
+        ai_digest = hashlib.sha256(AI_FEEDBACK_PATH.read_bytes()).hexdigest()
+        return hashlib.sha256(f"{ARTIFACT_VERSION}\n{upload_digest}\n{ai_digest}".encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}.zip"
+
+    def get(self, key: str):
+        """Path of the stored bundle, marked as recently used, or None if there is none."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def evict(self) -> int:
+        """Delete expired bundles, then the least recently used until under the size limit. Returns how many."""
+        now = time.time()
+        entries = []
+        for path in self.directory.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.suffix == ".zip":
+                entries.append((stat.st_mtime, stat.st_size, path))
+            elif path.name.endswith(".zip.part") and stat.st_mtime < now - self.max_age:
+                path.unlink(missing_ok=True)  # left behind by a crash; live jobs write to theirs continuously
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if mtime >= now - self.max_age and total <= self.max_bytes:
+                break
+            # A bundle being downloaded stays readable until the download finishes
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def start_eviction(self, interval: float = EVICTION_INTERVAL_SECONDS) -> threading.Thread:
+        def evict_forever():
+            while True:
+                try:
+                    self.evict()
+                except OSError as e:
+                    print(f"Evicting generated bundles failed: {e}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=evict_forever, name="artifact-eviction", daemon=True)
+        thread.start()
+        return thread
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """Bundle jobs processed on a bounded pool of worker threads, with their status for /status.
+
+    A job's id is the artifact key of the bundle it generates, so /download/<id> serves it once done,
+    an upload whose bundle is already stored is done at once, and one already being processed joins that job.
+    The bundle is written under a .part name and renamed when complete, so it is never served half-written.
+    """
+
+    def __init__(self, store: ArtifactStore, workers: int = JOB_WORKERS, max_pending: int = MAX_PENDING_JOBS):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bundle-job")
+        self.max_pending = max_pending
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, upload, upload_digest: str) -> str:
+        """Queue a spooled upload (which is closed once processed or found to be a duplicate) and return the job id."""
+        job_id = self.store.key(upload_digest)
+        with self.lock:
+            self._forget_old_jobs()
+            job = self.jobs.get(job_id)
+            if job is not None and job["status"] in ("queued", "running"):
+                upload.close()
+                return job_id
+            if self.store.get(job_id) is not None:
+                upload.close()
+                self.jobs[job_id] = {"status": "done", "progress": 1.0, "error": None, "cached": True,
+                                     "updated": time.time()}
+                return job_id
+            pending = sum(job["status"] in ("queued", "running") for job in self.jobs.values())
+            if pending >= self.max_pending:
+                raise QueueFull(f"{pending} bundles are already being processed. Please try again in a minute.")
+            self.jobs[job_id] = {"status": "queued", "progress": 0.0, "error": None, "cached": False,
+                                 "updated": time.time()}
+        self.executor.submit(self._run, job_id, upload)
+        return job_id
+
+    def status(self, job_id: str):
+        """A copy of the job's status, or None if the job is unknown."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _update(self, job_id: str, **fields) -> None:
+        with self.lock:
+            self.jobs[job_id].update(fields, updated=time.time())
+
+    def _run(self, job_id: str, upload) -> None:
+        self._update(job_id, status="running")
+        out_path = self.store.path(job_id)
+        part_path = out_path.with_name(out_path.name + ".part")
+        try:
+            with upload, open(part_path, "wb") as f:
+                stream_zip_with_ai(upload, f, progress=lambda fraction: self._update(job_id, progress=round(fraction, 3)))
+            os.replace(part_path, out_path)
+            self._update(job_id, status="done", progress=1.0)
+        except Exception as e:
+            part_path.unlink(missing_ok=True)
+            self._update(job_id, status="failed", error=str(e))
+
+    def _forget_old_jobs(self) -> None:
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job["status"] in ("done", "failed") and job["updated"] < cutoff]:
+            del self.jobs[job_id]
 
 
 def create_app():
     app = Flask(__name__)
     app.secret_key = os.environ.get("SECRET_KEY", "dev-secret")
+    store = ArtifactStore()
+    store.start_eviction()
+    jobs = JobQueue(store)
 
     @app.route("/", methods=["GET"]) 
     def index():
         ready_id = request.args.get("ready")
-        return render_template("index.html", ready_id=ready_id)
+        job_id = request.args.get("job")
+        return render_template("index.html", ready_id=ready_id, job_id=job_id)
 
     @app.route("/process", methods=["POST"]) 
     def process():
+        # API clients get JSON; browsers are redirected to the page, which polls /status
+        wants_json = request.accept_mimetypes.best == "application/json"
         file = request.files.get("bundle")
         if not file or not file.filename.lower().endswith(".zip"):
+            if wants_json:
+                return jsonify(error="Please upload a .zip file of your autograder bundle."), 400
             flash("Please upload a .zip file of your autograder bundle.")
             return redirect(url_for("index"))
+        # The upload is only readable during the request, so it is spooled before the job is queued
+        upload, upload_digest = spool_upload(file.stream)
         try:
-            zip_bytes = file.read()
-            output_zip = make_zip_with_ai(zip_bytes)
-            # Persist the generated zip to a temporary server folder
-            file_id = str(uuid.uuid4())
-            out_path = GENERATED_DIR / f"{file_id}.zip"
-            with open(out_path, "wb") as f:
-                f.write(output_zip)
-            # Redirect to index with a ready flag to show a manual download button
-            flash("Your bundle is ready. Click the button below to download.")
-            return redirect(url_for("index", ready=file_id))
-        except Exception as e:
+            job_id = jobs.submit(upload, upload_digest)
+        except QueueFull as e:
+            upload.close()
+            if wants_json:
+                return jsonify(error=str(e)), 503
             flash(f"Error: {e}")
             return redirect(url_for("index"))
+        if wants_json:
+            return jsonify(job_id=job_id, status_url=url_for("status", job_id=job_id),
+                           download_url=url_for("download", file_id=job_id)), 202
+        return redirect(url_for("index", job=job_id))
+
+    @app.route("/status/<job_id>", methods=["GET"])
+    def status(job_id: str):
+        job = jobs.status(job_id)
+        safe_id = re.sub(r"[^a-zA-Z0-9\-]", "", job_id)
+        if job is None or (job["status"] == "done" and not store.path(safe_id).exists()):
+            # Forgotten, from before a restart, or evicted: done only if its bundle is still there
+            if not store.path(safe_id).exists():
+                return jsonify(error="Unknown or expired job. Please upload the bundle again."), 404
+            job = {"status": "done", "progress": 1.0, "error": None, "cached": True}
+        response = {"job_id": job_id, "status": job["status"], "progress": job["progress"], "error": job["error"],
+                    "cached": job["cached"]}
+        if job["status"] == "done":
+            response["download_url"] = url_for("download", file_id=job_id)
+        return jsonify(response)
 
     @app.route("/download/<file_id>", methods=["GET"]) 
     def download(file_id: str):
         # Serve the previously generated file by id
         safe_id = re.sub(r"[^a-zA-Z0-9\-]", "", file_id)
-        path = GENERATED_DIR / f"{safe_id}.zip"
-        if not path.exists():
+        path = store.get(safe_id)
+        if path is None:
             flash("Download not found or expired. Please regenerate.")
             return redirect(url_for("index"))
         return send_file(path, mimetype="application/zip", as_attachment=True, download_name="autograder_with_ai_feedback.zip")